@@ -16,32 +16,43 @@ import datetime
 import json
 import contextlib
 import itertools
+import subprocess
+import platform
+import resource
+import glob
+import traceback
+import binascii
+import threading
+import queue
 
 from os.path import expanduser
 from random import sample
 
-# import PoseUNet
-import PoseUNet_dataset as PoseUNet
-import PoseUNet_resnet as PoseURes
 import hdf5storage
 import imageio
 import multiResData
 from multiResData import float_feature, int64_feature,bytes_feature,trx_pts, check_fnum
+import trx_transforms
+import trx_table
+import lbl_cache
+import hmap_sink
+import trk_filter
+import poseConfig
 # from multiResData import *
-import leap.training
-from leap.training import train as leap_train
-#import open_pose as op
-# import sb1 as sb
-from deeplabcut.pose_estimation_tensorflow.train import train as deepcut_train
-import deeplabcut.pose_estimation_tensorflow.train
 import ast
 import tempfile
-import tensorflow
-vv = [int(v) for v in tensorflow.__version__.split('.')]
-if vv[0]==1 and vv[1]>12:
-    tf = tensorflow.compat.v1
-else:
-    tf = tensorflow
+import importlib
+import copy
+from lazy_import import LazyModule, lazy_tf
+# tensorflow and the network backends are imported only when they are first used
+tf = lazy_tf()
+PoseUNet = LazyModule('PoseUNet_dataset')
+PoseURes = LazyModule('PoseUNet_resnet')
+leap = LazyModule('leap', 'leap.training')
+deeplabcut = LazyModule('deeplabcut', 'deeplabcut.pose_estimation_tensorflow.train')
+link_trajectories = LazyModule('link_trajectories')
+#import open_pose as op
+# import sb1 as sb
 
 import sys
 import h5py
@@ -63,13 +74,46 @@ import getpass
 
 ISPY3 = sys.version_info >= (3, 0)
 N_TRACKED_WRITE_INTERVAL_SEC = 10 # interval in seconds between writing n frames tracked
+LIST_READER_POLL_SEC = 5 # interval in seconds between checks that the list reader processes are alive
 
 try:
     user = getpass.getuser()
 except KeyError:
     user = 'err'
 if ISPY3 and user!='ubuntu': # AL 20201111 exception for AWS; running on older AMI
-    import apt_dpk
+    apt_dpk = LazyModule('apt_dpk')
+
+# Modules needed by each network type. Other network types are in Pose_<type>.py
+NET_MODULES = {
+    'mdn': ['PoseUNet_resnet'],
+    'unet': ['PoseUNet_dataset'],
+    'leap': ['leap.training'],
+    'deeplabcut': ['deeplabcut.pose_estimation_tensorflow.train'],
+    'dpk': ['apt_dpk'],
+}
+
+
+def import_net_modules(net_type):
+    ''' Imports the modules for net_type upfront, so that missing dependencies are reported
+    before any work is done. Modules for other network types are not imported.'''
+    start = time.time()
+    for m in NET_MODULES.get(net_type, ['Pose_{}'.format(net_type)]):
+        try:
+            importlib.import_module(m)
+        except ImportError:
+            logging.warning('Could not import {} for network type {}'.format(m, net_type))
+            raise
+    logging.info('Imported modules for {} in {:.1f}s'.format(net_type, time.time() - start))
+
+
+def leap_train(*args, **kwargs):
+    from leap.training import train
+    return train(*args, **kwargs)
+
+
+def deepcut_train(*args, **kwargs):
+    from deeplabcut.pose_estimation_tensorflow.train import train
+    return train(*args, **kwargs)
 
 
 def savemat_with_catch_and_pickle(filename, out_dict):
@@ -236,8 +280,10 @@ def tf_serialize(data):
 
 
 def create_tfrecord(conf, split=True, split_file=None, use_cache=True, on_gt=False,
-                    db_files=(), max_nsamples=np.Inf, use_gt_cache=False):
+                    db_files=(), max_nsamples=np.Inf, use_gt_cache=False, db_fn=None):
     # function that creates tfrecords using db_from_lbl
+    # db_fn, if given, is called as db_fn(conf, out_fns, split, split_file) instead of
+    # db_from_lbl/db_from_cached_lbl and should return the splits.
     if not os.path.exists(conf.cachedir):
         os.mkdir(conf.cachedir)
 
@@ -262,7 +308,9 @@ def create_tfrecord(conf, split=True, split_file=None, use_cache=True, on_gt=Fal
 
     out_fns = [lambda data: envs[0].write(tf_serialize(data)),
                lambda data: envs[1].write(tf_serialize(data))]
-    if use_cache:
+    if db_fn is not None:
+        splits = db_fn(conf, out_fns, split, split_file)
+    elif use_cache:
         splits,__ = db_from_cached_lbl(conf, out_fns, split, split_file, on_gt,
                                        use_gt_cache=use_gt_cache)
     else:
@@ -372,6 +420,25 @@ def write_hmaps(hmaps, hmaps_dir, trx_ndx, frame_num, extra_str=''):
 
 
 def get_net_type(lbl_file):
+    ''' Net type saved in the lbl file. Cached (see lbl_cache) till the lbl file changes.'''
+    return lbl_cache.cached('net_type', lbl_file, None, lambda: read_net_type(lbl_file))
+
+
+def get_nviews(lbl_file):
+    ''' Number of views in the project. Cached (see lbl_cache) till the lbl file changes.'''
+
+    def compute():
+        try:
+            H = loadmat(lbl_file)
+        except NotImplementedError:
+            logging.info('Label file is in v7.3 format. Loading using h5py')
+            H = h5py.File(lbl_file, 'r')
+        return int(read_entry(H['cfg']['NumViews']))
+
+    return lbl_cache.cached('nviews', lbl_file, None, compute)
+
+
+def read_net_type(lbl_file):
     lbl = h5py.File(lbl_file, 'r')
     dt_params_ndx = None
     for ndx in range(lbl['trackerClass'].shape[0]):
@@ -466,7 +533,22 @@ def conf_opts_pvargstr2dict(conf_str):
     return conf_opts
 
 
-def create_conf(lbl_file, view, name, cache_dir=None, net_type='unet',conf_params=None,quiet=False):
+def create_conf(lbl_file, view, name, cache_dir=None, net_type='unet',conf_params=None,quiet=False,use_cache=True):
+    ''' Creates the conf for the project. Parsing the lbl file is slow, so the conf is cached
+    (see lbl_cache) and reused as long as the lbl file and the arguments don't change.'''
+    code_files = [__file__, poseConfig.__file__]
+    extra_key = (view, name, cache_dir, net_type, None if conf_params is None else tuple(conf_params),
+                 tuple(os.path.getmtime(f) for f in code_files))
+    conf = lbl_cache.cached('conf', lbl_file, extra_key,
+                            lambda: create_conf_from_lbl(lbl_file, view, name, cache_dir=cache_dir, net_type=net_type,
+                                                         conf_params=conf_params, quiet=quiet),
+                            use_cache=use_cache)
+    if not os.path.exists(conf.cachedir):
+        os.makedirs(conf.cachedir)
+    return conf
+
+
+def create_conf_from_lbl(lbl_file, view, name, cache_dir=None, net_type='unet',conf_params=None,quiet=False):
 
     try:
         try:
@@ -715,6 +797,12 @@ def create_conf(lbl_file, view, name, cache_dir=None, net_type='unet',conf_param
                 print('Overriding param %s <= '%n,v)
             setattr(conf,n,ast.literal_eval(v))
 
+    if conf.detect_crop_sz is not None and not conf.has_trx_file:
+        # the pose network works on crops around the animal. detect_imsz is the size of the whole frame
+        conf.detect_imsz = conf.imsz
+        conf.imsz = tuple(int(sz) for sz in conf.detect_crop_sz)
+        conf.sel_sz = min(conf.imsz)
+
     # overrides for each network
     if net_type == 'sb':
         sb.update_conf(conf)
@@ -785,19 +873,47 @@ def test_preproc(lbl_file=None,cachedir=None):
 def get_cur_trx(trx_file, trx_ndx):
     if trx_file is None:
         return None, 1
-    try:
-        trx = sio.loadmat(trx_file)['trx'][0]
-        cur_trx = trx[trx_ndx]
-        n_trx = len(trx)
-    except NotImplementedError:
-        # trx file in v7.3 format
-        # print('Trx file is in v7.3 format. Loading using h5py')
-        trx = h5py.File(trx_file,'r')['trx']
-        cur_trx = {}
-        for k in trx.keys():
-            cur_trx[k] = np.array(trx[trx[k][trx_ndx,0]]).T
-        n_trx = trx['x'].shape[0]
-    return cur_trx, n_trx
+    # handles both v5 and v7.3 trx files, and caches the parsed trx.
+    trx = trx_table.load_trx(trx_file)
+    return trx[trx_ndx], len(trx)
+
+
+def get_project_info(conf, on_gt=False, use_cache=True):
+    ''' Movie files, trx files, crop locations and labeled frames for conf.view, read from the lbl file.
+    Like the conf, this is cached and reused until the lbl file changes.
+    Returned dict has
+        movies: movie files
+        trx_files: trx files (None for each movie if the project has no trx files)
+        crop_locs: 0-indexed crop locations for each movie (None if the movie isn't cropped)
+        labeled: for each movie, list of 0-indexed labeled frames for each target. Use get_labeled_frames to access.
+    '''
+
+    def compute():
+        local_dirs, _ = multiResData.find_local_dirs(conf, on_gt)
+        lbl = h5py.File(conf.labelfile, 'r')
+        if conf.has_trx_file:
+            trx_files = multiResData.get_trx_files(lbl, local_dirs, on_gt)
+        else:
+            trx_files = [None, ] * len(local_dirs)
+        crop_locs = [PoseTools.get_crop_loc(lbl, ndx, conf.view, on_gt) for ndx in range(len(local_dirs))]
+        labeled = []
+        for ndx in range(len(local_dirs)):
+            # same as multiResData.get_labeled_frames, but reads the labels only once for all the targets.
+            cur_pts = trx_pts(lbl, ndx, on_gt)
+            if cur_pts.ndim == 3:
+                cur_pts = cur_pts[np.newaxis, ...]
+            labeled.append([np.where(np.invert(np.all(np.isnan(p), axis=(1, 2))))[0] for p in cur_pts])
+        lbl.close()
+        return {'movies': local_dirs, 'trx_files': trx_files, 'crop_locs': crop_locs, 'labeled': labeled}
+
+    return lbl_cache.cached('project', conf.labelfile, (conf.view, on_gt, conf.has_trx_file), compute, use_cache=use_cache)
+
+
+def get_labeled_frames(info, mov_ndx, trx_ndx):
+    ''' Labeled frames for target trx_ndx in movie mov_ndx from get_project_info output. '''
+    cur_labeled = info['labeled'][mov_ndx]
+    # labels are not per target in projects without trx
+    return cur_labeled[trx_ndx] if len(cur_labeled) > 1 else cur_labeled[0]
 
 
 def db_from_lbl(conf, out_fns, split=True, split_file=None, on_gt=False, sel=None, max_nsamples=np.Inf):
@@ -814,7 +930,8 @@ def db_from_lbl(conf, out_fns, split=True, split_file=None, on_gt=False, sel=Non
 
     # assert not (on_gt and split), 'Cannot split gt data'
 
-    local_dirs, _ = multiResData.find_local_dirs(conf, on_gt)
+    proj_info = get_project_info(conf, on_gt)
+    local_dirs = proj_info['movies']
     lbl = h5py.File(conf.labelfile, 'r')
     view = conf.view
     flipud = conf.flipud
@@ -849,7 +966,7 @@ def db_from_lbl(conf, out_fns, split=True, split_file=None, on_gt=False, sel=Non
         cur_pts = trx_pts(lbl, ndx, on_gt)
         cur_occ = trx_pts(lbl, ndx, on_gt, field_name='labeledpostag')
         cur_occ = ~np.isnan(cur_occ)
-        crop_loc = PoseTools.get_crop_loc(lbl, ndx, view, on_gt)
+        crop_loc = proj_info['crop_locs'][ndx]
 
         try:
             cap = movies.Movie(dir_name)
@@ -857,12 +974,11 @@ def db_from_lbl(conf, out_fns, split=True, split_file=None, on_gt=False, sel=Non
             logging.exception('MOVIE_READ: ' + local_dirs[ndx] + ' is missing')
             sys.exit(1)
 
+        trx_files = proj_info['trx_files']
         if conf.has_trx_file:
-            trx_files = multiResData.get_trx_files(lbl, local_dirs, on_gt)
             _, n_trx = get_cur_trx(trx_files[ndx],0)
             trx_split = np.random.random(n_trx) < conf.valratio
         else:
-            trx_files = [None,]*len(local_dirs)
             n_trx = 1
             trx_split = None
             cur_pts = cur_pts[np.newaxis, ...]
@@ -873,16 +989,23 @@ def db_from_lbl(conf, out_fns, split=True, split_file=None, on_gt=False, sel=Non
             if nsamples >= max_nsamples:
                 break
             
-            frames = multiResData.get_labeled_frames(lbl, ndx, trx_ndx, on_gt)
+            frames = get_labeled_frames(proj_info, ndx, trx_ndx)
             cur_trx, _ = get_cur_trx(trx_files[ndx], trx_ndx)
+            frames = [fnum for fnum in frames if check_fnum(fnum, cap, exp_name, ndx)]
+            # read the labeled frames batch_size at a time.
+            read_ims = {}
             for fnum in frames:
-                if not check_fnum(fnum, cap, exp_name, ndx):
-                    continue
+                if fnum not in read_ims:
+                    to_read = [f for f in frames if f >= fnum and f < cap.get_n_frames()]
+                    to_read = sorted(set(to_read))[:conf.batch_size]
+                    read_ims = dict(zip(to_read, cap.get_frames(to_read)[0])) if len(to_read) > 0 else {}
 
                 info = [int(ndx), int(fnum), int(trx_ndx)]
                 cur_out = multiResData.get_cur_env(out_fns, split, conf, info, mov_split, trx_split=trx_split, predefined=predefined)
 
-                frame_in, cur_loc = multiResData.get_patch( cap, fnum, conf, cur_pts[trx_ndx, fnum, :, sel_pts], cur_trx=cur_trx, flipud=flipud, crop_loc=crop_loc)
+                frame_in, cur_loc = multiResData.get_patch( cap, fnum, conf, cur_pts[trx_ndx, fnum, :, sel_pts], cur_trx=cur_trx, flipud=flipud, crop_loc=crop_loc, frame=read_ims.get(fnum))
+                if is_detect_crop(conf):
+                    frame_in, cur_loc = trx_transforms.crop_around_locs(conf, frame_in, cur_loc)
 
                 if occ_as_nan:
                     cur_loc[cur_occ[fnum,:],:] = np.nan
@@ -1009,6 +1132,8 @@ def db_from_cached_lbl(conf, out_fns, split=True, split_file=None, on_gt=False,
         # For old style code where rotation is done in py look at git history around here to find the code .
 
         info = [int(mndx), int(f_ndx[ndx]), int(t_ndx[ndx])]
+        if is_detect_crop(conf):
+            cur_frame, cur_locs = trx_transforms.crop_around_locs(conf, cur_frame, cur_locs)
 
         cur_out = multiResData.get_cur_env(out_fns, split, conf, info,
                                            mov_split, trx_split=None, predefined=predefined)
@@ -1035,7 +1160,7 @@ def db_from_cached_lbl(conf, out_fns, split=True, split_file=None, on_gt=False,
     return splits,sel
 
 
-def create_leap_db(conf, split=False, split_file=None, use_cache=False):
+def create_leap_db(conf, split=False, split_file=None, use_cache=False, db_fn=None):
     # function showing how to use db_from_lbl for tfrecords
     if not os.path.exists(conf.cachedir):
         os.mkdir(conf.cachedir)
@@ -1045,7 +1170,9 @@ def create_leap_db(conf, split=False, split_file=None, use_cache=False):
 
     # collect the images and labels in arrays
     out_fns = [lambda data: train_data.append(data), lambda data: val_data.append(data)]
-    if use_cache:
+    if db_fn is not None:
+        splits = db_fn(conf, out_fns, split, split_file)
+    elif use_cache:
         splits,__ = db_from_cached_lbl(conf, out_fns, split, split_file)
     else:
         splits = db_from_lbl(conf, out_fns, split, split_file)
@@ -1085,7 +1212,7 @@ def create_leap_db(conf, split=False, split_file=None, use_cache=False):
             hf.close()
 
 
-def create_deepcut_db(conf, split=False, split_file=None, use_cache=False):
+def create_deepcut_db(conf, split=False, split_file=None, use_cache=False, db_fn=None):
     if not os.path.exists(conf.cachedir):
         os.mkdir(conf.cachedir)
 
@@ -1135,7 +1262,9 @@ def create_deepcut_db(conf, split=False, split_file=None, use_cache=False):
 
     # collect the images and labels in arrays
     out_fns = [train_out_fn, val_out_fn]
-    if use_cache:
+    if db_fn is not None:
+        splits = db_fn(conf, out_fns, split, split_file)
+    elif use_cache:
         splits,__ = db_from_cached_lbl(conf, out_fns, split, split_file)
     else:
         splits = db_from_lbl(conf, out_fns, split, split_file)
@@ -1163,23 +1292,21 @@ def create_deepcut_db(conf, split=False, split_file=None, use_cache=False):
 
 def create_cv_split_files(conf, n_splits=3):
     # creates json files for the xv splits
-    local_dirs, _ = multiResData.find_local_dirs(conf)
-    lbl = h5py.File(conf.labelfile, 'r')
+    proj_info = get_project_info(conf)
+    local_dirs = proj_info['movies']
 
     mov_info = []
     trx_info = []
     n_labeled_frames = 0
     for ndx, dir_name in enumerate(local_dirs):
         if conf.has_trx_file:
-            trx_files = multiResData.get_trx_files(lbl, local_dirs)
-            trx = sio.loadmat(trx_files[ndx])['trx'][0]
-            n_trx = len(trx)
+            n_trx = len(trx_table.load_trx(proj_info['trx_files'][ndx]))
         else:
             n_trx = 1
 
         cur_mov_info = []
         for trx_ndx in range(n_trx):
-            frames = multiResData.get_labeled_frames(lbl, ndx, trx_ndx)
+            frames = get_labeled_frames(proj_info, ndx, trx_ndx)
             mm = [ndx] * frames.size
             tt = [trx_ndx] * frames.size
             cur_trx_info = list(zip(mm, frames.tolist(), tt))
@@ -1187,7 +1314,6 @@ def create_cv_split_files(conf, n_splits=3):
             cur_mov_info.extend(cur_trx_info)
             n_labeled_frames += frames.size
         mov_info.append(cur_mov_info)
-    lbl.close()
 
     lbls_per_fold = n_labeled_frames / n_splits
 
@@ -1245,15 +1371,40 @@ def create_cv_split_files(conf, n_splits=3):
     return all_train, splits, split_files
 
 
-def create_batch_ims(to_do_list, conf, cap, flipud, trx, crop_loc):
+def create_batch_ims(to_do_list, conf, cap, flipud, trx, crop_loc, trx_arr=None):
+    '''
+    trx_arr: trx unpacked with trx_transforms.unpack_trx. If given, the crop matrices for the whole batch are computed together.
+    '''
     bsize = conf.batch_size
     all_f = np.zeros((bsize,) + tuple(conf.imsz) + (conf.img_dim,))
     # KB 20200504: sometimes crop_loc might be specified as nans when
     # we want no cropping to happen for reasons. 
     if crop_loc is not None and np.any(np.isnan(np.array(crop_loc))):
         crop_loc = None
-        
-    for cur_t in range(len(to_do_list)):
+
+    if conf.has_trx_file and trx_arr is not None and len(to_do_list) > 0:
+        cur_list = np.array(to_do_list)
+        fnums = trx_transforms.clip_fnums(trx_arr, cur_list[:, 1], cur_list[:, 0])
+        x, y, theta = trx_transforms.get_xytheta(trx_arr, cur_list[:, 1], fnums)
+        A_full = trx_transforms.crop_matrices(conf, x, y, theta)
+        valid = [cur_t for cur_t in range(len(to_do_list)) if check_fnum(cur_list[cur_t, 0], cap, 0, 0)]
+        if len(valid) == 0:
+            return all_f
+        # read all the frames of the batch together.
+        frames = cap.get_frames(np.array(fnums)[valid])[0]
+        for ndx, cur_t in enumerate(valid):
+            frame_in = frames[ndx]
+            if flipud:
+                frame_in = np.flipud(frame_in)
+            all_f[cur_t, ...] = trx_transforms.crop_patch(conf, frame_in, A_full[cur_t])
+        return all_f
+
+    valid = [cur_t for cur_t in range(len(to_do_list)) if check_fnum(to_do_list[cur_t][0], cap, 0, 0)]
+    if len(valid) > 0:
+        # read all the frames of the batch together. get_patch reads the frame itself if it gets clipped.
+        fr_nums = np.clip([to_do_list[cur_t][0] for cur_t in valid], 0, cap.get_n_frames() - 1)
+        frames = cap.get_frames(fr_nums)[0]
+    for ndx, cur_t in enumerate(valid):
         cur_entry = to_do_list[cur_t]
         trx_ndx = cur_entry[1]
         cur_trx = trx[trx_ndx]
@@ -1261,7 +1412,7 @@ def create_batch_ims(to_do_list, conf, cap, flipud, trx, crop_loc):
 
         frame_in, cur_loc = multiResData.get_patch(
             cap, cur_f, conf, np.zeros([conf.n_classes, 2]),
-            cur_trx=cur_trx, flipud=flipud, crop_loc=crop_loc)
+            cur_trx=cur_trx, flipud=flipud, crop_loc=crop_loc, frame=frames[ndx])
         all_f[cur_t, ...] = frame_in
     return all_f
 
@@ -1269,10 +1420,10 @@ def create_batch_ims(to_do_list, conf, cap, flipud, trx, crop_loc):
 def get_trx_info(trx_file, conf, n_frames):
     ''' all returned values are 0-indexed'''
     if conf.has_trx_file:
-        trx = sio.loadmat(trx_file)['trx'][0]
+        trx = trx_table.load_trx(trx_file)
         n_trx = len(trx)
-        end_frames = np.array([x['endframe'][0, 0] for x in trx])
-        first_frames = np.array([x['firstframe'][0, 0] for x in trx]) - 1  # for converting from 1 indexing to 0 indexing
+        end_frames = trx.end_frames()
+        first_frames = trx.first_frames()  # for converting from 1 indexing to 0 indexing
     else:
         trx = [None, ]
         n_trx = 1
@@ -1352,6 +1503,7 @@ def classify_list(conf, pred_fn, cap, to_do_list, trx, crop_loc, n_done=0, part_
     n_batches = int(math.ceil(float(n_list) / bsize))
 
     ret_dict = {}
+    trx_arr = trx_transforms.unpack_trx(trx) if conf.has_trx_file else None
 
     # if part_file is specified, output count of number of frames tracked 
     # (n_done) to part_file every N_TRACKED_WRITE_INTERVAL_SEC seconds
@@ -1363,7 +1515,7 @@ def classify_list(conf, pred_fn, cap, to_do_list, trx, crop_loc, n_done=0, part_
         cur_start = cur_b * bsize
         nrows_pred = min(n_list - cur_start, bsize)
         all_f = create_batch_ims(to_do_list[cur_start:(cur_start + nrows_pred)],
-                                 conf, cap, flipud, trx, crop_loc)
+                                 conf, cap, flipud, trx, crop_loc, trx_arr=trx_arr)
         assert all_f.shape[0] == bsize  # dim0 has size bsize but only nrows_pred rows are filled
         ret_dict_b = pred_fn(all_f)
 
@@ -1378,24 +1530,20 @@ def classify_list(conf, pred_fn, cap, to_do_list, trx, crop_loc, n_done=0, part_
                 ret_dict[k] = np.zeros((n_list, ) + sz)
                 ret_dict[k][:] = np.nan
 
-        for cur_t in range(nrows_pred):
-            cur_entry = to_do_list[cur_t + cur_start]
-            cur_f = cur_entry[0]
-            trx_ndx = cur_entry[1]
-            cur_trx = trx[trx_ndx]
-            for k in ret_dict_b.keys():
-                retval = ret_dict_b[k]
-                if retval.ndim == 4:  # hmaps
-                    pass
-                elif retval.ndim == 3 or retval.ndim == 2:
-                    cur_orig = retval[cur_t, ...]
-                    if k.startswith('locs'):  # transform locs
-                        assert retval.ndim == 3
-                        cur_orig = convert_to_orig(cur_orig, conf, cur_f, cur_trx, crop_loc)
-                    ret_dict[k][cur_start + cur_t, ...] = cur_orig
-                else:
-                    logging.info("Ignoring return value '{}' with shape {}".format(k, retval.shape))
-                    #assert False, "Unexpected number of dims in return val"
+        cur_list = np.array(to_do_list[cur_start:(cur_start + nrows_pred)])
+        for k in ret_dict_b.keys():
+            retval = ret_dict_b[k]
+            if retval.ndim == 4:  # hmaps
+                pass
+            elif retval.ndim == 3 or retval.ndim == 2:
+                cur_orig = retval[:nrows_pred, ...]
+                if k.startswith('locs'):  # transform locs
+                    assert retval.ndim == 3
+                    cur_orig = trx_transforms.convert_to_orig_batch(cur_orig, conf, cur_list[:, 0], cur_list[:, 1], trx_arr, crop_loc)
+                ret_dict[k][cur_start:(cur_start + nrows_pred), ...] = cur_orig
+            else:
+                logging.info("Ignoring return value '{}' with shape {}".format(k, retval.shape))
+                #assert False, "Unexpected number of dims in return val"
         # update count of frames tracked
         n_done += nrows_pred
         if do_write_n_done:
@@ -1418,9 +1566,10 @@ def write_n_tracked_part_file(n_done,part_file):
         fh.write("{}".format(n_done))
     
 
-def get_pred_fn(model_type, conf, model_file=None,name='deepnet',distort=False,**kwargs):
+def get_pred_fn(model_type, conf, model_file=None,name='deepnet',distort=False,reset_graph=True,**kwargs):
     ''' Returns prediction functions and close functions for different network types
-
+    If reset_graph is False, the tf networks are created in the current default graph (see TrackGraph)
+    instead of in a new one.
     '''
     if model_type == 'dpk':
         pred_fn, close_fn, model_file = apt_dpk.get_pred_fn(conf, model_file, **kwargs)
@@ -1429,19 +1578,20 @@ def get_pred_fn(model_type, conf, model_file=None,name='deepnet',distort=False,*
     elif model_type == 'sb':
         pred_fn, close_fn, model_file = sb.get_pred_fn(conf, model_file, name=name,**kwargs)
     elif model_type == 'unet':
-        pred_fn, close_fn, model_file = get_unet_pred_fn(conf, model_file,name=name,**kwargs)
+        pred_fn, close_fn, model_file = get_unet_pred_fn(conf, model_file,name=name,reset_graph=reset_graph,**kwargs)
     elif model_type == 'mdn':
-        pred_fn, close_fn, model_file = get_mdn_pred_fn(conf, model_file,name=name,distort=distort,**kwargs)
+        pred_fn, close_fn, model_file = get_mdn_pred_fn(conf, model_file,name=name,distort=distort,reset_graph=reset_graph,**kwargs)
     elif model_type == 'leap':
         pred_fn, close_fn, model_file = leap.training.get_pred_fn(conf, model_file,name=name,**kwargs)
     elif model_type == 'deeplabcut':
         cfg_dict = create_dlc_cfg_dict(conf,name)
-        pred_fn, close_fn, model_file = deeplabcut.pose_estimation_tensorflow.get_pred_fn(cfg_dict, model_file)
+        pred_fn, close_fn, model_file = deeplabcut.pose_estimation_tensorflow.get_pred_fn(cfg_dict, model_file, batch_size=conf.batch_size)
     else:
         try:
             module_name = 'Pose_{}'.format(model_type)
             pose_module = __import__(module_name)
-            tf.reset_default_graph()
+            if reset_graph:
+                tf.reset_default_graph()
             self = getattr(pose_module, module_name)(conf,name=name)
             pred_fn, close_fn, model_file = self.get_pred_fn(model_file)
         except ImportError:
@@ -1450,6 +1600,354 @@ def get_pred_fn(model_type, conf, model_file=None,name='deepnet',distort=False,*
     return pred_fn, close_fn, model_file
 
 
+def is_torch_net(model_type):
+    ''' True for the networks implemented in pytorch. Doesn't import tensorflow for them.'''
+    if model_type in ['mdn', 'unet', 'leap', 'deeplabcut', 'dpk', 'sb']:
+        return False
+    module_name = 'Pose_{}'.format(model_type)
+    try:
+        pose_module = __import__(module_name)
+    except ImportError:
+        return False
+    torch_common = sys.modules.get('PoseCommon_pytorch', None)
+    return torch_common is not None and issubclass(getattr(pose_module, module_name), torch_common.PoseCommon_pytorch)
+
+
+class TrackGraph(object):
+    ''' A tf graph of its own for a prediction function, so that several networks can be loaded and
+    used at the same time (eg one per view from different threads). The keras networks also get their
+    own session, as keras otherwise uses one global session. The prediction function has to be created
+    with reset_graph=False within context(), and used and closed through wrap() and close().
+    Nothing is done for pytorch networks.
+    '''
+    KERAS_NETS = ['leap', 'dpk', 'openpose', 'multi_openpose', 'sb']
+
+    def __init__(self, model_type):
+        self.graph = None
+        self.sess = None
+        if is_torch_net(model_type):
+            return
+        self.graph = tf.Graph()
+        if model_type in self.KERAS_NETS:
+            config = tf.ConfigProto()
+            config.gpu_options.allow_growth = True
+            self.sess = tf.Session(graph=self.graph, config=config)
+
+    @contextlib.contextmanager
+    def context(self):
+        # the default graph and session are per thread, so this is needed in every thread that uses the network
+        if self.graph is None:
+            yield
+            return
+        with self.graph.as_default():
+            if self.sess is None:
+                yield
+            else:
+                with self.sess.as_default():
+                    yield
+
+    def wrap(self, fn):
+        def wrapped_fn(*args, **kwargs):
+            with self.context():
+                return fn(*args, **kwargs)
+        return wrapped_fn
+
+    def close(self, close_fn):
+        # close_fn of the keras networks clears the global keras session. Close their own session instead.
+        if self.sess is None:
+            with self.context():
+                close_fn()
+        else:
+            self.sess.close()
+
+
+def get_track_device():
+    ''' Returns the name, total memory (in MB) and gpu id of the device used for tracking.
+    Only the first visible GPU is considered. gpu id is None when tracking on the CPU.'''
+    vis = os.environ.get('CUDA_VISIBLE_DEVICES', None)
+    if vis is None or vis.strip() not in ['', '-1']:
+        gpu_id = '0' if vis is None else vis.split(',')[0].strip()
+        try:
+            out = subprocess.check_output(['nvidia-smi', '--query-gpu=name,memory.total',
+                                           '--format=csv,noheader,nounits', '-i', gpu_id])
+            gpu_name, mem_total = [o.strip() for o in out.decode().strip().split(',')]
+            return 'gpu:{}'.format(gpu_name), float(mem_total), gpu_id
+        except (OSError, subprocess.CalledProcessError, ValueError):
+            pass
+    mem_total = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024. / 1024.
+    return 'cpu:{}'.format(platform.machine()), mem_total, None
+
+
+def torch_gpu_in_use():
+    # without importing torch if the network doesn't use it
+    torch = sys.modules.get('torch', None)
+    return torch is not None and torch.cuda.is_available() and torch.cuda.is_initialized()
+
+
+def reset_track_mem_stats():
+    ''' Resets the peak memory stats of the framework allocator, where that is possible.'''
+    if torch_gpu_in_use():
+        torch = sys.modules['torch']
+        if hasattr(torch.cuda, 'reset_peak_memory_stats'):
+            torch.cuda.reset_peak_memory_stats()
+        else:
+            torch.cuda.reset_max_memory_allocated()
+
+
+def get_track_mem_used(gpu_id):
+    ''' Peak memory used (in MB) by this process on the tracking device. For the CPU this is the peak resident memory.
+    For the GPU these are the allocator stats of torch or tensorflow, whichever is using the GPU. These don't include
+    the CUDA context. TF can't reset its peak, but autotune probes increasing batch sizes so the peak is the latest.'''
+    if gpu_id is None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    if torch_gpu_in_use():
+        return sys.modules['torch'].cuda.max_memory_allocated() / 1024. / 1024.
+    tf_module = sys.modules.get('tensorflow', None)
+    if tf_module is None:
+        return 0.
+    if hasattr(tf_module, 'contrib'):
+        # the allocator is shared by all the sessions of the process, so a separate graph and session report its stats
+        with tf_module.Graph().as_default():
+            with tf_module.device('/gpu:0'):
+                peak_op = tf_module.contrib.memory_stats.MaxBytesInUse()
+            config = tf_module.ConfigProto()
+            config.gpu_options.allow_growth = True
+            with tf_module.Session(config=config) as sess:
+                peak = sess.run(peak_op)
+    else:
+        peak = tf_module.config.experimental.get_memory_info('GPU:0')['peak']
+    return peak / 1024. / 1024.
+
+
+def track_oom_errors():
+    # errors raised when a batch size doesn't fit. tf is only referred to if it has been imported by the network
+    errs = (RuntimeError, MemoryError)
+    if 'tensorflow' in sys.modules:
+        errs = errs + (tf.errors.ResourceExhaustedError,)
+    return errs
+
+
+def get_track_model_files(model_type, conf, model_file=None, name='deepnet'):
+    ''' Files of the model that is used for tracking, without creating the network.
+    Returns [] if these can't be found for the network type.'''
+    if model_file is not None:
+        # tf checkpoints are saved as model_file.index, model_file.data-* etc
+        return glob.glob(model_file + '*')
+    if model_type in ['mdn', 'unet', 'leap', 'openpose', 'sb', 'deeplabcut']:
+        try:
+            return get_latest_model_files(conf, net_type=model_type, name=name) or []
+        except (AssertionError, AttributeError):
+            return []
+    try:
+        module_name = 'Pose_{}'.format(model_type)
+        pose_module = __import__(module_name)
+    except ImportError:
+        return []
+    self = getattr(pose_module, module_name)(conf, name=name)
+    latest_model_file = self.get_latest_model_file() if hasattr(self, 'get_latest_model_file') else None
+    return [] if latest_model_file is None else glob.glob(latest_model_file + '*')
+
+
+def track_autotune_key(model_type, model_files, device, conf):
+    mtime = max([os.path.getmtime(f) for f in model_files]) if len(model_files) > 0 else 0
+    model_id = os.path.commonprefix(sorted(model_files)) if len(model_files) > 0 else None
+    return '{}|{}|{}|{}|{}x{}x{}'.format(model_type, model_id, int(mtime), device,
+                                         conf.imsz[0], conf.imsz[1], conf.img_dim)
+
+
+def get_track_pred_fn(model_type, conf, model_file=None, name='deepnet', **kwargs):
+    ''' Prediction function for tracking. The batch size used for tracking is
+    conf.track_batch_size if specified, or the autotuned batch size if conf.track_autotune is set,
+    or else the batch size used for training. conf.batch_size is updated to the chosen batch size.
+    '''
+    if conf.get('track_batch_size', None) is not None:
+        conf.batch_size = int(conf.track_batch_size)
+    elif conf.get('track_autotune', False):
+        return autotune_track_pred_fn(model_type, conf, model_file, name=name, **kwargs)
+    return get_pred_fn(model_type, conf, model_file, name=name, **kwargs)
+
+
+def autotune_track_pred_fn(model_type, conf, model_file=None, name='deepnet', **kwargs):
+    ''' Probes increasing batch sizes on random input with the actual prediction function
+    and returns the prediction function for the batch size with the highest throughput (frames/s)
+    that fits within conf.track_autotune_mem_frac of the device memory.
+    Results are cached in the cachedir per model file, device and image size.
+    '''
+    device, mem_total, gpu_id = get_track_device()
+    max_bsize = conf.get('track_autotune_max_bsize', 64)
+    mem_budget = conf.get('track_autotune_mem_frac', 0.9) * mem_total
+    n_reps = conf.get('track_autotune_reps', 5)
+    cache_file = os.path.join(conf.cachedir, 'track_autotune.json')
+
+    cache = {}
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'r') as f:
+                cache = json.load(f)
+        except ValueError:
+            logging.warning('Could not read autotune cache {}. Ignoring it'.format(cache_file))
+
+    key = track_autotune_key(model_type, get_track_model_files(model_type, conf, model_file, name), device, conf)
+    if key in cache:
+        bsize = cache[key]['batch_size']
+        logging.info('Autotune: Using cached tracking batch size {} for {}'.format(bsize, key))
+        conf.batch_size = bsize
+        return get_pred_fn(model_type, conf, model_file, name=name, **kwargs)
+
+    train_bsize = conf.batch_size
+    probes = []
+    bsize = 1
+    while bsize <= max_bsize:
+        conf.batch_size = bsize
+        reset_track_mem_stats()
+        # each probe in a graph of its own, so that the probes don't add to the caller's graph
+        probe_graph = TrackGraph(model_type)
+        probe_kwargs = dict(kwargs, reset_graph=False)
+        try:
+            with probe_graph.context():
+                pred_fn, close_fn, _ = get_pred_fn(model_type, conf, model_file, name=name, **probe_kwargs)
+        except track_oom_errors() as e:
+            logging.info('Autotune: Could not create prediction function with batch size {} ({})'.format(bsize, e))
+            probe_graph.close(lambda: None)
+            break
+        pred_fn = probe_graph.wrap(pred_fn)
+        try:
+            ims = np.random.randint(0, 255, (bsize,) + tuple(conf.imsz) + (conf.img_dim,)).astype('float')
+            pred_fn(ims)  # warm up
+            start = time.time()
+            for _ in range(n_reps):
+                pred_fn(ims)
+            fps = n_reps * bsize / (time.time() - start)
+            mem_used = get_track_mem_used(gpu_id)
+        except track_oom_errors() as e:
+            logging.info('Autotune: Prediction failed with batch size {} ({})'.format(bsize, e))
+            probe_graph.close(close_fn)
+            break
+        probe_graph.close(close_fn)
+        logging.info('Autotune: batch size {} - {:.1f} frames/s, {:.0f}MB of {:.0f}MB used'.format(bsize, fps, mem_used, mem_total))
+        if mem_used > mem_budget:
+            break
+        probes.append([bsize, fps, mem_used])
+        # stop once throughput has stopped improving over the last two sizes
+        if len(probes) > 2 and fps < 1.05 * probes[-3][1]:
+            break
+        bsize *= 2
+
+    if len(probes) == 0:
+        logging.warning('Autotune: No batch size could be probed. Using the training batch size {}'.format(train_bsize))
+        conf.batch_size = train_bsize
+        return get_pred_fn(model_type, conf, model_file, name=name, **kwargs)
+
+    best = max(probes, key=lambda p: p[1])
+    logging.info('Autotune: Using tracking batch size {} ({:.1f} frames/s)'.format(best[0], best[1]))
+    cache[key] = {'batch_size': best[0], 'fps': best[1], 'probes': probes,
+                  'date': datetime.datetime.now().strftime('%Y%m%dT%H%M%S')}
+    try:
+        with open(cache_file, 'w') as f:
+            json.dump(cache, f, indent=2)
+    except IOError:
+        logging.warning('Could not save autotune results to {}'.format(cache_file))
+
+    conf.batch_size = best[0]
+    return get_pred_fn(model_type, conf, model_file, name=name, **kwargs)
+
+
+def plan_list(in_list, n_movies):
+    ''' Groups the rows of in_list ([mov, frame, trx], 0-indexed) by movie, with each movie's rows sorted
+    by frame so that the movie is read sequentially.
+    Returns a list with the indices into in_list of the rows for each movie.
+    '''
+    in_list = np.array(in_list, dtype='int64').reshape([-1, 3])
+    order = np.lexsort((in_list[:, 2], in_list[:, 1], in_list[:, 0]))
+    splits = np.searchsorted(in_list[order, 0], np.arange(n_movies + 1))
+    return [order[splits[ndx]:splits[ndx + 1]] for ndx in range(n_movies)]
+
+
+def movie_list_batches(conf, mov_file, trx_file, crop_loc, in_list, cur_idx):
+    ''' Generates (list indices, batch ims) for the rows cur_idx of in_list that are all from mov_file. '''
+    bsize = conf.batch_size
+    try:
+        cap = movies.Movie(mov_file)
+    except ValueError:
+        logging.exception('MOVIE_READ: ' + mov_file + ' is missing')
+        raise
+    trx, _, _, _ = get_trx_info(trx_file, conf, 0)
+    trx_arr = trx_transforms.unpack_trx(trx) if conf.has_trx_file else None
+    for b_start in range(0, len(cur_idx), bsize):
+        b_idx = cur_idx[b_start:(b_start + bsize)]
+        to_do_list = in_list[b_idx, 1:].tolist()
+        yield b_idx, create_batch_ims(to_do_list, conf, cap, conf.flipud, trx, crop_loc, trx_arr=trx_arr)
+    cap.close()
+
+
+def list_reader(conf, in_list, plan, local_dirs, trx_files, crop_locs, mov_queue, out_queue):
+    ''' Reader process for list_batches. Reads movies from mov_queue till it gets None. '''
+    try:
+        while True:
+            mov_ndx = mov_queue.get()
+            if mov_ndx is None:
+                break
+            for b_idx, all_f in movie_list_batches(conf, local_dirs[mov_ndx], trx_files[mov_ndx], crop_locs[mov_ndx],
+                                                   in_list, plan[mov_ndx]):
+                out_queue.put((mov_ndx, b_idx, all_f))
+        out_queue.put(None)
+    except Exception:
+        out_queue.put(('error', traceback.format_exc()))
+
+
+def list_batches(conf, in_list, plan, local_dirs, trx_files, crop_locs):
+    ''' Generates (movie index, list indices, batch ims) for all the rows in the plan.
+    With conf.track_list_readers > 0, movies are opened and read on that many reader processes
+    while the caller runs prediction, else they are read in this process one movie at a time.
+    '''
+    n_readers = conf.get('track_list_readers', 0)
+    mov_ndxs = [ndx for ndx in range(len(plan)) if len(plan[ndx]) > 0]
+
+    if n_readers < 1:
+        for mov_ndx in mov_ndxs:
+            for b_idx, all_f in movie_list_batches(conf, local_dirs[mov_ndx], trx_files[mov_ndx], crop_locs[mov_ndx],
+                                                   in_list, plan[mov_ndx]):
+                yield mov_ndx, b_idx, all_f
+        return
+
+    import multiprocessing
+    # spawn so that the readers don't inherit the state of the loaded network
+    ctx = multiprocessing.get_context('spawn')
+    n_readers = min(n_readers, len(mov_ndxs))
+    mov_queue = ctx.Queue()
+    out_queue = ctx.Queue(maxsize=2 * n_readers)
+    for mov_ndx in mov_ndxs:
+        mov_queue.put(mov_ndx)
+    for _ in range(n_readers):
+        mov_queue.put(None)
+    readers = [ctx.Process(target=list_reader, args=(conf, in_list, plan, local_dirs, trx_files, crop_locs, mov_queue, out_queue), daemon=True)
+               for _ in range(n_readers)]
+    for r in readers:
+        r.start()
+    n_finished = 0
+    try:
+        while n_finished < n_readers:
+            try:
+                out = out_queue.get(timeout=LIST_READER_POLL_SEC)
+            except queue.Empty:
+                # readers that die (eg segfault or OOM kill) don't report an error
+                dead = [r for r in readers if r.exitcode not in (None, 0)]
+                if len(dead) > 0:
+                    raise RuntimeError('Movie reader process died with exit code {}'.format(dead[0].exitcode))
+                continue
+            if out is None:
+                n_finished += 1
+            elif out[0] == 'error':
+                raise RuntimeError('Error while reading movies:\n{}'.format(out[1]))
+            else:
+                yield out
+    finally:
+        for r in readers:
+            if r.is_alive():
+                r.terminate()
+            r.join()
+
+
 def classify_list_all(model_type, conf, in_list, on_gt, model_file,
                       movie_files=None, trx_files=None, crop_locs=None,
                       part_file=None,  # If specified, save intermediate "part" files
@@ -1483,35 +1981,29 @@ def classify_list_all(model_type, conf, in_list, on_gt, model_file,
         if is_external_crop:
             assert len(crop_locs) == len(local_dirs), \
                 "Number of crop_locs ({}) does not match number of movies ({})".format(len(crop_locs), len(local_dirs))
-    elif on_gt:
-        local_dirs, _ = multiResData.find_gt_dirs(conf)
-        # crops fetched from lbl below
     else:
-        local_dirs, _ = multiResData.find_local_dirs(conf)
-        # crops fetched from lbl below
-
-    lbl = h5py.File(conf.labelfile, 'r')
-    view = conf.view
+        # movies, trx and crops fetched from lbl
+        proj_info = get_project_info(conf, on_gt)
+        local_dirs = proj_info['movies']
 
     if conf.has_trx_file:
         if is_external_movies:
             pass  # trx_files provided
         else:
-            trx_files = multiResData.get_trx_files(lbl, local_dirs, on_gt)
+            trx_files = proj_info['trx_files']
     else:
         trx_files = [None, ] * len(local_dirs)
 
     assert len(trx_files) == len(local_dirs), \
         "Number of trx_files ({}) does not match number of movies ({})".format(len(trx_files), len(local_dirs))
 
-    pred_fn, close_fn, model_file = get_pred_fn(model_type, conf, model_file)
+    if is_external_movies:
+        crop_locs = crop_locs if is_external_crop else [None, ] * len(local_dirs)
+    else:
+        # This is None if proj/lbl doesnt have crops
+        crop_locs = proj_info['crop_locs']
 
-    # pred_locs = np.zeros([len(in_list), conf.n_classes, 2])
-    # pred_locs[:] = np.nan
-    # pred_conf = np.zeros([len(in_list), conf.n_classes])
-    # pred_conf[:] = np.nan
-    # pred_crop_locs = np.zeros([len(in_list), 4])
-    # pred_crop_locs[:] = np.nan
+    pred_fn, close_fn, model_file = get_track_pred_fn(model_type, conf, model_file)
 
     nlist = len(in_list)
     ret_dict_all = {}
@@ -1519,55 +2011,51 @@ def classify_list_all(model_type, conf, in_list, on_gt, model_file,
     ret_dict_all['crop_locs'][:] = np.nan
 
     logging.info('Tracking {} rows...'.format(nlist))
+    frame_desc = 'GT labeled frames' if on_gt else 'listed frames'
+    list_arr = np.array(in_list, dtype='int64').reshape([-1, 3])
+    plan = plan_list(list_arr, len(local_dirs))
+    trx_arrs = {}
     n_done = 0
     start_time = time.time()
-    for ndx, dir_name in enumerate(local_dirs):
-
-        cur_list = [[l[1], l[2]] for l in in_list if l[0] == ndx]
-        cur_idx = [i for i, l in enumerate(in_list) if l[0] == ndx]
-        if is_external_movies:
-            if is_external_crop:
-                crop_loc = crop_locs[ndx]
-            else:
-                crop_loc = None
-        else:
-            # This returns None if proj/lbl doesnt have crops
-            crop_loc = PoseTools.get_crop_loc(lbl, ndx, view, on_gt)
-
-        try:
-            cap = movies.Movie(dir_name)
-        except ValueError:
-            logging.exception('MOVIE_READ: ' + local_dirs[ndx] + ' is missing')
-            exit(1)
-
-        trx, _, _, _ = get_trx_info(trx_files[ndx], conf, 0)
-        ret_dict = classify_list(conf, pred_fn, cap, cur_list, trx, crop_loc, n_done=n_done, part_file=part_file)
+    for mov_ndx, cur_idx, all_f in list_batches(conf, list_arr, plan, local_dirs, trx_files, crop_locs):
+        n_cur = len(cur_idx)
+        ret_dict = pred_fn(all_f)
+        crop_loc = crop_locs[mov_ndx]
+        if conf.has_trx_file and mov_ndx not in trx_arrs:
+            trx_arrs[mov_ndx] = trx_transforms.unpack_trx(trx_table.load_trx(trx_files[mov_ndx]))
+        trx_arr = trx_arrs.get(mov_ndx, None)
+        cur_list = list_arr[cur_idx]
 
-        n_cur_list = len(cur_list)  # len of cur_idx; num of rows being processed for curr mov
         for k in ret_dict.keys():
             retval = ret_dict[k]
+            if retval.ndim == 4:  # hmaps
+                continue
+            elif retval.ndim != 3 and retval.ndim != 2:
+                logging.info("Ignoring return value '{}' with shape {}".format(k, retval.shape))
+                continue
             if k not in ret_dict_all.keys():
-                szval = retval.shape
-                assert szval[0] == n_cur_list
-                ret_dict_all[k] = np.zeros((nlist, ) + szval[1:])
+                ret_dict_all[k] = np.zeros((nlist, ) + retval.shape[1:])
                 ret_dict_all[k][:] = np.nan
+            cur_orig = retval[:n_cur, ...]
+            if k.startswith('locs'):  # transform locs
+                assert retval.ndim == 3
+                cur_orig = trx_transforms.convert_to_orig_batch(cur_orig, conf, cur_list[:, 1], cur_list[:, 2], trx_arr, crop_loc)
+            ret_dict_all[k][cur_idx, ...] = cur_orig
 
-            ret_dict_all[k][cur_idx, ...] = retval
-
-        # pred_locs[cur_idx, ...] = ret_dict['pred_locs']
-        # pred_conf[cur_idx, ...] = ret_dict['pred_conf']
         if crop_loc is not None:
             ret_dict_all['crop_locs'][cur_idx, ...] = crop_loc
 
-        cap.close()  # close the movie handles
-
-        n_done = len([1 for i in in_list if i[0]<=ndx])
-        logging.info('Done prediction on {} out of {} GT labeled frames'.format(n_done,len(in_list)))
-        if part_file is not None:
-            write_n_tracked_part_file(n_done,part_file)
+        n_done += n_cur
+        if time.time() - start_time >= N_TRACKED_WRITE_INTERVAL_SEC:
+            start_time = time.time()
+            logging.info('Done prediction on {} out of {} {}'.format(n_done, nlist, frame_desc))
+            if part_file is not None:
+                write_n_tracked_part_file(n_done, part_file)
 
+    logging.info('Done prediction on {} out of {} {}'.format(n_done, nlist, frame_desc))
+    if part_file is not None:
+        write_n_tracked_part_file(n_done, part_file)
     logging.info('Done prediction on all frames')
-    lbl.close()
     close_fn()
     return ret_dict_all
 
@@ -2154,6 +2642,38 @@ def write_trk(out_file, pred_locs_in, extra_dict, start, end, trx_ids, conf, inf
             tmp = to_mat(tmp)
         out_dict['pTrk' + k] = tmp
 
+    save_trk_dict(out_file, out_dict)
+
+
+def write_trk_tracklets(out_file, trajectories, start, end, conf, info, mov_file):
+    '''
+    Same as write_trk for the trajectories of link_trajectories.OnlineLinker.
+    Each trajectory is saved separately instead of in a dense n_frames x n_trajectories array:
+    pTrk{i} is n_body_parts x 2 x n_frames for trajectory i, which is tracked from
+    startframes(i) to endframes(i). pTrkTag is True in stitched gaps.
+    everything should be 0-indexed
+    '''
+    n_tr = len(trajectories)
+    cur_ts = datetime2matlabdn()
+    pred_locs = [to_mat(tr['p'].transpose([1, 0, 2])) for tr in trajectories]
+    ts = [np.ones(tr['p'].shape[1:]) * cur_ts for tr in trajectories]
+    tag = [np.tile(tr['isdummy'][np.newaxis, :], [conf.n_classes, 1]) for tr in trajectories]
+    tracked = np.zeros([1, end - start])
+    tracked[0, :] = to_mat(np.arange(start, end))
+
+    out_dict = {'pTrk': pred_locs,
+                'pTrkTS': ts,
+                'expname': mov_file,
+                'pTrkiTgt': to_mat(np.arange(n_tr)),
+                'pTrkTag': tag,
+                'pTrkFrm': tracked,
+                'startframes': to_mat(np.array([tr['t0'] for tr in trajectories], dtype=int)),
+                'endframes': to_mat(np.array([tr['t1'] for tr in trajectories], dtype=int)),
+                'trkInfo': info}
+    save_trk_dict(out_file, out_dict)
+
+
+def save_trk_dict(out_file, out_dict):
     # output to a temporary file and then rename to real file name.
     # this is because existence of trk file is a flag that tracking is done for
     # other processes, and writing may still be in progress when file discovered.
@@ -2164,6 +2684,59 @@ def write_trk(out_file, pred_locs_in, extra_dict, start, end, trx_ids, conf, inf
     else:
         logging.exception("Did not successfully write output to %s"%out_file_tmp)
 
+
+class PredictionReuse(object):
+    ''' Change-gated reuse of predictions while tracking (conf.track_reuse_thresh). The last prediction for a target
+    is reused if the target's network input differs from the input it was predicted on by less than thresh (mean
+    absolute difference in pixel values), as long as it was predicted at most max_gap frames earlier.
+    Only the inputs that are not reused are given to the prediction function.
+    '''
+
+    def __init__(self, thresh, max_gap):
+        self.thresh = thresh
+        self.max_gap = max_gap
+        self.ref_ims = {}  # target -> input that the last prediction was made on
+        self.ref_fr = {}
+        self.ref_out = {}  # target -> last prediction
+        self.n_reused = 0
+
+    def predict(self, pred_fn, all_f, fnums, trx_ndx):
+        ''' Same as pred_fn(all_f) for the first len(fnums) examples, and the gap (frames since the prediction) for each example.'''
+        n = len(fnums)
+        gaps = np.zeros(n, dtype=int)
+        do_pred = np.ones(n, dtype=bool)
+        for ndx in range(n):
+            t = trx_ndx[ndx]
+            if t in self.ref_fr and 0 < fnums[ndx] - self.ref_fr[t] <= self.max_gap and \
+                    np.mean(np.abs(all_f[ndx] - self.ref_ims[t])) < self.thresh:
+                gaps[ndx] = fnums[ndx] - self.ref_fr[t]
+                do_pred[ndx] = False
+            else:
+                self.ref_ims[t] = all_f[ndx].copy()
+                self.ref_fr[t] = fnums[ndx]
+        sel = np.flatnonzero(do_pred)
+        self.n_reused += n - len(sel)
+
+        pred_dict = {}
+        if len(sel) > 0:
+            sel_f = np.zeros_like(all_f)
+            sel_f[:len(sel), ...] = all_f[sel, ...]
+            pred_dict = pred_fn(sel_f)
+
+        ret_dict = {}
+        pred_ndx = 0
+        for ndx in range(n):
+            t = trx_ndx[ndx]
+            if do_pred[ndx]:
+                self.ref_out[t] = {k: np.array(v[pred_ndx]) for k, v in pred_dict.items()}
+                pred_ndx += 1
+            for k, v in self.ref_out[t].items():
+                if k not in ret_dict:
+                    ret_dict[k] = np.zeros((n,) + v.shape, dtype=v.dtype)
+                ret_dict[k][ndx, ...] = v
+        return ret_dict, gaps
+
+
 def classify_movie(conf, pred_fn, model_type,
                    mov_file='',
                    out_file='',
@@ -2176,8 +2749,13 @@ def classify_movie(conf, pred_fn, model_type,
                    name='',
                    nskip_partfile=400,
                    save_hmaps=False,
-                   crop_loc=None):
-    ''' Classifies frames in a movie. All animals in a frame are classified before moving to the next frame.'''
+                   crop_loc=None,
+                   progress_fn=None,
+                   reset_graph=True):
+    ''' Classifies frames in a movie. All animals in a frame are classified before moving to the next frame.
+    If given, progress_fn(n_done, n_total, next_frame) is called after every batch, where next_frame is one
+    after the last frame in the batch.
+    Set reset_graph to False if pred_fn will be used again (eg by a tracking worker).'''
 
     logging.info('classify_movie:')
     logging.info('mov_file: %s'%mov_file)
@@ -2191,13 +2769,20 @@ def classify_movie(conf, pred_fn, model_type,
     logging.info('name: %s'%name)
     logging.info('save_hmaps: '+str(save_hmaps))
     logging.info('crop_loc: '+str(crop_loc))
+
+    if is_detect_crop(conf):
+        raise ValueError('Movies for two-stage tracking (detect_crop_sz) should be tracked with classify_movie_two_stage')
+    if model_type.startswith('multi_'):
+        return classify_movie_multi(conf, pred_fn, mov_file=mov_file, out_file=out_file, start_frame=start_frame,
+                                    end_frame=end_frame, model_file=model_file, name=name,
+                                    nskip_partfile=nskip_partfile, crop_loc=crop_loc, progress_fn=progress_fn,
+                                    reset_graph=reset_graph)
     
-    cap = movies.Movie(mov_file)
+    cap = movies.Movie(mov_file, decode_workers=conf.get('movie_decode_workers', 0))
     sz = (cap.get_height(), cap.get_width())
     n_frames = int(cap.get_n_frames())
     T, first_frames, end_frames, n_trx = get_trx_info(trx_file, conf, n_frames)
     trx_ids = get_trx_ids(trx_ids, n_trx, conf.has_trx_file)
-    conf.batch_size = 1 if model_type == 'deeplabcut' else conf.batch_size
     bsize = conf.batch_size
     flipud = conf.flipud
 
@@ -2214,9 +2799,14 @@ def classify_movie(conf, pred_fn, model_type,
 
     extra_dict = {}
 
-    hmap_out_dir = os.path.splitext(out_file)[0] + '_hmap'
-    if not os.path.exists(hmap_out_dir):
-        os.mkdir(hmap_out_dir)
+    if save_hmaps:
+        hmap_file = os.path.splitext(out_file)[0] + '_hmap.h5'
+        hmap_writer = hmap_sink.HmapWriter(hmap_file, start_frame, max_n_frames, n_trx,
+                                           quantize=conf.get('hmap_quantize', False),
+                                           peak_window=conf.get('hmap_peak_window', 0),
+                                           decimate=conf.get('hmap_decimate', 1),
+                                           compression_level=conf.get('hmap_compression_level', 4))
+        logging.info('Saving heatmaps to {}'.format(hmap_file))
 
     to_do_list = []
     for cur_f in range(start_frame, end_frame):
@@ -2231,79 +2821,156 @@ def classify_movie(conf, pred_fn, model_type,
 
     n_list = len(to_do_list)
     n_batches = int(math.ceil(float(n_list) / bsize))
+    trx_arr = trx_transforms.unpack_trx(T) if conf.has_trx_file else None
+    reuse = None
+    if conf.get('track_reuse_thresh', None) is not None:
+        reuse = PredictionReuse(conf.track_reuse_thresh, conf.get('track_reuse_max_gap', 10))
+        # frames since the prediction that was used was made. 0 => predicted on the frame
+        extra_dict['reuse_gap'] = np.zeros([max_n_frames, n_trx, 1])
     for cur_b in range(n_batches):
         cur_start = cur_b * bsize
         ppe = min(n_list - cur_start, bsize)
-        all_f = create_batch_ims(to_do_list[cur_start:(cur_start + ppe)], conf, cap, flipud, T, crop_loc)
+        all_f = create_batch_ims(to_do_list[cur_start:(cur_start + ppe)], conf, cap, flipud, T, crop_loc, trx_arr=trx_arr)
 
+        cur_list = np.array(to_do_list[cur_start:(cur_start + ppe)])
+        cur_fs = cur_list[:, 0] - min_first_frame
+        trx_ndx = cur_list[:, 1]
 
-        ret_dict = pred_fn(all_f)
+        if reuse is None:
+            ret_dict = pred_fn(all_f)
+        else:
+            ret_dict, gaps = reuse.predict(pred_fn, all_f, cur_list[:, 0], trx_ndx)
+            extra_dict['reuse_gap'][cur_fs, trx_ndx, 0] = gaps
         base_locs = ret_dict.pop('locs')
-        #hmaps = ret_dict.pop('hmaps')
-
-        assert not save_hmaps
-        #if save_hmaps:
-            #mat_out = os.path.join(hmap_out_dir, 'hmap_batch_{}.mat'.format(cur_b+1))
-            #hdf5storage.savemat(mat_out,{'hm':hmaps,'startframe1b':to_do_list[cur_start][0]+1})
-
-        for cur_t in range(ppe):
-            cur_entry = to_do_list[cur_t + cur_start]
-            trx_ndx = cur_entry[1]
-            cur_trx = T[trx_ndx]
-            cur_f = cur_entry[0]
-            base_locs_orig = convert_to_orig(base_locs[cur_t, ...], conf, cur_f, cur_trx, crop_loc)
-            pred_locs[cur_f - min_first_frame, trx_ndx, :, :] = base_locs_orig[ ...]
-
-            #if save_hmaps:
-            #    write_hmaps(hmaps[cur_t, ...], hmap_out_dir, trx_ndx, cur_f)
-
-            # for everything else that is returned..
-            for k in ret_dict.keys():
-
-                if ret_dict[k].ndim == 4:  # hmaps
-                    #if save_hmaps:
-                    #    cur_hmap = ret_dict[k]
-                    #    write_hmaps(cur_hmap[cur_t, ...], hmap_out_dir, trx_ndx, cur_f, k[5:])
-                    pass
+        base_locs_orig = trx_transforms.convert_to_orig_batch(base_locs[:ppe, ...], conf, cur_list[:, 0], trx_ndx, trx_arr, crop_loc)
+        pred_locs[cur_fs, trx_ndx, :, :] = base_locs_orig
+
+        # for everything else that is returned..
+        for k in ret_dict.keys():
+
+            if ret_dict[k].ndim == 4:  # hmaps
+                if save_hmaps:
+                    # hmaps are stored as predicted, ie in the coordinates of the network input
+                    hmap_writer.write(k, ret_dict[k][:ppe, ...], cur_list[:, 0], trx_ndx)
+            else:
+                cur_v = ret_dict[k]
+                # py3 and py2 compatible
+                if k not in extra_dict:
+                    sz = cur_v.shape[1:]
+                    extra_dict[k] = np.zeros((max_n_frames, n_trx) + sz)
+
+                if k.startswith('locs'):  # transform locs
+                    cur_orig = trx_transforms.convert_to_orig_batch(cur_v[:ppe, ...], conf, cur_list[:, 0], trx_ndx, trx_arr, crop_loc)
                 else:
-                    cur_v = ret_dict[k]
-                    # py3 and py2 compatible
-                    if k not in extra_dict:
-                        sz = cur_v.shape[1:]
-                        extra_dict[k] = np.zeros((max_n_frames, n_trx) + sz)
-
-                    if k.startswith('locs'):  # transform locs
-                        cur_orig = convert_to_orig(cur_v[cur_t, ...], conf, cur_f, cur_trx, crop_loc)
-                    else:
-                        cur_orig = cur_v[cur_t, ...]
+                    cur_orig = cur_v[:ppe, ...]
 
-                    extra_dict[k][cur_f - min_first_frame, trx_ndx, ...] = cur_orig
+                extra_dict[k][cur_fs, trx_ndx, ...] = cur_orig
 
         if cur_b % 20 == 19:
             sys.stdout.write('.')
         if cur_b % nskip_partfile == nskip_partfile - 1:
             sys.stdout.write('\n')
             write_trk(out_file + '.part', pred_locs, extra_dict, start_frame, to_do_list[cur_start][0], trx_ids, conf, info, mov_file)
-
+        if progress_fn is not None:
+            progress_fn(cur_start + ppe, n_list, cur_list[-1, 0] + 1)
+
+    if save_hmaps:
+        hmap_writer.close()
+    if reuse is not None:
+        logging.info('Reused predictions for {} of {} targets in frames'.format(reuse.n_reused, n_list))
+    trk_filter_type = conf.get('trk_filter', None)
+    if trk_filter_type:
+        # the unfiltered locs are saved as pTrklocs_raw
+        extra_dict['locs_raw'] = pred_locs.copy()
+        pred_locs = filter_pred_locs(pred_locs, trk_filter_type, conf, pred_conf=extra_dict.get('conf', None))
     write_trk(out_file, pred_locs, extra_dict, start_frame, end_frame, trx_ids, conf, info, mov_file)
     if os.path.exists(out_file + '.part'):
         os.remove(out_file + '.part')
     cap.close()
-    tf.reset_default_graph()
+    if reset_graph:
+        tf.reset_default_graph()
     return pred_locs
 
 
-def get_unet_pred_fn(conf, model_file=None,name='deepnet'):
+def classify_movie_multi(conf, pred_fn,
+                         mov_file='',
+                         out_file='',
+                         start_frame=0,
+                         end_frame=-1,
+                         model_file='',
+                         name='',
+                         nskip_partfile=400,
+                         crop_loc=None,
+                         progress_fn=None,
+                         reset_graph=True):
+    ''' Classifies frames in a movie with a multi-animal network. The detections of each batch are linked into
+    trajectories (link_trajectories.OnlineLinker) as the movie is tracked, so the detections of the whole movie are
+    never stored, and the trajectories are saved with write_trk_tracklets.
+    '''
+
+    cap = movies.Movie(mov_file, decode_workers=conf.get('movie_decode_workers', 0))
+    n_frames = int(cap.get_n_frames())
+    bsize = conf.batch_size
+    info = compile_trk_info(conf, model_file, crop_loc, expname=name)
+
+    if end_frame < 0 or end_frame > n_frames: end_frame = n_frames
+    if start_frame > end_frame:
+        cap.close()
+        return None
+
+    link_params = {'maxcost': conf.get('link_maxcost', None),
+                   'maxframes_missed': conf.get('link_maxframes_missed', 4),
+                   'maxframes_delete': conf.get('link_maxframes_delete', 10),
+                   'verbose': 0}
+    linker = link_trajectories.OnlineLinker(link_params, nframes_maxcost=conf.get('link_maxcost_nframes', 100))
+
+    to_do_list = [[cur_f, 0] for cur_f in range(start_frame, end_frame)]
+    n_list = len(to_do_list)
+    n_batches = int(math.ceil(float(n_list) / bsize))
+    for cur_b in range(n_batches):
+        cur_start = cur_b * bsize
+        ppe = min(n_list - cur_start, bsize)
+        cur_list = np.array(to_do_list[cur_start:(cur_start + ppe)])
+        all_f = create_batch_ims(to_do_list[cur_start:(cur_start + ppe)], conf, cap, conf.flipud, [None], crop_loc)
+
+        base_locs = pred_fn(all_f)['locs']
+        base_locs_orig = trx_transforms.convert_to_orig_batch(base_locs[:ppe, ...], conf, cur_list[:, 0], cur_list[:, 1], None, crop_loc)
+        for ndx in range(ppe):
+            # max_n x n_classes x 2 -> 2 x n_classes x max_n
+            linker.add_frame(cur_list[ndx, 0], base_locs_orig[ndx].transpose([2, 1, 0]))
+
+        if cur_b % 20 == 19:
+            sys.stdout.write('.')
+        if cur_b % nskip_partfile == nskip_partfile - 1:
+            sys.stdout.write('\n')
+            write_trk_tracklets(out_file + '.part', linker.trajectories(), start_frame, cur_list[-1, 0] + 1, conf, info, mov_file)
+        if progress_fn is not None:
+            progress_fn(cur_start + ppe, n_list, cur_list[-1, 0] + 1)
+
+    trajectories = linker.finish()
+    logging.info('Linked detections into {} trajectories'.format(len(trajectories)))
+    write_trk_tracklets(out_file, trajectories, start_frame, end_frame, conf, info, mov_file)
+    if os.path.exists(out_file + '.part'):
+        os.remove(out_file + '.part')
+    cap.close()
+    if reset_graph:
+        tf.reset_default_graph()
+    return trajectories
+
+
+def get_unet_pred_fn(conf, model_file=None,name='deepnet',reset_graph=True):
     ''' Prediction function for UNet network'''
-    tf.reset_default_graph()
+    if reset_graph:
+        tf.reset_default_graph()
     self = PoseUNet.PoseUNet(conf, name=name)
     if name == 'deepnet':
         self.train_data_name = 'traindata'
     return self.get_pred_fn(model_file)
 
 
-def get_mdn_pred_fn(conf, model_file=None,name='deepnet',distort=False,**kwargs):
-    tf.reset_default_graph()
+def get_mdn_pred_fn(conf, model_file=None,name='deepnet',distort=False,reset_graph=True,**kwargs):
+    if reset_graph:
+        tf.reset_default_graph()
     self = PoseURes.PoseUMDN_resnet(conf, name=name)
     if name == 'deepnet':
         self.train_data_name = 'traindata'
@@ -2313,6 +2980,34 @@ def get_mdn_pred_fn(conf, model_file=None,name='deepnet',distort=False,**kwargs)
     return self.get_pred_fn(model_file,distort=distort,**kwargs)
 
 
+def export_model(model_type, conf, model_file=None, out_file=None, name='deepnet', fmt='torchscript'):
+    ''' Exports a trained model as a self-contained inference model: a frozen graph for
+    tensorflow networks (mdn, unet) and TorchScript or ONNX for pytorch networks (multi_mdn_joint_torch).
+    Decoding of the outputs into locations is part of the exported model. The exported model is
+    specific to the batch size. Other networks (openpose, leap, dpk, deeplabcut etc) can't be exported.
+    Returns the exported file, which can be given as the model file for tracking.
+    '''
+    tf.reset_default_graph()
+    if model_type == 'mdn':
+        self = PoseURes.PoseUMDN_resnet(conf, name=name)
+        self.train_data_name = 'traindata' if name == 'deepnet' else None
+        return self.export_frozen(model_file, out_file)
+    elif model_type == 'unet':
+        self = PoseUNet.PoseUNet(conf, name=name)
+        if name == 'deepnet':
+            self.train_data_name = 'traindata'
+        return self.export_frozen(model_file, out_file)
+    elif model_type in ['leap', 'deeplabcut', 'dpk', 'sb']:
+        raise ValueError('Export is not supported for {}'.format(model_type))
+    else:
+        module_name = 'Pose_{}'.format(model_type)
+        pose_module = __import__(module_name)
+        self = getattr(pose_module, module_name)(conf, name=name)
+        if not hasattr(self, 'export'):
+            raise ValueError('Export is not supported for {}'.format(model_type))
+        return self.export(model_file, out_file, fmt=fmt)
+
+
 def get_latest_model_files(conf, net_type='mdn', name='deepnet'):
     if net_type == 'mdn':
         self = PoseURes.PoseUMDN_resnet(conf, name=name)
@@ -2338,20 +3033,469 @@ def get_latest_model_files(conf, net_type='mdn', name='deepnet'):
 
     return files
 
+def filter_pred_locs(pred_locs, filter_type, conf, pred_conf=None):
+    ''' Temporal filtering (see trk_filter) of pred_locs (n_frames x n_trx x n_classes x 2) as in classify_movie.
+    pred_conf is the confidence of the predictions (n_frames x n_trx x n_classes) if available.'''
+    p = pred_locs.transpose([2, 3, 0, 1])
+    if pred_conf is not None and pred_conf.shape == pred_locs.shape[:3]:
+        pred_conf = pred_conf.transpose([2, 0, 1])
+    else:
+        pred_conf = None
+    params = conf.get('trk_filter_params', {})
+    logging.info('Filtering tracking output with {} filter, params: {}'.format(filter_type, params))
+    out = trk_filter.filter_trk_array(p, filter_type, conf=pred_conf, **params)
+    return out.transpose([2, 3, 0, 1])
+
+
 def classify_movie_all(model_type, **kwargs):
     ''' Classify movie wrapper'''
     conf = kwargs['conf']
     model_file = kwargs['model_file']
     train_name = kwargs['train_name']
     del kwargs['model_file'], kwargs['conf'], kwargs['train_name']
-    pred_fn, close_fn, model_file = get_pred_fn(model_type, conf, model_file,name=train_name)
     logging.info('Saving hmaps') if kwargs['save_hmaps'] else logging.info('NOT saving hmaps')
+    if is_detect_crop(conf):
+        # the pose and the detector networks are used together, so each gets its own graph
+        pred_fn, close_fn, model_file = get_graph_pred_fn(model_type, conf, model_file, name=train_name)
+        try:
+            detect_conf, detect_pred_fn, detect_close_fn, detect_model_file = get_detect_pred_fn(model_type, conf)
+            try:
+                classify_movie_two_stage(conf, pred_fn, detect_conf, detect_pred_fn, model_file=model_file,
+                                         detect_model_file=detect_model_file, reset_graph=False,
+                                         **two_stage_kwargs(kwargs))
+            finally:
+                detect_close_fn()
+        finally:
+            close_fn()
+        return
+    pred_fn, close_fn, model_file = get_track_pred_fn(model_type, conf, model_file,name=train_name)
     try:
         classify_movie(conf, pred_fn, model_type, model_file=model_file, **kwargs)
-    except (IOError, ValueError) as e:
+    finally:
         close_fn()
-        logging.exception('Could not track movie')
-    close_fn()
+
+
+def get_graph_pred_fn(model_type, conf, model_file=None, name='deepnet'):
+    ''' get_track_pred_fn for a network in a TrackGraph of its own. The returned pred_fn and close_fn use that graph.'''
+    graph = TrackGraph(model_type)
+    with graph.context():
+        pred_fn, close_fn, model_file = get_track_pred_fn(model_type, conf, model_file, name=name, reset_graph=False)
+    return graph.wrap(pred_fn), lambda: graph.close(close_fn), model_file
+
+
+def is_detect_crop(conf):
+    ''' True if the pose network is trained and tracked on crops around the animals found by a detector network (two-stage tracking).'''
+    return conf.get('detect_crop_sz', None) is not None and not conf.has_trx_file
+
+
+def two_stage_kwargs(kwargs):
+    ''' kwargs of classify_movie without the ones that classify_movie_two_stage doesn't use.'''
+    return {k: v for k, v in kwargs.items() if k not in ['trx_file', 'trx_ids', 'skip_rate', 'save_hmaps']}
+
+
+def get_detect_pred_fn(model_type, conf):
+    ''' Conf, prediction function, close function and model file of the detector network for two-stage tracking
+    of conf. The detector is loaded in a TrackGraph of its own (see get_graph_pred_fn).'''
+    detect_conf = get_detect_conf(conf)
+    detect_type = conf.get('detect_net_type', None) or model_type
+    pred_fn, close_fn, model_file = get_graph_pred_fn(detect_type, detect_conf, conf.get('detect_model_file', None),
+                                                      name=conf.get('detect_train_name', 'detect'))
+    return detect_conf, pred_fn, close_fn, model_file
+
+
+def get_detect_conf(conf):
+    ''' Conf for the detector network in two-stage tracking. The detector is trained on whole frames,
+    e.g. with -train_name detect and a larger rescale.'''
+    detect_conf = copy.deepcopy(conf)
+    detect_conf.detect_crop_sz = None
+    detect_conf.imsz = tuple(conf.detect_imsz)
+    detect_conf.sel_sz = min(detect_conf.imsz)
+    if conf.get('detect_rescale', None) is not None:
+        detect_conf.rescale = conf.detect_rescale
+        detect_conf.unet_rescale = conf.detect_rescale
+        detect_conf.leap_rescale = conf.detect_rescale
+    return detect_conf
+
+
+def predict_in_batches(pred_fn, ims, bsize):
+    ''' locs predicted by pred_fn for ims, bsize at a time. The last batch is padded with zeros.'''
+    locs = []
+    for start in range(0, ims.shape[0], bsize):
+        cur_ims = ims[start:start + bsize]
+        n_cur = cur_ims.shape[0]
+        if n_cur < bsize:
+            cur_ims = np.concatenate([cur_ims, np.zeros((bsize - n_cur,) + cur_ims.shape[1:])], 0)
+        locs.append(pred_fn(cur_ims)['locs'][:n_cur])
+    return np.concatenate(locs, 0)
+
+
+def classify_movie_two_stage(conf, pred_fn, detect_conf, detect_pred_fn,
+                             mov_file='',
+                             out_file='',
+                             start_frame=0,
+                             end_frame=-1,
+                             model_file='',
+                             detect_model_file='',
+                             name='',
+                             nskip_partfile=400,
+                             crop_loc=None,
+                             progress_fn=None,
+                             reset_graph=True):
+    ''' Two-stage tracking for projects without trx. For each batch, the detector network (detect_conf, usually at
+    a low resolution) is run on the whole frames, and the pose network is run on crops of size conf.imsz around the
+    mean of the detected landmarks. The locations are mapped back the same way as for trx with trx_align_theta off.
+    The detector's predictions are saved as pTrklocs_detect.
+    Set reset_graph to False if the prediction functions will be used again, or are in graphs of their own.
+    '''
+    logging.info('classify_movie_two_stage: detector model {}'.format(detect_model_file))
+    cap = movies.Movie(mov_file, decode_workers=conf.get('movie_decode_workers', 0))
+    n_frames = int(cap.get_n_frames())
+    bsize = conf.batch_size
+    flipud = conf.flipud
+    info = compile_trk_info(conf, model_file, crop_loc, expname=name)
+    info[u'detect_model_file'] = detect_model_file
+    if crop_loc is not None and np.any(np.isnan(np.array(crop_loc))):
+        crop_loc = None
+
+    if end_frame < 0 or end_frame > n_frames: end_frame = n_frames
+    if start_frame > end_frame:
+        cap.close()
+        return None
+
+    max_n_frames = end_frame - start_frame
+    pred_locs = np.zeros([max_n_frames, 1, conf.n_classes, 2])
+    pred_locs[:] = np.nan
+    extra_dict = {'locs_detect': pred_locs.copy()}
+    trx_ids = np.array([0])
+
+    n_batches = int(math.ceil(float(max_n_frames) / bsize))
+    for cur_b in range(n_batches):
+        cur_start = start_frame + cur_b * bsize
+        fnums = np.arange(cur_start, min(cur_start + bsize, end_frame))
+        ppe = len(fnums)
+        frames = cap.get_frames(fnums)[0]
+        full_ims = np.zeros((ppe,) + tuple(detect_conf.imsz) + (conf.img_dim,))
+        for ndx in range(ppe):
+            full_ims[ndx, ...], _ = multiResData.get_patch(cap, fnums[ndx], detect_conf, np.zeros([conf.n_classes, 2]),
+                                                           flipud=flipud, crop_loc=crop_loc, frame=frames[ndx])
+
+        # stage 1: find the animal
+        detect_locs = predict_in_batches(detect_pred_fn, full_ims, detect_conf.batch_size)
+        centers = trx_transforms.detect_centers(detect_locs)
+        found = ~np.any(np.isnan(centers), axis=1)
+        centers[~found, 0] = detect_conf.imsz[1] / 2.
+        centers[~found, 1] = detect_conf.imsz[0] / 2.
+        zeros = np.zeros(ppe)
+
+        # stage 2: pose on the crops
+        A_crop = trx_transforms.crop_matrices(conf, centers[:, 0], centers[:, 1], zeros, align_theta=False)
+        all_f = np.zeros((bsize,) + tuple(conf.imsz) + (conf.img_dim,))
+        for ndx in range(ppe):
+            all_f[ndx, ...] = trx_transforms.crop_patch(conf, full_ims[ndx], A_crop[ndx])
+        ret_dict = pred_fn(all_f)
+        A_uncrop = trx_transforms.uncrop_matrices(conf, centers[:, 0], centers[:, 1], zeros, align_theta=False)
+
+        cur_fs = fnums - start_frame
+        base_locs = trx_transforms.apply_matrices(A_uncrop, ret_dict.pop('locs')[:ppe, ...])
+        base_locs[~found] = np.nan
+        pred_locs[cur_fs, 0, ...] = trx_transforms.convert_to_orig_batch(base_locs, conf, fnums, zeros, None, crop_loc)
+        extra_dict['locs_detect'][cur_fs, 0, ...] = trx_transforms.convert_to_orig_batch(detect_locs, conf, fnums, zeros, None, crop_loc)
+        for k in ret_dict.keys():
+            cur_v = ret_dict[k]
+            if cur_v.ndim == 4:  # hmaps are not saved
+                continue
+            if k not in extra_dict:
+                extra_dict[k] = np.zeros((max_n_frames, 1) + cur_v.shape[1:])
+            if k.startswith('locs'):
+                cur_v = trx_transforms.apply_matrices(A_uncrop, cur_v[:ppe, ...])
+                cur_v = trx_transforms.convert_to_orig_batch(cur_v, conf, fnums, zeros, None, crop_loc)
+            extra_dict[k][cur_fs, 0, ...] = cur_v[:ppe, ...]
+
+        if cur_b % 20 == 19:
+            sys.stdout.write('.')
+        if cur_b % nskip_partfile == nskip_partfile - 1:
+            sys.stdout.write('\n')
+            write_trk(out_file + '.part', pred_locs, extra_dict, start_frame, fnums[-1] + 1, trx_ids, conf, info, mov_file)
+        if progress_fn is not None:
+            progress_fn(fnums[-1] + 1 - start_frame, max_n_frames, fnums[-1] + 1)
+
+    trk_filter_type = conf.get('trk_filter', None)
+    if trk_filter_type:
+        extra_dict['locs_raw'] = pred_locs.copy()
+        pred_locs = filter_pred_locs(pred_locs, trk_filter_type, conf, pred_conf=extra_dict.get('conf', None))
+    write_trk(out_file, pred_locs, extra_dict, start_frame, end_frame, trx_ids, conf, info, mov_file)
+    if os.path.exists(out_file + '.part'):
+        os.remove(out_file + '.part')
+    cap.close()
+    if reset_graph:
+        tf.reset_default_graph()
+    return pred_locs
+
+
+class Lockstep(object):
+    ''' Keeps threads at the same frame. step(ndx, frame) waits till all the other threads have reached frame,
+    so the thread that is furthest behind never waits. Threads with fewer targets per frame (and so fewer
+    frames per batch) wait for the others. Threads that have finished are not waited for.'''
+
+    def __init__(self, n):
+        self.frames = [-1] * n
+        self.done = [False] * n
+        self.cond = threading.Condition()
+
+    def step(self, ndx, frame):
+        with self.cond:
+            self.frames[ndx] = frame
+            self.cond.notify_all()
+            self.cond.wait_for(lambda: all(d or f >= frame for f, d in zip(self.frames, self.done)))
+
+    def finish(self, ndx):
+        with self.cond:
+            self.done[ndx] = True
+            self.cond.notify_all()
+
+
+def classify_movie_multiview(model_type, confs, mov_files, out_files, trx_files=None, model_files=None,
+                             start_frames=None, end_frames=None, trx_ids=None, crop_locs=None,
+                             train_name='deepnet', progress_file=None, **kwargs):
+    ''' Tracks the synchronized movies of all views concurrently, with one thread per view.
+    Models for all the views are loaded upfront. The threads decode and track their frames in lockstep:
+    after each batch, a view waits till the other views have tracked upto the same frame. If progress_file is given, the total number of frames tracked across
+    all views is written to it periodically.
+    The list arguments have an entry per view. kwargs are passed to classify_movie and are the same for all views.
+    Projects with two-stage tracking (see is_detect_crop) are tracked with classify_movie_two_stage.
+    Raises RuntimeError with the errors after all the views are done if tracking failed for any of them.
+    '''
+    n_views = len(confs)
+    trx_files = [None] * n_views if trx_files is None else trx_files
+    model_files = [None] * n_views if model_files is None else model_files
+    start_frames = [0] * n_views if start_frames is None else start_frames
+    end_frames = [-1] * n_views if end_frames is None else end_frames
+    trx_ids = [()] * n_views if trx_ids is None else trx_ids
+    crop_locs = [None] * n_views if crop_locs is None else crop_locs
+
+    # each view has its own graph (and session for keras networks), which the view's thread uses.
+    # The networks are created in the main thread.
+    trackers = []
+    detectors = []
+    for v in range(n_views):
+        trackers.append(get_graph_pred_fn(model_type, confs[v], model_files[v], name=train_name))
+        detectors.append(get_detect_pred_fn(model_type, confs[v]) if is_detect_crop(confs[v]) else None)
+
+    lockstep = Lockstep(n_views)
+    n_done = [0] * n_views
+    progress_lock = threading.Lock()
+    last_write = [time.time()]
+
+    def track_view(v):
+        conf, (pred_fn, close_fn, model_file) = confs[v], trackers[v]
+
+        def progress_fn(cur_done, n_total, next_frame):
+            with progress_lock:
+                n_done[v] = cur_done
+                if progress_file is not None and time.time() - last_write[0] >= N_TRACKED_WRITE_INTERVAL_SEC:
+                    write_n_tracked_part_file(sum(n_done), progress_file)
+                    last_write[0] = time.time()
+            lockstep.step(v, next_frame)
+
+        try:
+            if detectors[v] is not None:
+                detect_conf, detect_pred_fn, _, detect_model_file = detectors[v]
+                classify_movie_two_stage(conf, pred_fn, detect_conf, detect_pred_fn, mov_file=mov_files[v],
+                                         out_file=out_files[v], start_frame=start_frames[v], end_frame=end_frames[v],
+                                         model_file=model_file, detect_model_file=detect_model_file,
+                                         crop_loc=crop_locs[v], progress_fn=progress_fn, reset_graph=False,
+                                         **two_stage_kwargs(kwargs))
+            else:
+                classify_movie(conf, pred_fn, model_type, mov_file=mov_files[v], out_file=out_files[v],
+                               trx_file=trx_files[v], start_frame=start_frames[v], end_frame=end_frames[v],
+                               trx_ids=trx_ids[v], model_file=model_file, crop_loc=crop_locs[v],
+                               progress_fn=progress_fn, reset_graph=False, **kwargs)
+        except Exception as e:
+            logging.exception('Could not track movie {} for view {}'.format(mov_files[v], v + 1))
+            failed.append((v, e))
+        finally:
+            lockstep.finish(v)
+
+    failed = []
+    threads = [threading.Thread(target=track_view, args=(v,)) for v in range(n_views)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    if progress_file is not None:
+        write_n_tracked_part_file(sum(n_done), progress_file)
+    for (pred_fn, close_fn, model_file), detector in zip(trackers, detectors):
+        close_fn()
+        if detector is not None:
+            detector[2]()
+    if len(failed) > 0:
+        msgs = ['view {}: {}'.format(v + 1, e) for v, e in sorted(failed, key=lambda x: x[0])]
+        raise RuntimeError('Tracking failed for {}'.format('; '.join(msgs)))
+
+
+def run_track_job(job, model_type, trackers, name):
+    ''' Tracks a single movie for the tracking worker using an already loaded prediction function.
+    job is a dict with the same conventions as the track command line arguments (1-indexed):
+        mov, out: movie and output trk file (required)
+        view: view to track (default 1)
+        trx: trx file (default None)
+        start_frame, end_frame: frame range (default 1 and -1 i.e. till the end)
+        skip_rate: default 1
+        trx_ids: only track these animals (default all)
+        crop_loc: [xlo, xhi, ylo, yhi] (default None)
+    trackers is a dict view -> (conf, pred_fn, close_fn, model_file, detector) with 0-indexed views. detector is
+    the output of get_detect_pred_fn for two-stage tracking (see is_detect_crop), in which case trx, skip_rate and
+    trx_ids are ignored, and None otherwise.
+    '''
+    view = to_py(job.get('view', 1))
+    if view not in trackers:
+        raise ValueError('Model for view {} is not loaded in the worker'.format(job.get('view', 1)))
+    conf, pred_fn, close_fn, model_file, detector = trackers[view]
+    end_frame = job.get('end_frame', -1)
+    end_frame = np.Inf if end_frame < 0 else end_frame
+    crop_loc = job.get('crop_loc', None)
+    # 1-indexed like the track command line
+    crop_loc = None if crop_loc is None else to_py(np.array([int(x) for x in crop_loc]))
+    trx_ids = to_py(job.get('trx_ids', []))
+    logging.info('Worker: Tracking {} to {}'.format(job['mov'], job['out']))
+    start = time.time()
+    if detector is not None:
+        detect_conf, detect_pred_fn, _, detect_model_file = detector
+        classify_movie_two_stage(conf, pred_fn, detect_conf, detect_pred_fn,
+                                 mov_file=job['mov'],
+                                 out_file=job['out'],
+                                 start_frame=to_py(job.get('start_frame', 1)),
+                                 end_frame=end_frame,
+                                 model_file=model_file,
+                                 detect_model_file=detect_model_file,
+                                 name=name,
+                                 crop_loc=crop_loc,
+                                 reset_graph=False)
+        logging.info('Worker: Done tracking {} in {:.1f}s'.format(job['mov'], time.time() - start))
+        return {'status': 'done', 'out': job['out'], 'time': time.time() - start}
+    classify_movie(conf, pred_fn, model_type,
+                   mov_file=job['mov'],
+                   out_file=job['out'],
+                   trx_file=job.get('trx', None),
+                   start_frame=to_py(job.get('start_frame', 1)),
+                   end_frame=end_frame,
+                   skip_rate=job.get('skip_rate', 1),
+                   trx_ids=trx_ids,
+                   model_file=model_file,
+                   name=name,
+                   crop_loc=crop_loc,
+                   reset_graph=False)
+    logging.info('Worker: Done tracking {} in {:.1f}s'.format(job['mov'], time.time() - start))
+    return {'status': 'done', 'out': job['out'], 'time': time.time() - start}
+
+
+def track_worker(model_type, trackers, name, job_dir=None, port=None, authkey=None, idle_timeout=0, poll_interval=2.):
+    ''' Long running tracking worker. The models are loaded once (trackers) and are used to track
+    a stream of jobs (see run_track_job for the job format), which are read either
+    - from json files placed in job_dir. A job file <job>.json is renamed to <job>.json.running
+      while it is being tracked and then to <job>.json.done or <job>.json.err. Results or the error are
+      saved in <job>.json.log. A file named stop in job_dir stops the worker.
+    - or from a local socket on port. Each job is answered with a dict with status, and {'cmd':'stop'} stops the worker.
+    Progress for each job is saved in the usual .part trk files.
+    If idle_timeout > 0, the worker exits after waiting that many seconds without any job.
+    authkey is required with port, so that only clients that can read it can submit jobs.
+    '''
+    if port is not None and not authkey:
+        raise ValueError('An authkey is required to accept jobs on port {}'.format(port))
+
+    def do_job(job):
+        try:
+            return run_track_job(job, model_type, trackers, name)
+        except Exception as e:
+            logging.exception('Worker: Could not track job {}'.format(job))
+            return {'status': 'error', 'out': job.get('out', None), 'msg': traceback.format_exc()}
+
+    last_job = time.time()
+    if job_dir is not None:
+        logging.info('Worker: Waiting for jobs in {}'.format(job_dir))
+        while not os.path.exists(os.path.join(job_dir, 'stop')):
+            job_files = sorted(glob.glob(os.path.join(job_dir, '*.json')))
+            claimed = None
+            for job_file in job_files:
+                try:
+                    # rename is atomic so that multiple workers can share a job_dir
+                    os.rename(job_file, job_file + '.running')
+                    claimed = job_file
+                    break
+                except OSError:
+                    continue
+            if claimed is None:
+                if 0 < idle_timeout < time.time() - last_job:
+                    logging.info('Worker: No jobs for {}s. Exiting'.format(idle_timeout))
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            try:
+                with open(claimed + '.running', 'r') as f:
+                    job = json.load(f)
+            except ValueError:
+                res = {'status': 'error', 'msg': 'Could not parse job file {}'.format(claimed)}
+            else:
+                res = do_job(job)
+            with open(claimed + '.log', 'w') as f:
+                json.dump(res, f, indent=2)
+            os.rename(claimed + '.running', claimed + ('.done' if res['status'] == 'done' else '.err'))
+            last_job = time.time()
+
+    else:
+        from multiprocessing.connection import Listener
+        listener = Listener(('localhost', port), authkey=authkey)
+        logging.info('Worker: Waiting for jobs on port {}'.format(port))
+        stop = False
+        while not stop:
+            conn = listener.accept()
+            try:
+                while True:
+                    try:
+                        job = conn.recv()
+                    except EOFError:
+                        break
+                    if job.get('cmd', 'track') == 'stop':
+                        conn.send({'status': 'stopped'})
+                        stop = True
+                        break
+                    conn.send(do_job(job))
+            finally:
+                conn.close()
+        listener.close()
+
+    for view in trackers:
+        trackers[view][2]()
+        if trackers[view][4] is not None:
+            trackers[view][4][2]()
+    logging.info('Worker: Stopped')
+
+
+def create_worker_authkey(key_file):
+    ''' Generates a random authkey for the tracking worker and saves it in key_file, readable only by the user.'''
+    authkey = binascii.hexlify(os.urandom(16))
+    if os.path.exists(key_file):
+        os.remove(key_file)
+    fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(authkey)
+    logging.info('Worker: Saved the authkey for jobs in {}'.format(key_file))
+    return authkey
+
+
+def submit_track_job(port, job, authkey):
+    ''' Sends a job to a tracking worker listening on port and waits for it to finish.
+    authkey is the one given to the worker, or the one it saved in <log file>.authkey.'''
+    from multiprocessing.connection import Client
+    if isinstance(authkey, str):
+        authkey = authkey.encode()
+    conn = Client(('localhost', port), authkey=authkey)
+    conn.send(job)
+    res = conn.recv()
+    conn.close()
+    return res
 
 
 def train_unet(conf, args, restore,split, split_file=None):
@@ -2534,6 +3678,41 @@ def create_dlc_cfg_dict(conf,train_name='deepnet'):
     }
     return cfg_dict
 
+def train_net(net_type, conf, args, restore=False, split=False, split_file=None):
+    ''' Trains net_type with conf. args needs skip_db, use_cache, use_defaults and train_name.'''
+    if net_type == 'unet':
+        train_unet(conf, args, restore, split, split_file=split_file)
+    elif net_type == 'mdn':
+        train_mdn(conf, args, restore, split, split_file=split_file)
+    # elif net_type == 'openpose':
+    #     if args.use_defaults:
+    #         op.set_openpose_defaults(conf)
+    #     train_openpose(conf, args, split, split_file=split_file)
+    elif net_type == 'sb':
+        assert not args.use_defaults
+        train_sb(conf, args, split, split_file=split_file)
+    elif net_type == 'leap':
+        if args.use_defaults:
+            leap.training.set_leap_defaults(conf)
+        train_leap(conf, args, split, split_file=split_file)
+    elif net_type == 'deeplabcut':
+        if args.use_defaults:
+            deeplabcut.train.set_deepcut_defaults(conf)
+        train_deepcut(conf,args, split_file=split_file)
+    elif net_type == 'dpk':
+        train_dpk(conf, args, split, split_file=split_file)
+
+    else:
+        if not args.skip_db:
+            create_tfrecord(conf, split=split, use_cache=args.use_cache, split_file=split_file)
+        module_name = 'Pose_{}'.format(net_type)
+        pose_module = __import__(module_name)
+        tf.reset_default_graph()
+        self = getattr(pose_module, module_name)(conf,name=args.train_name)
+        # self.name = args.train_name
+        self.train_wrapper(restore=restore)
+
+
 def train(lblfile, nviews, name, args):
     ''' Creates training db and calls the appropriate network's training function '''
 
@@ -2568,37 +3747,7 @@ def train(lblfile, nviews, name, args):
             split_file = None
 
         try:
-            if net_type == 'unet':
-                train_unet(conf, args, restore, split, split_file=split_file)
-            elif net_type == 'mdn':
-                train_mdn(conf, args, restore, split, split_file=split_file)
-            # elif net_type == 'openpose':
-            #     if args.use_defaults:
-            #         op.set_openpose_defaults(conf)
-            #     train_openpose(conf, args, split, split_file=split_file)
-            elif net_type == 'sb':
-                assert not args.use_defaults
-                train_sb(conf, args, split, split_file=split_file)
-            elif net_type == 'leap':
-                if args.use_defaults:
-                    leap.training.set_leap_defaults(conf)
-                train_leap(conf, args, split, split_file=split_file)
-            elif net_type == 'deeplabcut':
-                if args.use_defaults:
-                    deeplabcut.train.set_deepcut_defaults(conf)
-                train_deepcut(conf,args, split_file=split_file)
-            elif net_type == 'dpk':
-                train_dpk(conf, args, split, split_file=split_file)
-
-            else:
-                if not args.skip_db:
-                    create_tfrecord(conf, split=split, use_cache=args.use_cache, split_file=split_file)
-                module_name = 'Pose_{}'.format(net_type)
-                pose_module = __import__(module_name)
-                tf.reset_default_graph()
-                self = getattr(pose_module, module_name)(conf,name=args.train_name)
-                # self.name = args.train_name
-                self.train_wrapper(restore=restore)
+            train_net(net_type, conf, args, restore, split, split_file=split_file)
 
         except tf.errors.InternalError as e:
             logging.exception(
@@ -2677,6 +3826,10 @@ def parse_args(argv):
     parser_classify.add_argument('-crop_loc', dest='crop_loc', help='crop location given xlo xhi ylo yhi', nargs='*', type=int,
                                  default=None)
     parser_classify.add_argument('-list_file',dest='list_file', help='JSON file with list of movies, targets and frames to track',default=None)
+    parser_classify.add_argument('-concurrent_views', dest='concurrent_views', action='store_true',
+                                 help='Track all the views at the same time. Only used when -view is not specified')
+    parser_classify.add_argument('-progress_file', dest='progress_file', default=None,
+                                 help='With -concurrent_views, write the number of frames tracked across all views to this file')
 
     parser_gt = subparsers.add_parser('gt_classify', help='Classify GT labeled frames')
     parser_gt.add_argument('-out',
@@ -2697,6 +3850,16 @@ def parse_args(argv):
 
     parser_model = subparsers.add_parser('model_files', help='prints the list of model files')
 
+    parser_export = subparsers.add_parser('export', help='Export the trained model for faster tracking. Use the exported file as the model file for tracking')
+    parser_export.add_argument('-out', dest='out_files', help='Exported file for each view. Default is the model file with .pb, .ts or .onnx appended', default=None, nargs='*')
+    parser_export.add_argument('-format', dest='export_format', help='Export format for pytorch networks. Tensorflow networks are always exported as frozen graphs', choices=['torchscript', 'onnx'], default='torchscript')
+
+    parser_worker = subparsers.add_parser('track_worker', help='Keep the models loaded and track movies from a job queue')
+    parser_worker.add_argument('-job_dir', dest='job_dir', help='Directory where json job files are placed', default=None)
+    parser_worker.add_argument('-port', dest='port', help='Accept jobs on this local port instead of job_dir', type=int, default=None)
+    parser_worker.add_argument('-authkey', dest='authkey', help='Authentication key for jobs sent to port. If not given, a random key is saved in <log file>.authkey', default=None)
+    parser_worker.add_argument('-idle_timeout', dest='idle_timeout', help='Exit after these many seconds without a job. 0 to never exit', type=float, default=0)
+
     parser_test = subparsers.add_parser('test', help='Perform tests')
     parser_test.add_argument('testrun', choices=['hello'], help="Test to run")
 
@@ -2765,18 +3928,16 @@ def run(args):
 
     lbl_file = args.lbl_file
     try:
-        try:
-            H = loadmat(lbl_file)
-        except NotImplementedError:
-            logging.info('Label file is in v7.3 format. Loading using h5py')
-            H = h5py.File(lbl_file, 'r')
+        nviews = get_nviews(lbl_file)
     except TypeError as e:
         logging.exception('LBL_READ: Could not read the lbl file {}'.format(lbl_file))
         exit(1)
 
     #raise ValueError('I am an error')
 
-    nviews = int(read_entry(H['cfg']['NumViews']))
+    # only for the subcommands that train or run the network
+    if args.type is not None and args.sub_name in ['train', 'track', 'track_worker', 'classify', 'gt_classify']:
+        import_net_modules(args.type)
 
     if args.sub_name == 'train':
         train(lbl_file, nviews, name, args)
@@ -2809,8 +3970,6 @@ def run(args):
 
             conf = create_conf(lbl_file, view, name, net_type=args.type,
                                cache_dir=args.cache,conf_params=args.conf_params)
-            # maybe this should be in create_conf
-            conf.batch_size = 1 if args.type == 'deeplabcut' else conf.batch_size
             success, pred_locs = classify_list_file(conf, args.type, args.list_file, args.model_file[view_ndx], args.out_files[view_ndx], ivw=view_ndx)
             assert success, 'Error classifying list_file ' + args.list_file + 'view ' + str(view)
 
@@ -2832,32 +3991,54 @@ def run(args):
                     args.crop_loc) == 4 * nviews, 'cropping location should be specified as xlo xhi ylo yhi for all the views'
             views = range(nviews)
 
-            for view_ndx, view in enumerate(views):
-                conf = create_conf(lbl_file, view, name, net_type=args.type, cache_dir=args.cache,
-                                   conf_params=args.conf_params)
+            if args.concurrent_views and nviews > 1:
+                confs = [create_conf(lbl_file, view, name, net_type=args.type, cache_dir=args.cache,
+                                     conf_params=args.conf_params) for view in views]
                 if args.crop_loc is not None:
-                    crop_loc = [int(x) for x in args.crop_loc]
-                    # crop_loc = np.array(crop_loc).reshape([len(views), 4])[view_ndx, :] - 1
-                    # KB 20190123: crop_loc was being decremented twice, removed one
-                    crop_loc = np.array(crop_loc).reshape([len(views), 4])[view_ndx, :]
+                    crop_locs = list(np.array([int(x) for x in args.crop_loc]).reshape([len(views), 4]))
                 else:
-                    crop_loc = None
-
-                classify_movie_all(args.type,
-                                   conf=conf,
-                                   mov_file=args.mov[view_ndx],
-                                   trx_file=args.trx[view_ndx],
-                                   out_file=args.out_files[view_ndx],
-                                   start_frame=args.start_frame[view_ndx],
-                                   end_frame=args.end_frame[view_ndx],
-                                   skip_rate=args.skip,
-                                   trx_ids=args.trx_ids[view_ndx],
-                                   name=name,
-                                   save_hmaps=args.hmaps,
-                                   crop_loc=crop_loc,
-                                   model_file=args.model_file[view_ndx],
-                                   train_name=args.train_name
-                                   )
+                    crop_locs = None
+                classify_movie_multiview(args.type, confs,
+                                         mov_files=args.mov,
+                                         out_files=args.out_files,
+                                         trx_files=args.trx,
+                                         model_files=args.model_file,
+                                         start_frames=args.start_frame,
+                                         end_frames=args.end_frame,
+                                         trx_ids=args.trx_ids,
+                                         crop_locs=crop_locs,
+                                         train_name=args.train_name,
+                                         progress_file=args.progress_file,
+                                         skip_rate=args.skip,
+                                         name=name,
+                                         save_hmaps=args.hmaps)
+            else:
+                for view_ndx, view in enumerate(views):
+                    conf = create_conf(lbl_file, view, name, net_type=args.type, cache_dir=args.cache,
+                                       conf_params=args.conf_params)
+                    if args.crop_loc is not None:
+                        crop_loc = [int(x) for x in args.crop_loc]
+                        # crop_loc = np.array(crop_loc).reshape([len(views), 4])[view_ndx, :] - 1
+                        # KB 20190123: crop_loc was being decremented twice, removed one
+                        crop_loc = np.array(crop_loc).reshape([len(views), 4])[view_ndx, :]
+                    else:
+                        crop_loc = None
+
+                    classify_movie_all(args.type,
+                                       conf=conf,
+                                       mov_file=args.mov[view_ndx],
+                                       trx_file=args.trx[view_ndx],
+                                       out_file=args.out_files[view_ndx],
+                                       start_frame=args.start_frame[view_ndx],
+                                       end_frame=args.end_frame[view_ndx],
+                                       skip_rate=args.skip,
+                                       trx_ids=args.trx_ids[view_ndx],
+                                       name=name,
+                                       save_hmaps=args.hmaps,
+                                       crop_loc=crop_loc,
+                                       model_file=args.model_file[view_ndx],
+                                       train_name=args.train_name
+                                       )
         else:
             nmov = len(args.mov)
             def checklen(x, varstr):
@@ -2987,6 +4168,53 @@ def run(args):
             m_files.append(get_latest_model_files(conf,net_type=args.type,name=args.train_name))
         print(m_files)
 
+    elif args.sub_name == 'track_worker':
+        assert (args.job_dir is None) != (args.port is None), 'Specify exactly one of job_dir or port'
+        views = range(nviews) if args.view is None else [args.view]
+        if args.model_file is None:
+            args.model_file = [None] * len(views)
+        else:
+            assert len(args.model_file) == len(views), 'Number of model files should be same as the number of views'
+        trackers = {}
+        for view_ndx, view in enumerate(views):
+            conf = create_conf(lbl_file, view, name, net_type=args.type, cache_dir=args.cache, conf_params=args.conf_params)
+            # each view has its own graph, as in classify_movie_multiview
+            pred_fn, close_fn, model_file = get_graph_pred_fn(args.type, conf, args.model_file[view_ndx],
+                                                              name=args.train_name)
+            detector = get_detect_pred_fn(args.type, conf) if is_detect_crop(conf) else None
+            trackers[view] = (conf, pred_fn, close_fn, model_file, detector)
+        authkey = None
+        if args.port is not None:
+            if args.authkey is None:
+                log_file = args.err_file if args.log_file is None else args.log_file
+                if log_file is None:
+                    log_file = os.path.join(expanduser("~"), '{}.err'.format(args.name))
+                authkey = create_worker_authkey(log_file + '.authkey')
+            else:
+                authkey = args.authkey.encode()
+        track_worker(args.type, trackers, name, job_dir=args.job_dir, port=args.port, authkey=authkey,
+                     idle_timeout=args.idle_timeout)
+
+    elif args.sub_name == 'export':
+        if args.view is None:
+            views = range(nviews)
+        else:
+            views = [args.view]
+        if args.model_file is None:
+            args.model_file = [None] * len(views)
+        else:
+            assert len(args.model_file) == len(views), 'Number of model files should be same as the number of views to export'
+        if args.out_files is None:
+            args.out_files = [None] * len(views)
+        else:
+            assert len(args.out_files) == len(views), 'Number of out files should be same as the number of views to export'
+
+        for view_ndx, view in enumerate(views):
+            conf = create_conf(lbl_file, view, name, net_type=args.type, cache_dir=args.cache, conf_params=args.conf_params)
+            out_file = export_model(args.type, conf, args.model_file[view_ndx], args.out_files[view_ndx],
+                                    name=args.train_name, fmt=args.export_format)
+            print(out_file)
+
 def main(argv):
     args = parse_args(argv)
 
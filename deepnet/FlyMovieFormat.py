@@ -263,7 +263,41 @@ class FlyMovie:
             raise
         else:
             return x
-    
+
+    def get_frames(self,frame_numbers):
+        """Return (frames, timestamps) for a list of frame numbers as N x H x W and N arrays.
+        For fmf files, each run of consecutive frames is read with a single read."""
+        frame_numbers = nx.asarray(frame_numbers,dtype=int).ravel()
+        frame_numbers = nx.where(frame_numbers<0,self.n_frames+frame_numbers,frame_numbers)
+        if nx.any(frame_numbers<0):
+            raise IndexError("index out of range (n_frames = %d)"%self.n_frames)
+        n = len(frame_numbers)
+        h,w = self.framesize
+        if self.issbfmf or self.bytes_per_chunk != self.timestamp_len + h*w:
+            frames = None
+            timestamps = nx.zeros(n)
+            for ndx,fn in enumerate(frame_numbers):
+                frame,timestamps[ndx] = self.get_frame(fn)
+                if frames is None:
+                    frames = nx.zeros((n,)+frame.shape,dtype=frame.dtype)
+                frames[ndx] = frame
+            return frames, timestamps
+
+        frames = nx.zeros((n,h,w),dtype=nx.uint8)
+        timestamps = nx.zeros(n)
+        run_starts = nx.concatenate([[0],nx.flatnonzero(nx.diff(frame_numbers)!=1)+1,[n]])
+        for r0,r1 in zip(run_starts[:-1],run_starts[1:]):
+            self.file.seek(self.chunk_start+self.bytes_per_chunk*frame_numbers[r0])
+            nbytes = self.bytes_per_chunk*(r1-r0)
+            data = self.file.read(nbytes)
+            if len(data)<nbytes:
+                raise NoMoreFramesException('short frame')
+            chunks = nx.frombuffer(data,nx.uint8).reshape([r1-r0,self.bytes_per_chunk])
+            timestamps[r0:r1] = chunks[:,:self.timestamp_len].copy().view(nx.float64)[:,0]
+            frames[r0:r1] = chunks[:,self.timestamp_len:].reshape([r1-r0,h,w])
+        self.next_frame = None
+        return frames, timestamps
+
     def get_all_timestamps(self):
         if self._all_timestamps is None:
 
@@ -8,6 +8,8 @@ import tensorflow as tf
 import os
 import PoseTools
 import multiResData
+import ckpt_writer
+import shm_batch
 from enum import Enum
 import numpy as np
 import re
@@ -95,7 +97,7 @@ def l2_dist(x,y):
     return np.sqrt(np.sum((x-y)**2,axis=-1))
 
 
-class PoseCommon(object):
+class PoseCommon(ckpt_writer.BackgroundSaveMixin):
 
     class DBType(Enum):
         Train = 1
@@ -186,6 +188,8 @@ class PoseCommon(object):
 
         self.create_q_specs()
         assert self.train_type is not None, 'traintype has not been set'
+        # before any op or session is created. See start_producers
+        self.start_producers()
         # if self.train_type == 0:
         #     train_filename = os.path.join(self.conf.cachedir, self.conf.trainfilename) + self.db_name + '.tfrecords'
         #     val_filename = os.path.join(self.conf.cachedir, self.conf.valfilename) + self.db_name + '.tfrecords'
@@ -212,6 +216,8 @@ class PoseCommon(object):
         q = tf.FIFOQueue(QUEUE_SIZE, [tf.float32]*len(names), shapes=shapes, name='trainq')
         enqueue_op = q.enqueue(placeholders_list)
         dequeue_op = q.dequeue()
+        # closing the queues makes dequeue raise instead of waiting for batches that won't come
+        self.q_close_ops = [q.close(cancel_pending_enqueues=True)]
 
         self.train_enqueue_op = enqueue_op
         self.train_dequeue_op = dequeue_op
@@ -221,6 +227,7 @@ class PoseCommon(object):
         q = tf.FIFOQueue(QUEUE_SIZE, [tf.float32]*len(names), shapes=shapes, name='valq')
         enqueue_op = q.enqueue(placeholders_list)
         dequeue_op = q.dequeue()
+        self.q_close_ops.append(q.close(cancel_pending_enqueues=True))
 
         self.val_enqueue_op = enqueue_op
         self.val_dequeue_op = dequeue_op
@@ -253,6 +260,24 @@ class PoseCommon(object):
             traceback = sys.exc_info()[2]
             raise_(ValueError, "Inocrrect value for for_training", traceback)
 
+        # With batch_workers, batches are created in worker processes (started in open_dbs) instead of
+        # threads, and the threads only enqueue them.
+        producers = getattr(self, 'producers', [])
+        if len(producers) > 0 and n_threads > 0 and self.producer_args != (distort, shuffle):
+            logging.warning('Batch workers were started with distort={} shuffle={}. Using threads instead'.format(*self.producer_args))
+            for p in producers:
+                p.stop()
+            producers = self.producers = []
+        if len(producers) > 0 and n_threads > 0:
+            train_p, val_p = producers
+            train_t = threading.Thread(target=self.feed_thread, args=(sess, self.DBType.Train, train_p))
+            train_t.start()
+            train_threads.append(train_t)
+            val_t = threading.Thread(target=self.feed_thread, args=(sess, self.DBType.Val, val_p))
+            val_t.start()
+            val_threads.append(val_t)
+            n_threads = 0
+
         for _ in range(n_threads):
 
             train_t = threading.Thread(target=self.read_image_thread,
@@ -280,11 +305,11 @@ class PoseCommon(object):
             self.coord.join(self.val_threads)
         except RuntimeError as e:
             pass
+        for p in getattr(self, 'producers', []):
+            p.stop()
 
 
-    def read_image_thread(self, sess, db_type, distort, shuffle, scale):
-        # Thread that does the pre processing.
-
+    def db_file(self, db_type):
         if self.train_type == 0:
             if db_type == self.DBType.Val:
                 filename = os.path.join(self.conf.cachedir, self.conf.valfilename) + '.tfrecords'
@@ -296,46 +321,122 @@ class PoseCommon(object):
 
         else:
             filename = os.path.join(self.conf.cachedir, self.conf.trainfilename) + '.tfrecords'
+        return filename
 
-        cur_db = multiResData.tf_reader(self.conf, filename, shuffle)
-        placeholders = self.q_placeholders
 
-        print('Starting preloading thread of type ... {}'.format(db_type))
+    def create_batch(self, cur_db, distort, scale):
+        # reads and preprocesses the next batch from cur_db.
         batch_np = {}
-        while not self.coord.should_stop():
-            batch_in = cur_db.next()
-            batch_np['orig_images'] = batch_in[0]
-            batch_np['orig_locs'] = batch_in[1]
-            batch_np['info'] = batch_in[2]
-            batch_np['extra_info'] = batch_in[3]
-            xs, locs = PoseTools.preprocess_ims(batch_np['orig_images'], batch_np['orig_locs'], self.conf,
-                                                distort, scale)
+        batch_in = cur_db.next()
+        batch_np['orig_images'] = batch_in[0]
+        batch_np['orig_locs'] = batch_in[1]
+        batch_np['info'] = batch_in[2]
+        batch_np['extra_info'] = batch_in[3]
+        xs, locs = PoseTools.preprocess_ims(batch_np['orig_images'], batch_np['orig_locs'], self.conf,
+                                            distort, scale)
+
+        batch_np['images'] = xs
+        batch_np['locs'] = locs
+
+        for fn in self.q_fns:
+            fn(batch_np)
+        return batch_np
+
+
+    def enqueue(self, sess, db_type, food):
+        # Returns False if the session has been closed or training stopped.
+        run_options = tf.RunOptions(timeout_in_ms=30000)
+        while True:
+            if sess._closed or self.coord.should_stop():
+                return False
+            try:
+                if db_type == self.DBType.Val:
+                    sess.run(self.val_enqueue_op, feed_dict=food, options=run_options)
+                elif db_type == self.DBType.Train:
+                    sess.run(self.train_enqueue_op, feed_dict=food, options=run_options)
+                return True
+            except tf.errors.DeadlineExceededError:
+                pass
+
+
+    def start_producers(self, distort=True, shuffle=True):
+        # Starts the batch worker processes if conf.batch_workers > 0. The workers are forked, and
+        # tensorflow and CUDA state is not fork safe, so this is called from open_dbs before any op or
+        # session exists. distort and shuffle are those used for training, create_cursors falls back
+        # to threads if it is called with others.
+        self.producers = []
+        self.producer_args = None
+        n_workers = self.conf.get('batch_workers', 0)
+        if n_workers < 1 or self.for_training == 1:
+            return
+        train_p = self.create_producer(self.DBType.Train, distort, shuffle, self.scale, n_workers)
+        val_p = self.create_producer(self.DBType.Val, False, False, self.scale, max(1, n_workers // 4))
+        for p in [train_p, val_p]:
+            p.start()
+        self.producers = [train_p, val_p]
+        self.producer_args = (distort, shuffle)
+
+
+    def create_producer(self, db_type, distort, shuffle, scale, n_workers):
+        # Batches are created in worker processes in shared memory. See shm_batch
+        filename = self.db_file(db_type)
+        spec = [[name, shape] for (name, shape) in self.q_placeholder_spec]
+
+        def batch_fn(w_ndx):
+            cur_db = multiResData.tf_reader(self.conf, filename, shuffle)
+            if shuffle:
+                # start the workers at different places in the db
+                for _ in range(np.random.randint(max(cur_db.N, 1))):
+                    cur_db.read_next()
+            return lambda: self.create_batch(cur_db, distort, scale)
 
-            batch_np['images'] = xs
-            batch_np['locs'] = locs
+        n_slots = self.conf.get('batch_shm_slots', None)
+        name = 'train' if db_type == self.DBType.Train else 'val'
+        return shm_batch.ShmBatchProducer(batch_fn, spec, n_workers=n_workers, n_slots=n_slots, name=name)
 
-            for fn in self.q_fns:
-                fn(batch_np)
 
-            food = {pl: batch_np[name] for (name, pl) in placeholders}
+    def feed_thread(self, sess, db_type, producer):
+        # Thread that enqueues the batches created by producer.
+        placeholders = self.q_placeholders
+        try:
+            while not self.coord.should_stop():
+                try:
+                    slot, batch_np = producer.get(timeout=5)
+                except shm_batch.queue.Empty:
+                    continue
+                try:
+                    food = {pl: batch_np[name] for (name, pl) in placeholders}
+                    if not self.enqueue(sess, db_type, food):
+                        return
+                finally:
+                    producer.release(slot)
+        except (tf.errors.CancelledError,) as e:
+            return
+        except Exception as e:
+            logging.exception('Error in batch feeding thread')
+            self.close_cursors()
+            if not sess._closed:
+                # so that training stops instead of waiting for batches
+                sess.run(self.q_close_ops)
+            sys.exit(1)
 
-            success = False
-            run_options = tf.RunOptions(timeout_in_ms=30000)
-            try:
-                while not success:
 
-                    if sess._closed or self.coord.should_stop():
-                        return
+    def read_image_thread(self, sess, db_type, distort, shuffle, scale):
+        # Thread that does the pre processing.
+
+        filename = self.db_file(db_type)
+        cur_db = multiResData.tf_reader(self.conf, filename, shuffle)
+        placeholders = self.q_placeholders
 
-                    try:
-                        if db_type == self.DBType.Val:
-                            sess.run(self.val_enqueue_op, feed_dict=food,options=run_options)
-                        elif db_type == self.DBType.Train:
-                            sess.run(self.train_enqueue_op, feed_dict=food, options=run_options)
-                        success = True
+        print('Starting preloading thread of type ... {}'.format(db_type))
+        while not self.coord.should_stop():
+            batch_np = self.create_batch(cur_db, distort, scale)
 
-                    except tf.errors.DeadlineExceededError:
-                        pass
+            food = {pl: batch_np[name] for (name, pl) in placeholders}
+
+            try:
+                if not self.enqueue(sess, db_type, food):
+                    return
 
             except (tf.errors.CancelledError,) as e:
                 return
@@ -575,20 +676,8 @@ class PoseCommon(object):
         self.train_info = train_info
 
 
-    def save_td(self):
-        '''
-        Save training data
-        :return:
-        '''
-        saver = self.saver
-        train_data_file = saver['train_data_file']
-        with open(train_data_file, 'wb') as td_file:
-            pickle.dump([self.train_info, self.conf], td_file, protocol=2)
-        json_data = {}
-        for x in self.train_info.keys():
-            json_data[x] = np.array(self.train_info[x]).astype(np.float64).tolist()
-        with open(train_data_file+'.json','w') as json_file:
-            json.dump(json_data, json_file)
+    def get_td_file(self):
+        return self.saver['train_data_file']
 
 
     def update_td(self, cur_dict):
@@ -797,6 +886,7 @@ class PoseCommon(object):
                 print("Optimization Finished!")
                 self.save(sess, training_iters)
                 self.save_td()
+                self.wait_for_saves()
             self.close_cursors()
 
 
@@ -24,6 +24,8 @@ else:
 import os
 import PoseTools
 import multiResData
+import ckpt_writer
+import tf_augment
 from enum import Enum
 import numpy as np
 import re
@@ -133,7 +135,42 @@ def l2_dist(x,y):
     return np.sqrt(np.sum((x-y)**2,axis=-1))
 
 
-class PoseCommon(object):
+def tensor_names(val):
+    # Same nested structure as val with tensors replaced by their names
+    if isinstance(val, tf.Tensor):
+        return val.name
+    elif isinstance(val, (list, tuple)):
+        return [tensor_names(v) for v in val]
+    elif isinstance(val, dict):
+        return {k: tensor_names(v) for k, v in val.items()}
+    return None
+
+
+def hmap_argmax(hmaps, edge_ignore=0):
+    # tensorflow version of PoseTools.get_pred_locs. B x H x W x C heatmaps to B x C x 2 locations (x, y)
+    if edge_ignore > 0:
+        h, w = hmaps.get_shape().as_list()[1:3]
+        mask = np.zeros([1, h, w, 1], dtype='float32')
+        mask[:, edge_ignore:-edge_ignore, edge_ignore:-edge_ignore, :] = 1
+        h_min = tf.reduce_min(hmaps, axis=[1, 2], keepdims=True)
+        hmaps = hmaps * mask + h_min * (1 - mask)
+    sz = tf.shape(hmaps)
+    flat = tf.reshape(tf.transpose(hmaps, [0, 3, 1, 2]), [sz[0], sz[3], -1])
+    max_ndx = tf.argmax(flat, axis=-1, output_type=tf.int32)
+    return tf.cast(tf.stack([max_ndx % sz[2], max_ndx // sz[2]], axis=-1), tf.float32)
+
+
+def flatten_names(names):
+    if isinstance(names, list):
+        return [n for cur in names for n in flatten_names(cur)]
+    elif isinstance(names, dict):
+        return [n for cur in names.values() for n in flatten_names(cur)]
+    elif names is None:
+        return []
+    return [names]
+
+
+class PoseCommon(ckpt_writer.BackgroundSaveMixin):
 
     class DBType(Enum):
         Train = 1
@@ -187,6 +224,9 @@ class PoseCommon(object):
         self.compute_summary = self.conf.get('compute_summary',False)
         self.input_sizes = None
         self.is_multi = is_multi
+        # graph versions of train_py_map and val_py_map used with conf.tf_augment. Set by nets that support it.
+        self.train_tf_map = None
+        self.val_tf_map = None
 
 
     def get_latest_model_file(self):
@@ -296,19 +336,8 @@ class PoseCommon(object):
         self.train_info = train_info
 
 
-    def save_td(self, train_data_file = None):
-        if train_data_file is None:
-            # save training info
-            saver = self.saver
-            train_data_file = saver['train_data_file']
-
-        with open(train_data_file, 'wb') as td_file:
-            pickle.dump([self.train_info, self.conf], td_file, protocol=2)
-        json_data = {}
-        for x in self.train_info.keys():
-            json_data[x] = np.array(self.train_info[x]).astype(np.float64).tolist()
-        with open(train_data_file+'.json','w') as json_file:
-            json.dump(json_data, json_file)
+    def get_td_file(self):
+        return self.saver['train_data_file']
 
 
     def update_td(self, cur_dict):
@@ -425,18 +454,33 @@ class PoseCommon(object):
         else:
             pfn = _parse_function
 
+        train_map = self.train_py_map
+        val_map = self.val_py_map
+        if conf.get('tf_augment', False):
+            if self.train_tf_map is None or self.is_multi:
+                logging.warning('Augmentation with tensorflow ops is not available for {}. Using python augmentation'.format(self.net_name))
+            elif not tf_augment.supported(conf):
+                logging.warning('Augmentation with tensorflow ops does not support adjust_contrast. Using python augmentation')
+            else:
+                logging.info('Augmenting with tensorflow ops')
+                train_map = self.train_tf_map
+                val_map = self.val_tf_map
+
+        shuffle_buffer = conf.get('dataset_shuffle_buffer', 100)
+        prefetch_buffer = conf.get('dataset_prefetch_buffer', 100)
+
         train_dataset = train_dataset.map(map_func=pfn,num_parallel_calls=8)
         train_dataset = train_dataset.repeat()
-        train_dataset = train_dataset.shuffle(buffer_size=100)
+        train_dataset = train_dataset.shuffle(buffer_size=shuffle_buffer)
         train_dataset = train_dataset.batch(self.conf.batch_size)
-        train_dataset = train_dataset.map(map_func=self.train_py_map,num_parallel_calls=16)
-        train_dataset = train_dataset.prefetch(buffer_size=100)
+        train_dataset = train_dataset.map(map_func=train_map,num_parallel_calls=16)
+        train_dataset = train_dataset.prefetch(buffer_size=prefetch_buffer)
 
         val_dataset = val_dataset.map(map_func=pfn,num_parallel_calls=2)
         val_dataset = val_dataset.repeat()
         val_dataset = val_dataset.batch(self.conf.batch_size)
-        val_dataset = val_dataset.map(map_func=self.val_py_map,num_parallel_calls=4)
-        val_dataset = val_dataset.prefetch(buffer_size=100)
+        val_dataset = val_dataset.map(map_func=val_map,num_parallel_calls=4)
+        val_dataset = val_dataset.prefetch(buffer_size=prefetch_buffer)
 
         self.train_dataset = train_dataset
         self.val_dataset = val_dataset
@@ -720,6 +764,7 @@ class PoseCommon(object):
             logging.info("Optimization Finished!")
             self.save(sess, training_iters)
             self.save_td()
+            self.wait_for_saves()
         tf.reset_default_graph()
 
 
@@ -747,6 +792,7 @@ class PoseCommon(object):
             logging.info("Optimization Finished!")
             self.save(sess, training_iters)
             self.update_and_save_td(training_iters,sess)
+            self.wait_for_saves()
         tf.reset_default_graph()
 
 
@@ -782,6 +828,8 @@ class PoseCommon(object):
 
 
     def restore_net_common(self, create_network_fn=None, model_file=None):
+        if isinstance(model_file, str) and model_file.endswith('.pb'):
+            return self.restore_frozen(model_file)
         if create_network_fn is None:
             create_network_fn = self.create_network
         logging.info('--- Loading the model by reconstructing the graph ---')
@@ -830,6 +878,114 @@ class PoseCommon(object):
         return latest_model_file
 
 
+    def export_frozen(self, model_file=None, out_file=None):
+        ''' Saves the prediction graph with the weights folded in as constants, and with the
+        training phase fixed to False so that training only branches get pruned.
+        Attributes of the network that hold tensors (pred, inputs, ph etc) are saved by name in a
+        json file next to it, so that get_pred_fn works unchanged when the frozen graph (.pb) is given as model_file.
+        '''
+        sess, latest_model_file = self.restore_net(model_file)
+        if out_file is None:
+            out_file = latest_model_file + '.pb'
+        # fold the decoding of the outputs into locations into the graph
+        self.decoded = self.create_decode_ops()
+
+        tensors = {}
+        attrs = {}
+        for k, v in self.__dict__.items():
+            names = tensor_names(v)
+            if len(flatten_names(names)) > 0:
+                tensors[k] = names
+            elif isinstance(v, (bool, int, float, str)):
+                attrs[k] = v
+        keep = list(set([n.split(':')[0] for n in flatten_names(tensors)]))
+
+        graph_def = sess.graph.as_graph_def()
+        graph_def = tf.graph_util.convert_variables_to_constants(sess, graph_def, keep)
+        graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=keep)
+
+        const_ph = []
+        for k in ['phase_train', 'is_train']:
+            if k not in self.ph:
+                continue
+            for node in graph_def.node:
+                if node.name == self.ph[k].op.name:
+                    node.op = 'Const'
+                    node.ClearField('attr')
+                    node.attr['dtype'].type = tf.bool.as_datatype_enum
+                    node.attr['value'].tensor.CopyFrom(tf.make_tensor_proto(False, dtype=tf.bool))
+                    const_ph.append(self.ph[k].name)
+
+        with open(out_file, 'wb') as f:
+            f.write(graph_def.SerializeToString())
+        info = {'model_file': latest_model_file,
+                'batch_size': self.conf.batch_size,
+                'imsz': list(self.conf.imsz),
+                'tensors': tensors,
+                'attrs': attrs,
+                'const_ph': const_ph,
+                'input_shapes': [i.get_shape().as_list() for i in self.inputs]}
+        with open(os.path.splitext(out_file)[0] + '.json', 'w') as f:
+            json.dump(info, f, indent=2)
+        sess.close()
+        logging.info('Saved frozen graph for {} to {}'.format(latest_model_file, out_file))
+        return out_file
+
+
+    def create_decode_ops(self):
+        ''' Inherit this to return a dict of tensors that decode the network outputs into locations.
+        These are added to the frozen graph by export_frozen, and pred_fn uses them (as self.decoded)
+        instead of decoding in numpy.'''
+        return None
+
+
+    def restore_frozen(self, model_file):
+        logging.info('--- Loading the model from the frozen graph {} ---'.format(model_file))
+        with open(os.path.splitext(model_file)[0] + '.json', 'r') as f:
+            info = json.load(f)
+        if info['batch_size'] != self.conf.batch_size:
+            raise ValueError('Frozen graph was exported with batch size {} but the batch size is {}. Export the model again with the tracking batch size'.format(info['batch_size'], self.conf.batch_size))
+
+        graph_def = tf.GraphDef()
+        with open(model_file, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        tf.import_graph_def(graph_def, name='')
+        graph = tf.get_default_graph()
+
+        def get_tensors(names):
+            if isinstance(names, list):
+                return [get_tensors(n) for n in names]
+            elif isinstance(names, dict):
+                return {k: get_tensors(n) for k, n in names.items()}
+            elif names is None:
+                return None
+            elif names in info['const_ph']:
+                # phase is now a constant in the graph. Values fed by pred_fn go to a dummy placeholder
+                return tf.placeholder(tf.bool, name='frozen_' + names.split(':')[0])
+            try:
+                return graph.get_tensor_by_name(names)
+            except KeyError:
+                return None
+
+        for k, names in info['tensors'].items():
+            setattr(self, k, get_tensors(names))
+        for k, v in info['attrs'].items():
+            if getattr(self, k, None) is None:
+                setattr(self, k, v)
+
+        self.fd = {}
+        for k in self.ph.keys():
+            self.fd[self.ph[k]] = 0 if k in ['learning_rate', 'step'] else False
+        for i, sz in zip(self.inputs, info['input_shapes']):
+            self.fd[i] = np.zeros(sz)
+
+        config = tf.ConfigProto(intra_op_parallelism_threads=self.conf.get('track_intra_op_threads', 0),
+                                inter_op_parallelism_threads=self.conf.get('track_inter_op_threads', 0))
+        config.gpu_options.allow_growth = True
+        sess = tf.Session(config=config)
+        return sess, model_file
+
+
     def classify_val(self,train_type=0, at_step=-1):
 
         if train_type is 0:
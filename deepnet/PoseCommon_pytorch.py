@@ -8,6 +8,7 @@ from collections import OrderedDict
 import logging
 import PoseTools
 import tfdatagen
+import ckpt_writer
 import time
 import tensorflow.compat.v1 as tf
 from tfrecord.torch.dataset import TFRecordDataset
@@ -24,6 +25,17 @@ def print_train_data(cur_dict):
         p_str += '{:s}:{:.2f} '.format(k, cur_dict[k])
     logging.info(p_str)
 
+def to_cpu(obj):
+    ''' Copy of a (nested) state dict with the tensors on the cpu.'''
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    elif isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    else:
+        return obj
+
 def decode_augment(features, conf, distort):
     n_pts = conf.n_classes
     h = features['height'][0]
@@ -72,6 +84,22 @@ def decode_augment(features, conf, distort):
     return features
 
 
+class ExportWrapper(torch.nn.Module):
+    # Folds the permute and scaling done in pred_fn, and the decoding of the outputs (if decode_fn
+    # is given) into the exported module.
+    # Input is preprocessed images B x H x W x C in 0-255.
+    def __init__(self, model, decode_fn=None):
+        super(ExportWrapper, self).__init__()
+        self.model = model
+        self.decode_fn = decode_fn
+
+    def forward(self, ims):
+        preds = self.model({'images': ims.permute([0, 3, 1, 2]) / 255.})
+        if self.decode_fn is not None:
+            preds = self.decode_fn(preds)
+        return preds
+
+
 def next_data(loader, dataset):
     try:
         ndata = next(loader)
@@ -80,7 +108,7 @@ def next_data(loader, dataset):
         ndata = next(loader)
     return ndata, loader
 
-class PoseCommon_pytorch(object):
+class PoseCommon_pytorch(ckpt_writer.BackgroundSaveMixin):
 
     def __init__(self,conf,name='deepnet',is_multi=False):
         self.conf = conf
@@ -121,27 +149,34 @@ class PoseCommon_pytorch(object):
         return td_name
 
     def save(self, step, model, opt, sched):
+        # snapshot the state on the cpu so that training can continue while it is written
         fname = self.name + '-{}'.format(step)
         out_file = os.path.join(self.conf.cachedir,fname)
-        torch.save({'step':step, 'model_state_params':model.state_dict(), 'optimizer_state_params':opt.state_dict(), 'sched_state_params':sched.state_dict()
-                    },
-                    out_file)
-        logging.info('Saved model to {}'.format(out_file))
-        self.save_td()
+        ckpt = to_cpu({'step':step, 'model_state_params':model.state_dict(), 'optimizer_state_params':opt.state_dict(), 'sched_state_params':sched.state_dict()
+                    })
         self.prev_models.append(fname)
+        to_remove = None
         if len(self.prev_models) > self.conf.maxckpt:
-            if os.path.exists(self.prev_models[0]):
-                os.remove(self.prev_models[0])
-            _ = self.prev_models.pop(0)
+            to_remove = os.path.join(self.conf.cachedir, self.prev_models.pop(0))
+        prev_models = list(self.prev_models)
+        ckpt_file = self.get_ckpt_file()
 
-        with open(self.get_ckpt_file(),'w') as cf:
-            json.dump(self.prev_models,cf)
+        def write_ckpt():
+            ckpt_writer.atomic_write(out_file, lambda f: torch.save(ckpt, f))
+            logging.info('Saved model to {}'.format(out_file))
+            if to_remove is not None and os.path.exists(to_remove):
+                os.remove(to_remove)
+            ckpt_writer.atomic_write(ckpt_file, lambda f: json.dump(prev_models, f), mode='w')
+
+        self.get_writer().submit(write_ckpt)
+        self.save_td()
 
     def restore(self, model_file,model, opt=None, sched=None):
         if model_file is None:
             with open(self.get_ckpt_file(),'r') as cf:
                 prev_models = json.load(cf)
-            model_file = prev_models[-1]
+            # the checkpoint list has the file names within the cachedir
+            model_file = os.path.join(self.conf.cachedir, prev_models[-1])
         logging.info('Loading model from {}'.format(model_file))
         ckpt = torch.load(model_file)
         model.load_state_dict(ckpt['model_state_params'])
@@ -195,18 +230,6 @@ class PoseCommon_pytorch(object):
         self.train_info = train_info
 
 
-    def save_td(self):
-        train_data_file = self.get_td_file()
-
-        with open(train_data_file, 'wb') as td_file:
-            pickle.dump([self.train_info, self.conf], td_file, protocol=2)
-        json_data = {}
-        for x in self.train_info.keys():
-            json_data[x] = np.array(self.train_info[x]).astype(np.float64).tolist()
-        with open(train_data_file+'.json','w') as json_file:
-            json.dump(json_data, json_file)
-
-
     def update_td(self, cur_dict):
         # update training info
         if len(self.train_info) == 0:
@@ -335,6 +358,7 @@ class PoseCommon_pytorch(object):
 
         logging.info("Optimization Finished!")
         self.save(n_steps, model, opt, lr_sched)
+        self.wait_for_saves()
 
     def train_wrapper(self, restore=False):
         model = self.create_model()
@@ -373,8 +397,97 @@ class PoseCommon_pytorch(object):
         # Inherit this to create the model
         assert False, 'Inherit this function'
 
+    def is_exported(self, model_file):
+        return model_file is not None and model_file.endswith(('.ts', '.onnx'))
+
+    def export(self, model_file=None, out_file=None, fmt='torchscript'):
+        ''' Exports the model for inference as TorchScript (traced) or ONNX. The exported model
+        is specific to the batch size, image size and (for TorchScript) the device it was exported on.
+        Export with CUDA_VISIBLE_DEVICES='' for tracking on machines without GPUs.
+        The exported file can be given as model_file to get_pred_fn.
+        '''
+        model = self.create_model()
+        model = torch.nn.DataParallel(model)
+        if model_file is None:
+            model_file = self.get_latest_model_file()
+        self.restore(model_file, model)
+        model.to(self.device)
+        model.eval()
+        decode_fn = self.export_decode_fn()
+        wrapper = ExportWrapper(model.module, decode_fn).eval()
+
+        conf = self.conf
+        dummy = np.zeros((conf.batch_size,) + tuple(conf.imsz) + (conf.img_dim,))
+        xs, _ = PoseTools.preprocess_ims(dummy, np.zeros([conf.batch_size, conf.n_classes, 2]), conf, False, conf.rescale)
+        example = torch.tensor(xs, dtype=torch.float32, device=self.device)
+
+        if fmt == 'torchscript':
+            out_file = model_file + '.ts' if out_file is None else out_file
+            with torch.no_grad():
+                traced = torch.jit.trace(wrapper, example)
+            traced.save(out_file)
+        elif fmt == 'onnx':
+            out_file = model_file + '.onnx' if out_file is None else out_file
+            with torch.no_grad():
+                torch.onnx.export(wrapper, example, out_file, input_names=['images'], opset_version=11)
+        else:
+            raise ValueError('Unknown export format {}'.format(fmt))
+
+        info = {'model_file': model_file,
+                'format': fmt,
+                'batch_size': conf.batch_size,
+                'imsz': list(conf.imsz),
+                'device': self.device,
+                'decoded': decode_fn is not None}
+        with open(os.path.splitext(out_file)[0] + '.json', 'w') as f:
+            json.dump(info, f, indent=2)
+        logging.info('Exported {} to {}'.format(model_file, out_file))
+        return out_file
+
+    def export_decode_fn(self):
+        ''' Inherit this to return a traceable function that decodes the model outputs into locations,
+        so that the decoding is part of the exported model.'''
+        return None
+
+    def restore_exported(self, model_file):
+        ''' Loads a model saved by export. Returns a function that maps preprocessed
+        images (B x H x W x C) to the network outputs.
+        '''
+        logging.info('Loading exported model from {}'.format(model_file))
+        with open(os.path.splitext(model_file)[0] + '.json', 'r') as f:
+            info = json.load(f)
+        if info['batch_size'] != self.conf.batch_size:
+            raise ValueError('Model was exported with batch size {} but the batch size is {}. Export the model again with the tracking batch size'.format(info['batch_size'], self.conf.batch_size))
+        self.exported_decoded = info.get('decoded', False)
+        n_threads = self.conf.get('track_intra_op_threads', 0)
+
+        if model_file.endswith('.onnx'):
+            import onnxruntime
+            opts = onnxruntime.SessionOptions()
+            if n_threads > 0:
+                opts.intra_op_num_threads = n_threads
+            sess = onnxruntime.InferenceSession(model_file, opts)
+            in_name = sess.get_inputs()[0].name
+
+            def model_fn(ims):
+                return sess.run(None, {in_name: ims.astype(np.float32)})
+        else:
+            if n_threads > 0:
+                torch.set_num_threads(n_threads)
+            device = info['device']
+            model = torch.jit.load(model_file, map_location=device)
+            model.eval()
+
+            def model_fn(ims):
+                with torch.no_grad():
+                    return model(torch.tensor(ims, dtype=torch.float32, device=device))
+
+        return model_fn
+
     def to_numpy(self, t):
         if type(t) is list or type(t) is tuple:
             return [self.to_numpy(tt) for tt in t]
+        elif isinstance(t, np.ndarray):
+            return t
         else:
             return t.detach().cpu().numpy()
\ No newline at end of file
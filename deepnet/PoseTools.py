@@ -14,12 +14,8 @@ import math, h5py
 # import caffe
 from scipy import misc
 from scipy import ndimage
-import tensorflow
-vv = [int(v) for v in tensorflow.__version__.split('.')]
-if vv[0]==1 and vv[1]>12:
-    tf = tensorflow.compat.v1
-else:
-    tf = tensorflow
+from lazy_import import lazy_tf
+tf = lazy_tf()
 
 import multiResData
 import tempfile
@@ -698,39 +694,42 @@ def create_affinity_labels(locs, im_sz, graph, scale, blur_rad):
 
     out = np.zeros((len(locs), sz0, sz1, n_out*2))
     n_steps = min(sz0,sz1)*2
-    for cur in range(n_ex):
-        for ndx, e in enumerate(graph):
-            start_x, start_y = locs[cur,e[0],:]
-            end_x, end_y = locs[cur,e[1],:]
-            ll = np.sqrt( (start_x-end_x)**2 + (start_y-end_y)**2)
-
-            if ll==0:
-                # Can occur if start/end labels identical
-                # Don't update out/PAF
-                continue
-
-            dx = (end_x - start_x)/ll/2
-            dy = (end_y - start_y)/ll/2
-            zz = None
-            # AL: worried this creates a "tube" of width blur_rad/2 instead of blur_rad because
-            # dx and dy above already have a factor of 1/2. c.f. open_pose/create_affinity_labels
-            for delta in np.arange(-blur_rad/2,blur_rad/2,0.25):
-                xx = np.round(np.linspace(start_x+delta*dy,end_x+delta*dy,n_steps))
-                yy = np.round(np.linspace(start_y-delta*dx,end_y-delta*dx,n_steps))
-                if zz is None:
-                    zz = np.stack([xx,yy])
-                else:
-                    zz = np.concatenate([zz,np.stack([xx,yy])],axis=1)
-            # zz now has all the pixels that are along the line.
-            zz = np.unique(zz,axis=1)
-            # zz now has all the unique pixels that are along the line with thickness blur_rad.
-            dx = (end_x - start_x) / ll
-            dy = (end_y - start_y) / ll
-            for x,y in zz.T:
-                if x >= out.shape[2] or y >= out.shape[1]:
-                    continue
-                out[cur,int(y),int(x),ndx*2] = dx
-                out[cur,int(y),int(x),ndx*2+1] = dy
+    deltas = np.arange(-blur_rad/2,blur_rad/2,0.25)
+    if n_out == 0 or len(deltas) == 0:
+        return out
+
+    # All the limbs of all the examples are done together.
+    graph = np.array(graph, dtype='int64').reshape([n_out, 2])
+    start_x, start_y = locs[:, graph[:, 0], 0], locs[:, graph[:, 0], 1]  # n_ex x n_out
+    end_x, end_y = locs[:, graph[:, 1], 0], locs[:, graph[:, 1], 1]
+    ll = np.sqrt((start_x-end_x)**2 + (start_y-end_y)**2)
+    # ll is 0 if start/end labels are identical. Don't update out/PAF for those
+    valid = ll > 0
+    ll = np.where(valid, ll, 1.)
+    dx = (end_x - start_x)/ll/2
+    dy = (end_y - start_y)/ll/2
+    # AL: worried this creates a "tube" of width blur_rad/2 instead of blur_rad because
+    # dx and dy above already have a factor of 1/2. c.f. open_pose/create_affinity_labels
+
+    def line_coords(s, e, off):
+        # same as np.linspace(s+delta*off, e+delta*off, n_steps) for each delta
+        s = s[:, :, None] + deltas*off[:, :, None]
+        e = e[:, :, None] + deltas*off[:, :, None]
+        zz = np.arange(n_steps)*((e-s)/(n_steps-1))[..., None] + s[..., None]
+        zz[..., -1] = e
+        return np.round(zz)
+
+    # pixels along the line with thickness blur_rad. n_ex x n_out x len(deltas) x n_steps
+    xx = line_coords(start_x, end_x, dy)
+    yy = line_coords(start_y, end_y, -dx)
+    sel = valid[:, :, None, None] & (xx >= 0) & (xx < out.shape[2]) & (yy >= 0) & (yy < out.shape[1])
+    shape = xx.shape
+    e_ndx = np.broadcast_to(np.arange(n_ex)[:, None, None, None], shape)[sel]
+    c_ndx = np.broadcast_to(2*np.arange(n_out)[None, :, None, None], shape)[sel]
+    cx = xx[sel].astype('int64')
+    cy = yy[sel].astype('int64')
+    out[e_ndx, cy, cx, c_ndx] = np.broadcast_to((2*dx)[:, :, None, None], shape)[sel]
+    out[e_ndx, cy, cx, c_ndx+1] = np.broadcast_to((2*dy)[:, :, None, None], shape)[sel]
 
     return out
 
@@ -104,6 +104,9 @@ class PoseUMDN(PoseCommon.PoseCommon):
 
         self.train_py_map = lambda *args: tuple(tf.py_func( train_pp, args, self.input_dtypes))
         self.val_py_map = lambda *args: tuple(tf.py_func( val_pp,args, self.input_dtypes))
+        if not pad_input:
+            self.train_tf_map = lambda *args: PoseUNet.tf_preproc_func(conf, True, *args)
+            self.val_tf_map = lambda *args: PoseUNet.tf_preproc_func(conf, False, *args)
 
         if 'mdn_groups' not in self.conf.__dict__:
             self.conf.mdn_groups = [range(self.conf.n_classes)]
@@ -1,5 +1,6 @@
-from PoseCommon_dataset import PoseCommon, PoseCommonMulti, PoseCommonRNN, PoseCommonTime, conv_relu3, conv_shortcut
+from PoseCommon_dataset import PoseCommon, PoseCommonMulti, PoseCommonRNN, PoseCommonTime, conv_relu3, conv_shortcut, hmap_argmax
 import PoseTools
+import tf_augment
 import tensorflow as tf
 import os
 import sys
@@ -45,6 +46,13 @@ def preproc_func(conf, distort, *args, pad_input=False,pad_x=0,pad_y=0):
     hmaps = PoseTools.create_label_images(tlocs, hsz, 1, conf.label_blur_rad,occluded=occ)
     return ims.astype('float32'), locs.astype('float32'), info.astype('float32'), hmaps.astype('float32')
 
+def tf_preproc_func(conf, distort, ims, locs, info, occ=None):
+    ''' preproc_func with tensorflow ops, for use in the dataset pipeline without py_func. '''
+    ims, locs = tf_augment.preprocess_ims(ims, locs, conf, distort, conf.rescale)
+    hsz = [i//conf.rescale for i in conf.imsz]
+    hmaps = tf_augment.create_label_images(locs, hsz, 1, conf.label_blur_rad)
+    return ims, locs, tf.cast(info, tf.float32), hmaps
+
 def conv_residual(x_in, train_phase):
     in_dim = x_in.get_shape().as_list()[3]
 
@@ -127,6 +135,9 @@ class PoseUNet(PoseCommon):
 
         self.train_py_map = lambda *args: tuple(tf.py_func( train_pp, args, [tf.float32, tf.float32, tf.float32, tf.float32]))
         self.val_py_map = lambda *args: tuple(tf.py_func( val_pp, args, [tf.float32, tf.float32, tf.float32, tf.float32]))
+        if not pad_input:
+            self.train_tf_map = lambda *args: tf_preproc_func(conf, True, *args)
+            self.val_tf_map = lambda *args: tf_preproc_func(conf, False, *args)
 
     def create_network(self ):
         im, locs, info, hmap = self.inputs
@@ -622,17 +633,26 @@ class PoseUNet(PoseCommon):
 
             self.fd[self.inputs[0]] = xs
             self.fd_val()
+            decoded = getattr(self, 'decoded', None)
             try:
-                pred = sess.run(self.pred, self.fd)
+                if decoded is None:
+                    pred = sess.run(self.pred, self.fd)
+                else:
+                    pred, decoded = sess.run([self.pred, decoded], self.fd)
             except tf.errors.ResourceExhaustedError:
                 logging.exception('Out of GPU Memory. Either reduce the batch size or scale down the images')
                 exit(1)
-            base_locs = PoseTools.get_pred_locs(pred, self.edge_ignore)
+            if decoded is None:
+                base_locs = PoseTools.get_pred_locs(pred, self.edge_ignore)
+                cur_conf = np.max(pred,axis=(1,2))
+            else:
+                base_locs = decoded['locs']
+                cur_conf = decoded['conf']
             base_locs = base_locs * conf.rescale
             ret_dict = {}
             ret_dict['locs'] = base_locs
             ret_dict['hmaps'] = pred
-            ret_dict['conf'] = np.max(pred,axis=(1,2))
+            ret_dict['conf'] = cur_conf
             return ret_dict
 
         def close_fn():
@@ -640,6 +660,10 @@ class PoseUNet(PoseCommon):
 
         return pred_fn, close_fn, latest_model_file
 
+    def create_decode_ops(self):
+        return {'locs': hmap_argmax(self.pred, self.edge_ignore),
+                'conf': tf.reduce_max(self.pred, axis=[1, 2])}
+
     def classify_val(self, model_file=None, onTrain=False):
         if not onTrain:
             val_file = os.path.join(self.conf.cachedir, self.conf.valfilename + '.tfrecords')
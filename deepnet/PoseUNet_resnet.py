@@ -21,7 +21,7 @@ import traceback
 from scipy import stats
 from tensorflow.contrib.slim.nets import resnet_v1
 import tensorflow.contrib.slim as slim
-from PoseCommon_dataset import conv_relu3, conv_relu
+from PoseCommon_dataset import conv_relu3, conv_relu, hmap_argmax
 from tensorflow.contrib.layers import batch_norm
 import resnet_official
 import urllib
@@ -899,10 +899,12 @@ class PoseUMDN_resnet(PoseUMDN.PoseUMDN):
             self.fd[self.ph['phase_train']] = False
             self.fd[self.ph['learning_rate']] = 0
             # self.fd[self.ph['keep_prob']] = 1.
-            out_list = [self.pred, self.inputs]
+            decoded = getattr(self, 'decoded', None)
+            # with decoding folded into the (exported) graph, the mdn outputs aren't needed
+            out_list = [self.pred if decoded is None else decoded, self.inputs]
             if self.conf.mdn_use_unet_loss:
                 out_list.append(self.unet_pred)
-            if pred_occ:
+            if pred_occ and decoded is None:
                 out_list.append(self.occ_pred)
 
             with tmr_pred:
@@ -912,12 +914,9 @@ class PoseUMDN_resnet(PoseUMDN.PoseUMDN):
             cur_input = out[1]
             if self.conf.mdn_use_unet_loss:
                 unet_pred = out[2]
-            if pred_occ:
+            if pred_occ and decoded is None:
                 occ_out = out[-1]
                 occ_ret = np.zeros([bsize,self.conf.n_classes])
-
-            pred_means, pred_std, pred_weights,pred_dist = pred
-            pred_means = pred_means * self.offset
 #            pred_weights = PoseUMDN.softmax(pred_weights,axis=1)
 
             osz = [int(i/conf.rescale) for i in self.conf.imsz]
@@ -939,23 +938,34 @@ class PoseUMDN_resnet(PoseUMDN.PoseUMDN):
             # mdn_pred_out = 2*(mdn_pred_out-0.5)
             # mdn_conf = np.max(mdn_pred_out, axis=(1, 2))
 
-            base_locs = np.zeros([pred_means.shape[0],self.conf.n_classes,2])
-            mdn_conf = np.zeros([pred_means.shape[0],self.conf.n_classes])
-            for ndx in range(pred_means.shape[0]):
-                for gdx, gr in enumerate(self.conf.mdn_groups):
-                    for g in gr:
-                        sel_ex = np.argmax(pred_weights[ndx, :, gdx])
-                        mm = pred_means[ndx, sel_ex, g, :]
-                        base_locs[ndx, g] = mm
-                        mdn_conf[ndx,g] = np.max(pred_weights[ndx,:,gdx])
-                        if pred_occ:
-                            occ_ret[ndx,g] = occ_out[ndx,sel_ex,g]
+            if decoded is not None:
+                base_locs = pred['locs_mdn']
+                mdn_conf = pred['conf']
+                if pred_occ:
+                    occ_ret = pred['occ']
+            else:
+                pred_means, pred_std, pred_weights,pred_dist = pred
+                pred_means = pred_means * self.offset
+                base_locs = np.zeros([pred_means.shape[0],self.conf.n_classes,2])
+                mdn_conf = np.zeros([pred_means.shape[0],self.conf.n_classes])
+                for ndx in range(pred_means.shape[0]):
+                    for gdx, gr in enumerate(self.conf.mdn_groups):
+                        for g in gr:
+                            sel_ex = np.argmax(pred_weights[ndx, :, gdx])
+                            mm = pred_means[ndx, sel_ex, g, :]
+                            base_locs[ndx, g] = mm
+                            mdn_conf[ndx,g] = np.max(pred_weights[ndx,:,gdx])
+                            if pred_occ:
+                                occ_ret[ndx,g] = occ_out[ndx,sel_ex,g]
 
             base_locs = base_locs * conf.rescale
             mdn_conf = 2*mdn_conf -1 # it should now be between -1 to 1.
 
             if self.conf.mdn_use_unet_loss:
-                unet_locs = PoseTools.get_pred_locs(unet_pred)*conf.rescale
+                if decoded is not None:
+                    unet_locs = pred['locs_unet']*conf.rescale
+                else:
+                    unet_locs = PoseTools.get_pred_locs(unet_pred)*conf.rescale
                 d = np.sqrt(np.sum((base_locs - unet_locs) ** 2, axis=-1))
                 mdn_unet_locs = base_locs.copy()
                 mdn_unet_locs[d < mdn_unet_dist, :] = unet_locs[d < mdn_unet_dist, :]
@@ -982,6 +992,34 @@ class PoseUMDN_resnet(PoseUMDN.PoseUMDN):
         return pred_fn, close_fn, latest_model_file
 
 
+    def create_decode_ops(self):
+        # tensorflow version of the decoding in pred_fn
+        pred_means, _, pred_weights, _ = self.pred
+        n_k = pred_means.get_shape().as_list()[1]
+        pred_means = pred_means * self.offset
+        pred_occ = self.conf.get('predict_occluded',False)
+        locs = [None] * self.conf.n_classes
+        mdn_conf = [None] * self.conf.n_classes
+        occ = [None] * self.conf.n_classes
+        for gdx, gr in enumerate(self.conf.mdn_groups):
+            sel_ex = tf.one_hot(tf.argmax(pred_weights[:, :, gdx], axis=1), n_k, dtype=tf.float32)
+            gr_locs = tf.reduce_sum(pred_means * sel_ex[:, :, tf.newaxis, tf.newaxis], axis=1)
+            gr_conf = tf.reduce_max(pred_weights[:, :, gdx], axis=1)
+            if pred_occ:
+                gr_occ = tf.reduce_sum(self.occ_pred * sel_ex[:, :, tf.newaxis], axis=1)
+            for g in gr:
+                locs[g] = gr_locs[:, g, :]
+                mdn_conf[g] = gr_conf
+                if pred_occ:
+                    occ[g] = gr_occ[:, g]
+        decoded = {'locs_mdn': tf.stack(locs, axis=1), 'conf': tf.stack(mdn_conf, axis=1)}
+        if pred_occ:
+            decoded['occ'] = tf.stack(occ, axis=1)
+        if self.conf.mdn_use_unet_loss:
+            decoded['locs_unet'] = hmap_argmax(self.unet_pred)
+        return decoded
+
+
     def create_network_full(self):
 
         im, locs, info, hmap = self.inputs
@@ -1405,6 +1443,9 @@ class PoseUNet_resnet_lowres(PoseUNet_resnet):
 
         self.train_py_map = lambda ims, locs, info: tuple(tf.py_func( train_pp, [ims, locs, info], [tf.float32, tf.float32, tf.float32, tf.float32]))
         self.val_py_map = lambda ims, locs, info: tuple(tf.py_func( val_pp, [ims, locs, info], [tf.float32, tf.float32, tf.float32, tf.float32]))
+        # hmaps are at a lower resolution than tf_preproc_func creates
+        self.train_tf_map = None
+        self.val_tf_map = None
 
 
     def create_network(self):
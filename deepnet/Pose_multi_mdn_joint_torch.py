@@ -421,6 +421,52 @@ class Pose_multi_mdn_joint_torch(PoseCommon_pytorch.PoseCommon_pytorch):
                     preds_ref[ndx,cur_n,cls,:] = cur_pred
         return {'ref':preds_ref,'joint':preds_joint}
 
+    def export_decode_fn(self):
+        # Same as get_joint_pred, but with torch ops so that it can be traced into the exported model.
+        # Returns the top max_n_animals predictions and the number of them that are valid.
+        n_max = self.conf.max_n_animals
+        locs_offset = self.offset
+        ref_scale = self.ref_scale
+
+        def decode_fn(preds):
+            locs_joint, logits_joint, locs_ref, logits_ref = preds
+            bsz, n_classes = locs_joint.shape[0], locs_joint.shape[1]
+            k_ref = locs_ref.shape[-3]
+            n_y_r, n_x_r = locs_ref.shape[-2], locs_ref.shape[-1]
+            ll_joint_flat = logits_joint.reshape(bsz, -1)
+            n_preds = torch.clamp((ll_joint_flat > 0).sum(1), 1, n_max)
+            ids = torch.topk(ll_joint_flat, n_max, dim=1)[1]
+
+            lj = locs_joint.reshape(bsz, n_classes, 2, -1)
+            sel_joint = torch.gather(lj, 3, ids[:, None, None, :].expand(bsz, n_classes, 2, n_max))
+            preds_joint = sel_joint.permute(0, 3, 1, 2) * locs_offset
+
+            mm = torch.round(sel_joint * ref_scale).long()
+            mm_x = torch.clamp(mm[:, :, 0, :], 0, n_x_r - 1)
+            mm_y = torch.clamp(mm[:, :, 1, :], 0, n_y_r - 1)
+            pix = mm_y * n_x_r + mm_x  # B x n_classes x n_max
+            lr = logits_ref.reshape(bsz, n_classes, k_ref, -1)
+            pt_selex = torch.gather(lr, 3, pix[:, :, None, :].expand(bsz, n_classes, k_ref, n_max)).argmax(2)
+            sel_ndx = pt_selex * (n_y_r * n_x_r) + pix
+            lr_locs = locs_ref.reshape(bsz, n_classes, 2, -1)
+            sel_ref = torch.gather(lr_locs, 3, sel_ndx[:, :, None, :].expand(bsz, n_classes, 2, n_max))
+            preds_ref = sel_ref.permute(0, 3, 1, 2) * locs_offset / ref_scale
+            return preds_ref, preds_joint, n_preds
+
+        return decode_fn
+
+    def decode_exported(self, preds):
+        # Outputs of a model exported with decoding to the same format as get_joint_pred
+        preds_ref, preds_joint, n_preds = self.to_numpy(preds)
+        n_max = self.conf.max_n_animals
+        assert preds_ref.shape[1] >= n_max, 'Model was exported with max_n_animals {}'.format(preds_ref.shape[1])
+        invalid = np.arange(n_max)[np.newaxis, :] >= np.asarray(n_preds)[:, np.newaxis]
+        preds_ref = preds_ref[:, :n_max].astype('float64')
+        preds_joint = preds_joint[:, :n_max].astype('float64')
+        preds_ref[invalid] = np.nan
+        preds_joint[invalid] = np.nan
+        return {'ref':preds_ref,'joint':preds_joint}
+
     def compute_dist(self, output, labels):
         locs = labels.numpy().copy()
         locs[locs<-1000] = np.nan
@@ -441,18 +487,29 @@ class Pose_multi_mdn_joint_torch(PoseCommon_pytorch.PoseCommon_pytorch):
             self.conf.max_n_animals = max_n
         if imsz is not None:
             self.conf.imsz = imsz
-        model = self.create_model()
-        model = torch.nn.DataParallel(model)
-
-        if model_file is None:
-            latest_model_file = self.get_latest_model_file()
-        else:
+        if self.is_exported(model_file):
+            # same as in create_model
+            self.ref_scale = 8 if self.conf.get('mdn_joint_use_fpn',True) else 1
+            model_fn = self.restore_exported(model_file)
             latest_model_file = model_file
+        else:
+            model = self.create_model()
+            model = torch.nn.DataParallel(model)
+
+            if model_file is None:
+                latest_model_file = self.get_latest_model_file()
+            else:
+                latest_model_file = model_file
+
+            self.restore(latest_model_file,model)
+            model.to(self.device)
+            model.eval()
+            self.model = model
+
+            def model_fn(ims):
+                with torch.no_grad():
+                    return model({'images':torch.tensor(ims).permute([0,3,1,2])/255.})
 
-        self.restore(latest_model_file,model)
-        model.to(self.device)
-        model.eval()
-        self.model = model
         conf = self.conf
 
         def pred_fn(ims):
@@ -460,9 +517,11 @@ class Pose_multi_mdn_joint_torch(PoseCommon_pytorch.PoseCommon_pytorch):
             locs_dummy = np.zeros(locs_sz)
 
             ims, _ = PoseTools.preprocess_ims(ims,locs_dummy,conf,False,conf.rescale)
-            with torch.no_grad():
-                preds = model({'images':torch.tensor(ims).permute([0,3,1,2])/255.})
-            locs = self.get_joint_pred(preds)
+            preds = model_fn(ims)
+            if getattr(self, 'exported_decoded', False):
+                locs = self.decode_exported(preds)
+            else:
+                locs = self.get_joint_pred(preds)
             ret_dict = {}
             ret_dict['locs'] = locs['ref'] * conf.rescale
             ret_dict['locs_joint'] = locs['joint'] * conf.rescale
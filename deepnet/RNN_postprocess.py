@@ -14,6 +14,7 @@ import time
 import json
 import math
 import APT_interface as apt
+import trx_table
 
 def print_train_data(cur_dict):
     p_str = ''
@@ -22,6 +23,78 @@ def print_train_data(cur_dict):
     print(p_str)
 
 
+class PredCache(object):
+    ''' Predictions of the base network for the frames of one target in a movie.
+    Predictions for a frame don't depend on which labeled frame's window it is in (patches are centered
+    on the target in that frame), so each frame is predicted once, in one sequential pass over the movie,
+    and windows are gathered from the cache. Only predictions without augmentation can be cached.
+    '''
+
+    def __init__(self, frames, preds):
+        # frames: sorted 0-indexed frame numbers. preds: dict of arrays with predictions for each frame.
+        self.frames = np.asarray(frames)
+        self.preds = preds
+
+    @staticmethod
+    def window_frames(fnum, hist, cur_trx, n_frames):
+        ''' Frames that multiResData.read_frame reads for offsets -hist to hist-1 around fnum. '''
+        o_fnums = fnum + np.arange(-hist, hist)
+        if cur_trx is not None:
+            return np.clip(o_fnums, int(cur_trx['firstframe'][0, 0]) - 1, int(cur_trx['endframe'][0, 0]) - 1)
+        else:
+            return np.clip(o_fnums, 0, n_frames - 1)
+
+    @classmethod
+    def build(cls, pred_fn, conf, cap, cur_trx, frames, crop_loc=None, keys=('locs', 'locs_unet')):
+        ''' Predicts frames with pred_fn in one pass, in batches of conf.batch_size. The frames of
+        each batch are read together with cap.get_frames, in increasing order. '''
+        frames = np.unique(frames)
+        bsize = conf.batch_size
+        preds = {k: np.zeros([len(frames), conf.n_classes, 2]) for k in keys}
+        dummy_locs = np.zeros([conf.n_classes, 2])
+        for start in range(0, len(frames), bsize):
+            cur_frames = frames[start:start + bsize]
+            movie_frames = cap.get_frames(cur_frames)[0]
+            ims = []
+            for fnum, frame in zip(cur_frames, movie_frames):
+                frame_in, _ = multiResData.get_patch(cap, fnum, conf, dummy_locs, cur_trx=cur_trx,
+                                                     flipud=conf.flipud, crop_loc=crop_loc, frame=frame)
+                ims.append(frame_in)
+            n_cur = len(ims)
+            ims = np.array(ims + [np.zeros_like(ims[0])] * (bsize - n_cur))
+            cur_ims, _ = PoseTools.preprocess_ims(ims, np.zeros([bsize, conf.n_classes, 2]), conf,
+                                                  distort=False, scale=conf.rescale)
+            ret_dict = pred_fn(cur_ims)
+            for k in keys:
+                preds[k][start:start + n_cur] = ret_dict[k][:n_cur]
+        return cls(frames, preds)
+
+    def get(self, key, fnums):
+        idx = np.searchsorted(self.frames, fnums)
+        assert np.all(self.frames[np.minimum(idx, len(self.frames) - 1)] == fnums), 'Frames missing from the prediction cache'
+        return self.preds[key][idx]
+
+
+def align_window_preds(pred_locs, conf, fnum, cur_trx, hist):
+    ''' Brings the predictions for the window of frames around fnum (in the patch coordinates of their own
+    frames) into the patch coordinates of fnum, as done in RNN_pp.create_db. pred_locs is 2*hist x n_classes x 2.'''
+    if cur_trx is None:
+        return pred_locs.copy()
+    first_frame = int(cur_trx['firstframe'][0, 0]) - 1
+    end_ndx = int(cur_trx['endframe'][0, 0]) - 1 - first_frame
+    hsz = [float(conf.imsz[1]) / 2, float(conf.imsz[0]) / 2]
+    trx_fnum = fnum - first_frame
+    trx_fnum_ex = np.clip(trx_fnum + np.arange(-hist, hist), 0, end_ndx)
+    dx = cur_trx['x'][0, trx_fnum] - cur_trx['x'][0, trx_fnum_ex]
+    dy = cur_trx['y'][0, trx_fnum] - cur_trx['y'][0, trx_fnum_ex]
+    tt = cur_trx['theta'][0, trx_fnum] - cur_trx['theta'][0, trx_fnum_ex]
+    R = np.array([[np.cos(tt), -np.sin(tt)], [np.sin(tt), np.cos(tt)]]).transpose([2, 0, 1])
+    rr = cur_trx['theta'][0, trx_fnum] + math.pi / 2
+    Q = np.array([[np.cos(rr), -np.sin(rr)], [np.sin(rr), np.cos(rr)]])
+    shift = np.dot(np.stack([dx, dy], axis=-1), Q)
+    return np.matmul(pred_locs - hsz, R) + hsz - shift[:, np.newaxis, :]
+
+
 class RNN_pp(object):
 
 
@@ -40,6 +113,11 @@ class RNN_pp(object):
         self.net_type = 'conv'
         self.debug = False
         self.noise = 5
+        # Use base network predictions from a PredCache for windows without augmentation (ie validation
+        # examples). If cache_train_preds is True, training examples are also taken from the cache,
+        # with one unaugmented repeat each instead of train_rep augmented ones.
+        self.use_pred_cache = True
+        self.cache_train_preds = False
 
 
     def create_db(self, split_file=None):
@@ -79,7 +157,7 @@ class RNN_pp(object):
 
             if conf.has_trx_file:
                 trx_files = multiResData.get_trx_files(lbl, local_dirs, on_gt)
-                trx = sio.loadmat(trx_files[ndx])['trx'][0]
+                trx = trx_table.load_trx(trx_files[ndx])
                 n_trx = len(trx)
                 trx_split = np.random.random(n_trx) < conf.valratio
                 first_frames = np.array( [x['firstframe'][0, 0] for x in trx]) - 1  # for converting from 1 indexing to 0 indexing
@@ -94,9 +172,30 @@ class RNN_pp(object):
 
                 frames = multiResData.get_labeled_frames(lbl, ndx, trx_ndx, on_gt)
                 cur_trx = trx[trx_ndx]
-                for fnum in frames:
+                envs = [multiResData.get_cur_env(out_fns, split, conf, [ndx, fnum, trx_ndx], mov_split, trx_split=trx_split, predefined=predefined) for fnum in frames]
+                use_cache = [self.use_pred_cache and (self.cache_train_preds or not cur_out) for cur_out in envs]
+                if any(use_cache):
+                    # predict all the frames in the windows of these labeled frames in one pass
+                    cache_frames = [PredCache.window_frames(fnum, self.rnn_pp_hist, cur_trx, cap.get_n_frames()) for fnum, u in zip(frames, use_cache) if u]
+                    pred_cache = PredCache.build(pred_fn, conf, cap, cur_trx, np.concatenate(cache_frames), crop_loc=crop_loc)
+
+                for fnum, cur_out, from_cache in zip(frames, envs, use_cache):
                     info = [ndx, fnum, trx_ndx]
-                    cur_out = multiResData.get_cur_env(out_fns, split, conf, info, mov_split, trx_split=trx_split, predefined=predefined)
+                    if from_cache:
+                        if not multiResData.check_fnum(fnum, cap, dir_name, ndx):
+                            continue
+                        w_frames = PredCache.window_frames(fnum, self.rnn_pp_hist, cur_trx, cap.get_n_frames())
+                        raw_preds = pred_cache.get('locs', w_frames)
+                        cur_pred = align_window_preds(raw_preds, conf, fnum, cur_trx, self.rnn_pp_hist)
+                        frame_in, cur_loc = multiResData.get_patch(
+                            cap, fnum, conf, cur_pts[trx_ndx, fnum, :, sel_pts],
+                            cur_trx=cur_trx, flipud=flipud, crop_loc=crop_loc)
+                        _, cur_label = PoseTools.preprocess_ims(frame_in[np.newaxis, ...], cur_loc[np.newaxis, ...], conf,
+                                                                distort=False, scale=self.conf.rescale)
+                        data[0 if cur_out else 1].append([cur_pred, cur_label[0], info, raw_preds])
+                        count += 1
+                        continue
+
                     num_rep = 1 + cur_out*(self.train_rep-1)
 
                     orig_ims = []
@@ -0,0 +1,507 @@
+''' Offline throughput benchmarks for APT networks.
+
+Creates a synthetic project (fmf/ufmf/avi movies, optional trx and random labels)
+in a scratch directory, so that no lbl file or network access is needed, and
+measures for each network type:
+    db_rate     samples written to the training DB per second
+    aug_rate    augmented samples per second (PoseTools.preprocess_ims)
+    train_rate  training steps per second after warm-up, without graph creation and checkpointing
+    track_rate  tracked frames (targets) per second
+and the peak memory used by training (train_peak_rss_mb, and train_gpu_peak_mb on GPUs), which is
+recorded but not compared against the baseline.
+
+Results are written as json and optionally compared against a stored baseline.
+Typical use:
+    python apt_benchmark.py -cpu -out bench.json
+    python apt_benchmark.py -cpu -out bench_new.json -baseline bench.json
+'''
+
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import math
+import logging
+import argparse
+import tempfile
+import platform
+import datetime
+import easydict
+import numpy as np
+
+ALL_NETS = ['mdn', 'unet', 'openpose', 'leap', 'deeplabcut', 'dpk', 'multi_mdn_joint_torch']
+ALL_FORMATS = ['fmf', 'ufmf', 'avi']
+METRICS = ['db_rate', 'aug_rate', 'train_rate', 'track_rate']
+
+# Parameters that are normally read from the lbl file and that the networks expect.
+SYNTH_CONF_PARAMS = {
+    'leap_val_size': 0.15,
+    'leap_preshuffle': True,
+    'leap_filters': 64,
+    'leap_val_batches_per_epoch': 1,
+    'leap_reduce_lr_factor': 0.1,
+    'leap_reduce_lr_patience': 3,
+    'leap_reduce_lr_min_delta': 1e-5,
+    'leap_reduce_lr_cooldown': 0,
+    'leap_reduce_lr_min_lr': 1e-10,
+    'leap_amsgrad': False,
+    'leap_upsampling': False,
+    'use_leap_preprocessing': False,
+}
+
+
+def synth_trajectories(n_frames, n_animals, sz, rng):
+    ''' Smooth random walks for the animal centers and orientations. 0-indexed.'''
+    h, w = sz
+    margin = 0.2
+    x = np.zeros([n_animals, n_frames])
+    y = np.zeros([n_animals, n_frames])
+    theta = np.zeros([n_animals, n_frames])
+    for ndx in range(n_animals):
+        x0 = rng.uniform(margin * w, (1 - margin) * w)
+        y0 = rng.uniform(margin * h, (1 - margin) * h)
+        dx = np.cumsum(rng.normal(0, 1., n_frames))
+        dy = np.cumsum(rng.normal(0, 1., n_frames))
+        x[ndx, :] = np.clip(x0 + dx, margin * w, (1 - margin) * w)
+        y[ndx, :] = np.clip(y0 + dy, margin * h, (1 - margin) * h)
+        theta[ndx, :] = rng.uniform(-math.pi, math.pi) + np.cumsum(rng.normal(0, 0.05, n_frames))
+    return x, y, theta
+
+
+def synth_parts(x, y, theta, n_classes, body_len):
+    ''' Landmark locations on a line through the animal, rotated by theta.
+    Returns n_animals x n_frames x n_classes x 2.'''
+    offsets = np.linspace(-body_len / 2, body_len / 2, n_classes)
+    px = x[..., np.newaxis] + np.cos(theta)[..., np.newaxis] * offsets
+    py = y[..., np.newaxis] + np.sin(theta)[..., np.newaxis] * offsets
+    return np.stack([px, py], axis=-1)
+
+
+def render_frame(bg, parts, fnum, rng):
+    import cv2
+    im = bg.copy()
+    for a_ndx in range(parts.shape[0]):
+        pts = np.round(parts[a_ndx, fnum]).astype('int')
+        cv2.polylines(im, [pts.reshape([-1, 1, 2])], False, 220, 5)
+        for p in pts:
+            cv2.circle(im, (int(p[0]), int(p[1])), 3, 255, -1)
+    noise = rng.integers(0, 8, im.shape, dtype=np.uint8)
+    return cv2.add(im, noise)
+
+
+def write_movie(mov_file, fmt, frames, centers, radius):
+    ''' Writes the grayscale frames in fmt. centers are the animal centers per frame
+    (used to pick the foreground boxes for ufmf).'''
+    if fmt == 'fmf':
+        import FlyMovieFormat
+        saver = FlyMovieFormat.FlyMovieSaver(mov_file, version=1)
+        for ndx, im in enumerate(frames):
+            saver.add_frame(im, float(ndx))
+        saver.close()
+    elif fmt == 'ufmf':
+        import ufmf
+        bg = np.median(np.array(frames[:min(len(frames), 50)]), axis=0).astype('uint8')
+        saver = ufmf.UfmfSaverV1(mov_file, bg, 0., image_radius=radius)
+        for ndx, im in enumerate(frames):
+            saver.add_frame(im, float(ndx), centers[ndx])
+        saver.close()
+    elif fmt == 'avi':
+        import cv2
+        h, w = frames[0].shape
+        fourcc = cv2.VideoWriter_fourcc(*'MJPG')
+        writer = cv2.VideoWriter(mov_file, fourcc, 30., (w, h), isColor=False)
+        for im in frames:
+            writer.write(im)
+        writer.release()
+    else:
+        raise ValueError('Unknown movie format {}'.format(fmt))
+
+
+def write_trx(trx_file, x, y, theta, body_len):
+    ''' Saves a Ctrax style trx struct array. Values are 1-indexed.'''
+    from scipy import io as sio
+    n_animals, n_frames = x.shape
+    fields = ['x', 'y', 'theta', 'a', 'b', 'firstframe', 'endframe']
+    trx = np.zeros([1, n_animals], dtype=[(f, 'O') for f in fields])
+    for ndx in range(n_animals):
+        trx[0, ndx]['x'] = x[ndx:ndx + 1] + 1
+        trx[0, ndx]['y'] = y[ndx:ndx + 1] + 1
+        trx[0, ndx]['theta'] = theta[ndx:ndx + 1]
+        trx[0, ndx]['a'] = np.ones([1, n_frames]) * body_len / 4
+        trx[0, ndx]['b'] = np.ones([1, n_frames]) * body_len / 8
+        trx[0, ndx]['firstframe'] = np.array([[1.]])
+        trx[0, ndx]['endframe'] = np.array([[float(n_frames)]])
+    sio.savemat(trx_file, {'trx': trx})
+
+
+def create_synthetic_project(out_dir, formats=ALL_FORMATS, has_trx=True, n_frames=200,
+                             frame_sz=(256, 256), n_animals=2, n_classes=5, n_labeled=20, seed=0):
+    ''' Creates movies, trx files and random labels in out_dir.
+    Returns a dict with the movie list, trx list and the labels as a list of
+    [mov_ndx, frame, trx_ndx, locs] with everything 0-indexed.'''
+    rng = np.random.default_rng(seed)
+    body_len = min(frame_sz) / 8
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    proj = {'movies': [], 'trx': [], 'labels': [], 'n_classes': n_classes,
+            'frame_sz': frame_sz, 'n_frames': n_frames, 'n_animals': n_animals,
+            'has_trx': has_trx, 'body_len': body_len}
+    for mov_ndx, fmt in enumerate(formats):
+        x, y, theta = synth_trajectories(n_frames, n_animals, frame_sz, rng)
+        parts = synth_parts(x, y, theta, n_classes, body_len)
+        bg = rng.integers(20, 60, frame_sz, dtype=np.uint8)
+        frames = [render_frame(bg, parts, f, rng) for f in range(n_frames)]
+        radius = int(body_len)
+        centers = [[(x[a, f], y[a, f]) for a in range(n_animals)] for f in range(n_frames)]
+        mov_file = os.path.join(out_dir, 'movie_{}.{}'.format(mov_ndx, fmt))
+        write_movie(mov_file, fmt, frames, centers, radius)
+        proj['movies'].append(mov_file)
+
+        if has_trx:
+            trx_file = os.path.join(out_dir, 'movie_{}_trx.mat'.format(mov_ndx))
+            write_trx(trx_file, x, y, theta, body_len)
+            proj['trx'].append(trx_file)
+        else:
+            proj['trx'].append(None)
+
+        # leave a few frames at either end so that augmentation has room
+        lbl_frames = rng.choice(np.arange(2, n_frames - 2), n_labeled, replace=False)
+        for fnum in sorted(lbl_frames.tolist()):
+            if has_trx:
+                for a_ndx in range(n_animals):
+                    proj['labels'].append([mov_ndx, fnum, a_ndx, parts[a_ndx, fnum]])
+            else:
+                proj['labels'].append([mov_ndx, fnum, 0, parts[:, fnum]])
+    return proj
+
+
+def create_synthetic_conf(proj, cache_dir, net_type, batch_size=4, n_steps=20, patch_sz=96):
+    ''' Builds the conf directly, bypassing create_conf and the lbl file.'''
+    from poseConfig import config
+    conf = config()
+    conf.set_exp_name('apt_benchmark')
+    conf.n_classes = proj['n_classes']
+    conf.selpts = np.arange(conf.n_classes)
+    conf.nviews = 1
+    conf.view = 0
+    conf.img_dim = 1
+    conf.has_trx_file = proj['has_trx']
+    if conf.has_trx_file:
+        conf.imsz = (patch_sz, patch_sz)
+    else:
+        conf.imsz = tuple(proj['frame_sz'])
+    conf.sel_sz = min(conf.imsz)
+    conf.labelfile = ''
+    conf.project_file = ''
+    conf.cachedir = os.path.join(cache_dir, net_type)
+    if not os.path.exists(conf.cachedir):
+        os.makedirs(conf.cachedir)
+    conf.batch_size = batch_size
+    conf.dl_steps = n_steps
+    conf.display_step = max(1, n_steps // 2)
+    conf.save_step = n_steps
+    conf.save_td_step = n_steps
+    conf.maxckpt = 2
+    conf.mdn_groups = [(i,) for i in range(conf.n_classes)]
+    conf.op_affinity_graph = [[i, i + 1] for i in range(conf.n_classes - 1)]
+    conf.unet_rescale = conf.rescale
+    conf.leap_rescale = conf.rescale
+    for k, v in SYNTH_CONF_PARAMS.items():
+        setattr(conf, k, v)
+    if net_type.startswith('multi_'):
+        conf.max_n_animals = proj['n_animals']
+        conf.has_trx_file = False
+        conf.imsz = tuple(proj['frame_sz'])
+    elif net_type == 'dpk':
+        import apt_dpk
+        apt_dpk.update_conf_dpk_from_affgraph_flm(conf)
+    return conf
+
+
+def get_db_fn(proj):
+    ''' db_fn for APT_interface.create_* that feeds the synthetic labels through the
+    usual patch extraction.'''
+    import movies
+    import multiResData
+    import APT_interface as apt
+
+    def db_fn(conf, out_fns, split, split_file):
+        splits = [[], []]
+        prev_mov = None
+        cap = None
+        for mov_ndx, fnum, trx_ndx, locs in proj['labels']:
+            if mov_ndx != prev_mov:
+                if cap is not None:
+                    cap.close()
+                cap = movies.Movie(proj['movies'][mov_ndx])
+                prev_mov = mov_ndx
+            cur_trx, _ = apt.get_cur_trx(proj['trx'][mov_ndx], trx_ndx) if conf.has_trx_file else (None, 1)
+            frame_in, cur_loc = multiResData.get_patch(cap, fnum, conf, locs.copy(), cur_trx=cur_trx,
+                                                       flipud=conf.flipud, crop_loc=None)
+            info = [int(mov_ndx), int(fnum), int(trx_ndx)]
+            out_fns[0]([frame_in, cur_loc, info])
+            splits[0].append(info)
+        if cap is not None:
+            cap.close()
+        return splits
+
+    return db_fn
+
+
+def tf_serialize_multi(data):
+    ''' Serializes a multi-animal example in the format read by
+    multiResData.read_and_decode_without_session_multi.'''
+    from multiResData import float_feature, int64_feature, bytes_feature
+    from APT_interface import tf
+    frame_in, cur_loc, info, occ, mask = data
+    rows, cols, depth = frame_in.shape
+    expid, fnum, trxid = info
+    example = tf.train.Example(features=tf.train.Features(feature={
+        'height': int64_feature(rows),
+        'width': int64_feature(cols),
+        'depth': int64_feature(depth),
+        'trx_ndx': int64_feature(trxid),
+        'locs': float_feature(cur_loc.flatten()),
+        'expndx': float_feature(expid),
+        'ts': float_feature(fnum),
+        'image_raw': bytes_feature(frame_in.tostring()),
+        'occ': float_feature(occ.flatten()),
+        'max_n': int64_feature(cur_loc.shape[0]),
+        'mask': bytes_feature(mask.astype(np.uint8).tostring()),
+    }))
+    return example.SerializeToString()
+
+
+def build_db(conf, net_type, proj):
+    ''' Writes the training DB for net_type. Returns the number of samples written.'''
+    import APT_interface as apt
+    import movies
+    db_fn = get_db_fn(proj)
+    if net_type == 'leap':
+        apt.create_leap_db(conf, split=False, db_fn=db_fn)
+        return len(proj['labels'])
+    elif net_type == 'deeplabcut':
+        apt.create_deepcut_db(conf, split=False, db_fn=db_fn)
+        return len(proj['labels'])
+    elif net_type.startswith('multi_'):
+        env = apt.tf.python_io.TFRecordWriter(os.path.join(conf.cachedir, conf.trainfilename) + '.tfrecords')
+        count = 0
+        by_frame = {}
+        for mov_ndx, fnum, trx_ndx, locs in proj['labels']:
+            by_frame.setdefault((mov_ndx, fnum), []).append(locs)
+        for (mov_ndx, fnum), all_locs in sorted(by_frame.items()):
+            cap = movies.Movie(proj['movies'][mov_ndx])
+            im = cap.get_frame(fnum)[0]
+            cap.close()
+            if im.ndim == 2:
+                im = im[..., np.newaxis]
+            im = im[..., :conf.img_dim]
+            locs = np.ones([conf.max_n_animals, conf.n_classes, 2]) * -100000
+            locs[:len(all_locs)] = np.array(all_locs)
+            occ = np.zeros([conf.max_n_animals, conf.n_classes])
+            mask = np.ones(im.shape[:2])
+            env.write(tf_serialize_multi([im, locs, [mov_ndx, fnum, 0], occ, mask]))
+            count += 1
+        env.close()
+        return count
+    else:
+        apt.create_tfrecord(conf, split=False, use_cache=False, db_fn=db_fn)
+        return len(proj['labels'])
+
+
+def bench_aug(conf, proj, n_batches=10):
+    ''' Returns augmented samples per second using the standard preprocessing.'''
+    import PoseTools
+    import multiResData
+    db_file = os.path.join(conf.cachedir, conf.trainfilename) + '.tfrecords'
+    if not os.path.exists(db_file):
+        return np.nan
+    ims, locs, _, _ = multiResData.read_and_decode_without_session(db_file, conf.n_classes, ())
+    ims = np.array(ims)
+    locs = np.array(locs)
+    bsize = conf.batch_size
+    start = time.time()
+    for b in range(n_batches):
+        sel = np.random.choice(ims.shape[0], bsize)
+        PoseTools.preprocess_ims(ims[sel], locs[sel], conf, True, conf.rescale)
+    return n_batches * bsize / (time.time() - start)
+
+
+def bench_train(conf, net_type, n_warmup=5):
+    ''' Returns training steps per second after warm-up, and a dict with the peak memory used.
+    Training is run for n_warmup and for n_warmup + conf.dl_steps steps, and the rate is computed
+    from the difference in time, so that graph creation, the first (slow) steps and checkpointing,
+    which are the same in both runs, are not included.
+    The peak RSS is of this process, so it includes the networks benchmarked before this one.'''
+    import resource
+    import APT_interface as apt
+    args = easydict.EasyDict({'skip_db': True, 'use_cache': False, 'train_name': 'deepnet', 'use_defaults': False})
+    n_steps = conf.dl_steps
+    step_params = {k: getattr(conf, k) for k in ['dl_steps', 'display_step', 'save_step', 'save_td_step']}
+    _, _, gpu_id = apt.get_track_device()
+    apt.reset_track_mem_stats()
+    times = []
+    for cur_steps in [n_warmup, n_warmup + n_steps]:
+        for k in step_params.keys():
+            setattr(conf, k, cur_steps)
+        start = time.time()
+        apt.train_net(net_type, conf, args)
+        times.append(time.time() - start)
+    for k, v in step_params.items():
+        setattr(conf, k, v)
+    mem = {'train_peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+           'train_gpu_peak_mb': None if gpu_id is None else apt.get_track_mem_used(gpu_id)}
+    return n_steps / max(times[1] - times[0], 1e-6), mem
+
+
+def bench_track(conf, net_type, proj, out_dir, max_frames=100):
+    ''' Returns tracked (frame, target) pairs per second for the first movie.'''
+    import APT_interface as apt
+    import movies
+    pred_fn, close_fn, model_file = apt.get_pred_fn(net_type, conf)
+    mov_file = proj['movies'][0]
+    end_frame = min(max_frames, proj['n_frames'])
+    start = time.time()
+    if net_type.startswith('multi_'):
+        cap = movies.Movie(mov_file)
+        bsize = conf.batch_size
+        for b_start in range(0, end_frame, bsize):
+            ims = np.zeros((bsize,) + tuple(conf.imsz) + (conf.img_dim,))
+            for ndx in range(min(bsize, end_frame - b_start)):
+                im = cap.get_frame(b_start + ndx)[0]
+                ims[ndx, ...] = im.reshape(im.shape[:2] + (-1,))[..., :conf.img_dim]
+            pred_fn(ims)
+        cap.close()
+        n_tracked = end_frame
+    else:
+        out_file = os.path.join(out_dir, '{}_track.trk'.format(net_type))
+        apt.classify_movie(conf, pred_fn, net_type, mov_file=mov_file, out_file=out_file,
+                           trx_file=proj['trx'][0], start_frame=0, end_frame=end_frame,
+                           model_file=model_file, name='apt_benchmark')
+        n_tracked = end_frame * (proj['n_animals'] if conf.has_trx_file else 1)
+    elapsed = time.time() - start
+    close_fn()
+    return n_tracked / elapsed
+
+
+def run_net(net_type, proj, work_dir, args):
+    ''' Runs all the benchmarks for a single net type. Failures are recorded, not raised,
+    so that one broken network does not hide the numbers for the others.'''
+    res = {k: np.nan for k in METRICS}
+    res['error'] = None
+    try:
+        conf = create_synthetic_conf(proj, work_dir, net_type, batch_size=args.batch_size,
+                                     n_steps=args.train_steps, patch_sz=args.patch_sz)
+        start = time.time()
+        n = build_db(conf, net_type, proj)
+        res['db_rate'] = n / (time.time() - start)
+        if net_type not in ['leap', 'deeplabcut']:
+            res['aug_rate'] = bench_aug(conf, proj)
+        res['train_rate'], train_mem = bench_train(conf, net_type, n_warmup=args.train_warmup)
+        res.update(train_mem)
+        res['track_rate'] = bench_track(conf, net_type, proj, work_dir, max_frames=args.track_frames)
+    except Exception as e:
+        logging.exception('Benchmark for {} failed'.format(net_type))
+        res['error'] = repr(e)
+    res = {k: (None if isinstance(v, float) and np.isnan(v) else v) for k, v in res.items()}
+    return res
+
+
+def compare_to_baseline(results, baseline, tol):
+    ''' Returns a list of (net, metric, baseline, current) that dropped below
+    (1-tol) times the baseline.'''
+    regressions = []
+    for net, cur in results['nets'].items():
+        if net not in baseline['nets']:
+            continue
+        base = baseline['nets'][net]
+        for m in METRICS:
+            b = base.get(m)
+            c = cur.get(m)
+            if b is None:
+                continue
+            if c is None or c < (1 - tol) * b:
+                regressions.append((net, m, b, c))
+    return regressions
+
+
+def get_env_info(cpu_only):
+    info = {'python': platform.python_version(),
+            'machine': platform.machine(),
+            'node': platform.node(),
+            'cpu_only': cpu_only,
+            'date': datetime.datetime.now().strftime('%Y%m%dT%H%M%S')}
+    try:
+        import PoseTools
+        info['git_commit'] = PoseTools.get_git_commit()
+    except Exception:
+        info['git_commit'] = None
+    return info
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Offline throughput benchmarks for APT networks')
+    parser.add_argument('-out', dest='out_file', help='json file to write the results to', required=True)
+    parser.add_argument('-baseline', dest='baseline', help='json file with baseline results to compare against', default=None)
+    parser.add_argument('-tol', dest='tol', help='allowed fractional drop in any rate before it is flagged', type=float, default=0.2)
+    parser.add_argument('-nets', dest='nets', nargs='*', default=ALL_NETS, help='network types to benchmark')
+    parser.add_argument('-formats', dest='formats', nargs='*', default=ALL_FORMATS, choices=ALL_FORMATS)
+    parser.add_argument('-no_trx', dest='no_trx', action='store_true', help='create a project without trx files')
+    parser.add_argument('-cpu', dest='cpu', action='store_true', help='hide all GPUs')
+    parser.add_argument('-work_dir', dest='work_dir', default=None, help='scratch directory. Default: a new temp dir')
+    parser.add_argument('-n_frames', dest='n_frames', type=int, default=200)
+    parser.add_argument('-n_labeled', dest='n_labeled', type=int, default=20, help='labeled frames per movie')
+    parser.add_argument('-n_classes', dest='n_classes', type=int, default=5)
+    parser.add_argument('-n_animals', dest='n_animals', type=int, default=2)
+    parser.add_argument('-frame_sz', dest='frame_sz', type=int, nargs=2, default=[256, 256])
+    parser.add_argument('-patch_sz', dest='patch_sz', type=int, default=96)
+    parser.add_argument('-batch_size', dest='batch_size', type=int, default=4)
+    parser.add_argument('-train_steps', dest='train_steps', type=int, default=20, help='timed training steps, after the warm-up steps')
+    parser.add_argument('-train_warmup', dest='train_warmup', type=int, default=5, help='training steps that are not timed')
+    parser.add_argument('-track_frames', dest='track_frames', type=int, default=100)
+    parser.add_argument('-seed', dest='seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    if args.cpu:
+        # has to happen before tensorflow/torch are imported
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)-5.5s] %(message)s')
+
+    work_dir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp()
+    logging.info('Creating synthetic project in {}'.format(work_dir))
+    proj = create_synthetic_project(os.path.join(work_dir, 'movies'), formats=args.formats,
+                                    has_trx=not args.no_trx, n_frames=args.n_frames,
+                                    frame_sz=tuple(args.frame_sz), n_animals=args.n_animals,
+                                    n_classes=args.n_classes, n_labeled=args.n_labeled, seed=args.seed)
+
+    results = {'env': get_env_info(args.cpu), 'settings': vars(args), 'nets': {}}
+    for net_type in args.nets:
+        logging.info('Benchmarking {}'.format(net_type))
+        results['nets'][net_type] = run_net(net_type, proj, os.path.join(work_dir, 'cache'), args)
+        logging.info('{}: {}'.format(net_type, results['nets'][net_type]))
+
+    ret = 0
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.tol)
+        results['regressions'] = [list(r) for r in regressions]
+        for net, m, b, c in regressions:
+            logging.warning('REGRESSION {} {}: baseline {} current {}'.format(net, m, b, c))
+        ret = 1 if len(regressions) > 0 else 0
+
+    with open(args.out_file, 'w') as f:
+        json.dump(results, f, indent=2)
+    logging.info('Results saved to {}'.format(args.out_file))
+    return ret
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,380 @@
+''' Local cross-validation runner for APT projects.
+
+Runs n-fold cross-validation for one or more network types on a single workstation:
+    - the cropped image set is built once per view from the lbl file (or its image cache)
+      and saved as cv_images.h5,
+    - the folds are created with APT_interface.create_cv_split_files and each fold's
+      train/val DBs are derived from the image set by (movie, frame, target) index,
+    - every (view, fold, net) job is trained and evaluated on the held out fold in its own
+      process. Jobs are packed onto the available GPUs (or CPU cores with -cpu) using a
+      memory estimate, so that several small jobs can share a device.
+Per fold errors and a summary per network are written to a single json file.
+Typical use:
+    python apt_cv.py proj.lbl -nets mdn deeplabcut -n_splits 3 -out cv.json
+    python apt_cv.py proj.lbl -nets mdn -gpus 0 1 -job_mem 4 -out cv.json
+'''
+
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import logging
+import queue
+import argparse
+import traceback
+import subprocess
+import multiprocessing
+import easydict
+
+# Rough activation memory per input pixel per example while training (bytes).
+# Used only to decide how many jobs fit on a device. Use -job_mem to override.
+NET_MEM_PER_PX = {
+    'mdn': 10e3,
+    'unet': 8e3,
+    'openpose': 12e3,
+    'leap': 4e3,
+    'deeplabcut': 8e3,
+    'dpk': 6e3,
+}
+DEFAULT_MEM_PER_PX = 10e3
+# framework, weights and optimizer state
+JOB_MEM_OVERHEAD = 1.5e9
+PCTILES = [50, 75, 90, 95, 97]
+
+
+def build_image_set(conf, out_file, use_cache=False):
+    ''' Writes all the labeled examples (already cropped as for training) to out_file.
+    Returns the number of examples.'''
+    import numpy as np
+    import h5py
+    import APT_interface as apt
+
+    data = []
+    out_fns = [lambda d: data.append(d), lambda d: data.append(d)]
+    if use_cache:
+        apt.db_from_cached_lbl(conf, out_fns, split=False)
+    else:
+        apt.db_from_lbl(conf, out_fns, split=False)
+
+    ims = np.array([d[0] for d in data])
+    locs = np.array([d[1] for d in data])
+    info = np.array([d[2] for d in data], dtype='int64').reshape([-1, 3])
+    occ = np.array([d[3] if len(d) > 3 else np.zeros(d[1].shape[:-1]) for d in data])
+    with h5py.File(out_file, 'w') as f:
+        f.create_dataset('ims', data=ims)
+        f.create_dataset('locs', data=locs)
+        f.create_dataset('info', data=info)
+        f.create_dataset('occ', data=occ)
+    return len(data)
+
+
+def get_fold_db_fn(data_file, val_info):
+    ''' db_fn for APT_interface.create_* that writes the examples of the image set.
+    Examples in val_info go to the val DB when splitting and are dropped otherwise, so that
+    they are never used for training.'''
+    import h5py
+
+    val_set = set(tuple(int(x) for x in i) for i in val_info)
+
+    def db_fn(conf, out_fns, split, split_file):
+        splits = [[], []]
+        with h5py.File(data_file, 'r') as f:
+            info = f['info'][()]
+            for ndx in range(info.shape[0]):
+                cur_info = [int(x) for x in info[ndx]]
+                is_val = tuple(cur_info) in val_set
+                if is_val and not split:
+                    continue
+                data = [f['ims'][ndx], f['locs'][ndx], cur_info, f['occ'][ndx]]
+                out_fns[1 if is_val else 0](data)
+                splits[1 if is_val else 0].append(cur_info)
+        return splits
+
+    return db_fn
+
+
+def create_fold_db(conf, net_type, db_fn):
+    import APT_interface as apt
+    if net_type == 'leap':
+        apt.create_leap_db(conf, split=True, db_fn=db_fn)
+    elif net_type == 'deeplabcut':
+        apt.create_deepcut_db(conf, split=True, db_fn=db_fn)
+    else:
+        apt.create_tfrecord(conf, split=True, use_cache=False, db_fn=db_fn)
+
+
+def get_val_file(conf, net_type):
+    import APT_interface as apt
+    if net_type in ['leap', 'deeplabcut']:
+        return os.path.join(conf.cachedir, apt.get_valfilename(conf, net_type))
+    else:
+        return os.path.join(conf.cachedir, conf.valfilename + '.tfrecords')
+
+
+def fold_errors(preds, locs):
+    ''' Per example, per landmark euclidean error. Unlabeled landmarks are nan.'''
+    import numpy as np
+    preds = np.array(preds)
+    locs = np.array(locs)
+    return np.sqrt(np.sum((preds - locs) ** 2, axis=-1))
+
+
+def error_metrics(dd):
+    import numpy as np
+    if dd.size == 0 or np.all(np.isnan(dd)):
+        return {'n': int(dd.shape[0])}
+    return {'n': int(dd.shape[0]),
+            'mean': float(np.nanmean(dd)),
+            'median': float(np.nanmedian(dd)),
+            'mean_per_landmark': np.nanmean(dd, axis=0).tolist(),
+            'pctiles': PCTILES,
+            'pctiles_per_landmark': np.nanpercentile(dd, PCTILES, axis=0).T.tolist()}
+
+
+def estimate_job_mem(conf, net_type):
+    ''' Rough peak memory in bytes for training net_type with conf.'''
+    rescale = conf.get('rescale', 1)
+    n_px = float(conf.imsz[0]) * conf.imsz[1] / rescale ** 2
+    per_px = NET_MEM_PER_PX.get(net_type, DEFAULT_MEM_PER_PX)
+    return JOB_MEM_OVERHEAD + conf.batch_size * n_px * per_px
+
+
+def get_devices(gpus=None, cpu=False, max_cpu_jobs=None):
+    ''' Returns the devices that jobs can be packed onto as dicts with name, mem (bytes),
+    max_jobs and env (set in the job process).'''
+    if not cpu:
+        try:
+            out = subprocess.check_output(['nvidia-smi', '--query-gpu=index,memory.total',
+                                           '--format=csv,noheader,nounits'])
+            all_gpus = {}
+            for line in out.decode().strip().split('\n'):
+                ndx, mem = [x.strip() for x in line.split(',')]
+                all_gpus[int(ndx)] = float(mem) * 1024 ** 2
+        except (OSError, subprocess.CalledProcessError, ValueError):
+            all_gpus = {}
+        if gpus is None:
+            gpus = sorted(all_gpus.keys())
+        devices = [{'name': 'gpu{}'.format(g), 'mem': all_gpus.get(g, float('inf')), 'max_jobs': None,
+                    'env': {'CUDA_VISIBLE_DEVICES': str(g)}} for g in gpus]
+        if len(devices) > 0:
+            return devices
+        logging.warning('No GPUs found. Running on the CPU')
+
+    n_cores = multiprocessing.cpu_count()
+    max_cpu_jobs = max_cpu_jobs or max(1, n_cores // 4)
+    n_threads = str(max(1, n_cores // max_cpu_jobs))
+    try:
+        mem = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') * 0.8
+    except (ValueError, OSError, AttributeError):
+        mem = float('inf')
+    return [{'name': 'cpu', 'mem': mem, 'max_jobs': max_cpu_jobs,
+             'env': {'CUDA_VISIBLE_DEVICES': '', 'OMP_NUM_THREADS': n_threads, 'MKL_NUM_THREADS': n_threads}}]
+
+
+def pick_device(job, devices, used, running):
+    ''' First device with enough free memory. A job that doesn't fit on any device runs
+    alone on the largest one.'''
+    for d in devices:
+        name = d['name']
+        if d['max_jobs'] is not None and running[name] >= d['max_jobs']:
+            continue
+        if used[name] + job['mem'] <= d['mem']:
+            return d
+    largest = max(devices, key=lambda d: d['mem'])
+    if job['mem'] > largest['mem'] and running[largest['name']] == 0:
+        return largest
+    return None
+
+
+def run_job(job, env, out_queue):
+    ''' Trains job['net'] on the train part of job['fold'] and classifies the held out
+    examples. Runs in its own process.'''
+    # has to happen before tensorflow/torch initialize the devices
+    os.environ.update(env)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)-5.5s] %(message)s')
+    res = {'view': job['view'], 'fold': job['fold'], 'net': job['net'], 'error': None}
+    start = time.time()
+    try:
+        import hdf5storage
+        import APT_interface as apt
+        net_type = job['net']
+        conf = apt.create_conf(job['lbl_file'], job['view'], job['name'], cache_dir=job['cache'],
+                               net_type=net_type, conf_params=job['conf_params'], quiet=True)
+        conf.view = job['view']
+        create_fold_db(conf, net_type, get_fold_db_fn(job['data_file'], job['val_info']))
+        args = easydict.EasyDict({'skip_db': True, 'use_cache': False, 'use_defaults': job['use_defaults'],
+                                  'train_name': 'deepnet'})
+        apt.train_net(net_type, conf, args)
+        res['train_time'] = time.time() - start
+
+        preds, locs, info, model_file = apt.classify_db_all(net_type, conf, get_val_file(conf, net_type))
+        dd = fold_errors(preds, locs)
+        out_file = os.path.join(conf.cachedir, 'cv_val_preds.mat')
+        hdf5storage.savemat(out_file, {'preds': apt.to_mat(preds), 'locs': apt.to_mat(locs),
+                                       'info': apt.to_mat(info), 'model_file': model_file},
+                            appendmat=False, truncate_existing=True)
+        res.update({'metrics': error_metrics(dd), 'errors': dd.tolist(),
+                    'model_file': model_file, 'preds_file': out_file})
+    except Exception:
+        logging.exception('CV job {} failed'.format(job['id']))
+        res['error'] = traceback.format_exc()
+    res['time'] = time.time() - start
+    out_queue.put((job['id'], res))
+
+
+def schedule(jobs, devices, poll_interval=5.):
+    ''' Runs the jobs in separate processes packed onto the devices by their memory
+    estimate, largest first. Returns the results by job id.'''
+    ctx = multiprocessing.get_context('spawn')
+    out_queue = ctx.Queue()
+    pending = sorted(jobs, key=lambda j: -j['mem'])
+    used = {d['name']: 0. for d in devices}
+    running = {d['name']: 0 for d in devices}
+    procs = {}
+    results = {}
+    while len(pending) > 0 or len(procs) > 0:
+        for job in list(pending):
+            d = pick_device(job, devices, used, running)
+            if d is None:
+                continue
+            p = ctx.Process(target=run_job, args=(job, d['env'], out_queue))
+            p.start()
+            logging.info('Started {} on {} (estimated {:.1f}GB)'.format(job['id'], d['name'], job['mem'] / 1e9))
+            procs[job['id']] = (p, d['name'], job)
+            used[d['name']] += job['mem']
+            running[d['name']] += 1
+            pending.remove(job)
+
+        finished = []
+        try:
+            job_id, res = out_queue.get(timeout=poll_interval)
+            res['device'] = procs[job_id][1]
+            results[job_id] = res
+            finished.append(job_id)
+        except queue.Empty:
+            # check for jobs that died without reporting
+            for job_id, (p, _, _) in procs.items():
+                if not p.is_alive() and job_id not in results:
+                    results[job_id] = {'error': 'Process exited with code {}'.format(p.exitcode),
+                                       'device': procs[job_id][1]}
+                    finished.append(job_id)
+
+        for job_id in finished:
+            p, name, job = procs.pop(job_id)
+            p.join()
+            used[name] -= job['mem']
+            running[name] -= 1
+            logging.info('Finished {}{}'.format(job_id, '' if results[job_id].get('error') is None else ' with errors'))
+    return results
+
+
+def summarize(jobs, results):
+    ''' Pools the per fold errors for each view and net.'''
+    import numpy as np
+    summary = {}
+    for job in jobs:
+        res = results.get(job['id'], {})
+        key = '{}_view{}'.format(job['net'], job['view'])
+        cur = summary.setdefault(key, {'errors': [], 'failed_folds': []})
+        if res.get('error') is not None or 'errors' not in res:
+            cur['failed_folds'].append(job['fold'])
+        elif len(res['errors']) > 0:
+            cur['errors'].append(np.array(res['errors'], dtype='float'))
+    for key, cur in summary.items():
+        dd = np.concatenate(cur.pop('errors'), axis=0) if len(cur['errors']) > 0 else np.zeros([0])
+        cur.update(error_metrics(dd))
+    return summary
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Local cross-validation for APT projects')
+    parser.add_argument('lbl_file', help='path to lbl file')
+    parser.add_argument('-out', dest='out_file', help='json file to write the results to', required=True)
+    parser.add_argument('-nets', dest='nets', nargs='+', default=['mdn'], help='network types to cross-validate')
+    parser.add_argument('-n_splits', dest='n_splits', type=int, default=3)
+    parser.add_argument('-name', dest='name', default='cv', help='name for the run. Folds are saved as <name>_fold<k>')
+    parser.add_argument('-view', dest='view', type=int, default=None, help='1-indexed view. Default all views')
+    parser.add_argument('-cache', dest='cache', default=None, help='override cachedir in lbl file')
+    parser.add_argument('-conf_params', dest='conf_params', default=None, nargs='*',
+                        help='conf params. These will override params from lbl file')
+    parser.add_argument('-use_cache', dest='use_cache', action='store_true',
+                        help='use cached images in the label file to build the image set')
+    parser.add_argument('-use_defaults', dest='use_defaults', action='store_true',
+                        help='use default settings of deeplabcut or leap')
+    parser.add_argument('-gpus', dest='gpus', type=int, nargs='*', default=None, help='GPUs to use. Default all')
+    parser.add_argument('-cpu', dest='cpu', action='store_true', help='run on the CPU')
+    parser.add_argument('-max_cpu_jobs', dest='max_cpu_jobs', type=int, default=None,
+                        help='jobs to run at the same time on the CPU. Default a quarter of the cores')
+    parser.add_argument('-job_mem', dest='job_mem', type=float, default=None,
+                        help='memory per job in GB. Default an estimate from the image and batch size')
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    # the image set is built here, the devices are only used by the jobs
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)-5.5s] %(message)s')
+    import h5py
+    import APT_interface as apt
+
+    with h5py.File(args.lbl_file, 'r') as lbl:
+        nviews = int(apt.read_entry(lbl['cfg']['NumViews']))
+    views = range(nviews) if args.view is None else [args.view - 1]
+
+    splits = None
+    jobs = []
+    for view in views:
+        conf = apt.create_conf(args.lbl_file, view, args.name, cache_dir=args.cache, net_type=args.nets[0],
+                               conf_params=args.conf_params)
+        conf.view = view
+        if splits is None:
+            # same folds for all the views
+            splits = apt.create_cv_split_files(conf, args.n_splits)
+            if splits is None:
+                logging.error('Could not create the cross-validation splits')
+                return 1
+        data_file = os.path.join(conf.cachedir, 'cv_images.h5')
+        start = time.time()
+        n = build_image_set(conf, data_file, use_cache=args.use_cache)
+        logging.info('View {}: {} examples written to {} in {:.1f}s'.format(view + 1, n, data_file, time.time() - start))
+
+        for fold in range(args.n_splits):
+            for net_type in args.nets:
+                if args.job_mem is not None:
+                    mem = args.job_mem * 1e9
+                else:
+                    mem = estimate_job_mem(conf, net_type)
+                jobs.append({'id': '{}_view{}_fold{}'.format(net_type, view + 1, fold),
+                             'net': net_type, 'view': view, 'fold': fold, 'mem': mem,
+                             'name': '{}_fold{}'.format(args.name, fold),
+                             'lbl_file': args.lbl_file, 'cache': args.cache, 'conf_params': args.conf_params,
+                             'use_defaults': args.use_defaults, 'data_file': data_file,
+                             'val_info': [list(i) for i in splits[1][fold]]})
+
+    devices = get_devices(args.gpus, args.cpu, args.max_cpu_jobs)
+    logging.info('Running {} jobs on {}'.format(len(jobs), ', '.join(d['name'] for d in devices)))
+    start = time.time()
+    results = schedule(jobs, devices)
+
+    out = {'settings': vars(args),
+           'time': time.time() - start,
+           'summary': summarize(jobs, results),
+           'folds': []}
+    for job in jobs:
+        res = dict(results.get(job['id'], {}))
+        res.pop('errors', None)
+        res.update({'id': job['id'], 'net': job['net'], 'view': job['view'] + 1, 'fold': job['fold'],
+                    'n_val': len(job['val_info']), 'mem_estimate': job['mem']})
+        out['folds'].append(res)
+    with open(args.out_file, 'w') as f:
+        json.dump(out, f, indent=2)
+    logging.info('Results saved to {}'.format(args.out_file))
+    return 1 if any(r.get('error') is not None for r in out['folds']) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,157 @@
+''' Background writing of training checkpoints and training info.
+
+CheckpointWriter runs save jobs on a background thread so that serializing checkpoints and
+training info doesn't stall training. Jobs run in the order they are submitted. A job submitted
+with a key replaces a queued (not yet started) job with the same key, so that training info
+that is rewritten every display step is written only once if the disk falls behind.
+atomic_write writes to a temporary file and renames it over the target, so readers (and
+restarts after a crash) never see partially written files.
+
+save_td queues the full training info (pickle used for restoring and a json copy) and appends the
+new entries to <train_data_file>.jsonl, one json dict per display step, which can be tailed to
+monitor training without rereading the whole history.
+
+BackgroundSaveMixin gives the PoseCommon classes a writer (get_writer), save_td and
+wait_for_saves. The classes only implement get_td_file.
+'''
+
+import os
+import json
+import pickle
+import atexit
+import logging
+import threading
+import collections
+import numpy as np
+
+
+class CheckpointWriter(object):
+
+    def __init__(self, async_write=True):
+        ''' If async_write is False, jobs are run when they are submitted.'''
+        self.async_write = async_write
+        self.jobs = collections.deque()
+        self.busy = False
+        self.error = None
+        self.cond = threading.Condition()
+        self.thread = None
+        if async_write:
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+            # don't lose queued checkpoints when training exits without waiting
+            atexit.register(self.wait)
+
+    def submit(self, fn, key=None):
+        ''' Queues fn() to be run on the writer thread.'''
+        self._check_error()
+        if not self.async_write:
+            fn()
+            return
+        with self.cond:
+            replaced = False
+            if key is not None:
+                for ndx, (k, _) in enumerate(self.jobs):
+                    if k == key:
+                        self.jobs[ndx] = (key, fn)
+                        replaced = True
+                        break
+            if not replaced:
+                self.jobs.append((key, fn))
+            self.cond.notify_all()
+
+    def wait(self):
+        ''' Blocks till all the queued jobs are written.'''
+        if self.async_write:
+            with self.cond:
+                while len(self.jobs) > 0 or self.busy:
+                    self.cond.wait()
+        self._check_error()
+
+    def _check_error(self):
+        if self.error is not None:
+            err = self.error
+            self.error = None
+            raise RuntimeError('Error while saving in the background: {}'.format(err))
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while len(self.jobs) == 0:
+                    self.cond.wait()
+                _, fn = self.jobs.popleft()
+                self.busy = True
+            try:
+                fn()
+            except Exception as e:
+                logging.exception('Error while saving in the background')
+                self.error = e
+            with self.cond:
+                self.busy = False
+                self.cond.notify_all()
+
+
+class BackgroundSaveMixin(object):
+    ''' Needs self.conf, self.train_info and get_td_file(), which returns the training info file.'''
+
+    def get_writer(self):
+        if getattr(self, 'bg_writer', None) is None:
+            self.bg_writer = CheckpointWriter(self.conf.get('async_save', True))
+        return self.bg_writer
+
+    def wait_for_saves(self):
+        if getattr(self, 'bg_writer', None) is not None:
+            self.bg_writer.wait()
+
+    def save_td(self, train_data_file=None):
+        ''' Queues the training info to be saved to train_data_file (default get_td_file()).'''
+        if train_data_file is None:
+            train_data_file = self.get_td_file()
+        self.td_logged = save_td(self.get_writer(), train_data_file, self.train_info, self.conf,
+                                 getattr(self, 'td_logged', None))
+
+
+def atomic_write(out_file, write_fn, mode='wb'):
+    ''' Calls write_fn(f) on a temporary file which is then renamed to out_file.'''
+    tmp_file = out_file + '.tmp'
+    with open(tmp_file, mode) as f:
+        write_fn(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, out_file)
+
+
+def write_td(train_data_file, train_info, conf):
+    atomic_write(train_data_file, lambda f: pickle.dump([train_info, conf], f, protocol=2))
+    json_data = {}
+    for x in train_info.keys():
+        json_data[x] = np.array(train_info[x]).astype(np.float64).tolist()
+    atomic_write(train_data_file + '.json', lambda f: json.dump(json_data, f), mode='w')
+
+
+def append_td_log(log_file, entries, reset=False):
+    ''' Appends entries (list of dicts) as json lines. If reset, the log is rewritten.'''
+    lines = ''.join(json.dumps(e) + '\n' for e in entries)
+    if reset:
+        atomic_write(log_file, lambda f: f.write(lines), mode='w')
+    else:
+        with open(log_file, 'a') as f:
+            f.write(lines)
+
+
+def save_td(writer, train_data_file, train_info, conf, n_logged=None):
+    ''' Queues the training info to be saved and the entries after the first n_logged to be
+    appended to the jsonl log. With n_logged None, the log is rewritten with all the entries.
+    Returns the number of entries in the log.'''
+    # snapshot, training keeps appending to the lists
+    train_info = collections.OrderedDict((k, list(v)) for k, v in train_info.items())
+    n = min([len(v) for v in train_info.values()]) if len(train_info) > 0 else 0
+    start = 0 if n_logged is None else n_logged
+    entries = []
+    for ndx in range(start, n):
+        entries.append(collections.OrderedDict(
+            (k, np.array(v[ndx]).astype(np.float64).tolist()) for k, v in train_info.items()))
+    if len(entries) > 0 or n_logged is None:
+        writer.submit(lambda: append_td_log(train_data_file + '.jsonl', entries, reset=n_logged is None))
+    writer.submit(lambda: write_td(train_data_file, train_info, conf), key=train_data_file)
+    return n
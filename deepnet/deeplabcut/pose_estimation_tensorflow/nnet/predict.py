@@ -127,6 +127,22 @@ def extract_cnn_outputmulti(outputs_np, cfg):
     return scmap, locref
 
 
+def argmax_pose_predict_batch(scmap, locref, stride):
+    """Batch version of argmax_pose_predict for scmap of size batch x ny x nx x joints and
+    locref of size batch x ny x nx x joints x 2 (as returned by extract_cnn_outputmulti).
+    Returns pose of size batch x joints x 3 (x, y, score)."""
+    batchsize, ny, nx, num_joints = scmap.shape
+    maxloc = np.argmax(scmap.reshape([batchsize, ny * nx, num_joints]), axis=1)
+    Y, X = np.unravel_index(maxloc, (ny, nx))
+    b_ndx = np.arange(batchsize)[:, None]
+    j_ndx = np.arange(num_joints)[None, :]
+    P = scmap[b_ndx, Y, X, j_ndx]
+    pose = np.stack([X * stride + 0.5 * stride, Y * stride + 0.5 * stride, P], axis=-1).astype('float')
+    if locref is not None:
+        pose[..., :2] += locref[b_ndx, Y, X, j_ndx]
+    return pose
+
+
 def get_top_values(scmap, n_top=5):
     batchsize,ny,nx,num_joints = scmap.shape
     scmap_flat = scmap.reshape(batchsize,nx*ny,num_joints)
@@ -318,7 +318,8 @@ def create_cfg(cfg_dict):
         cfg[k] = cfg_dict[k]
     return  cfg
 
-def get_pred_fn(cfg_dict, model_file=None):
+def get_pred_fn(cfg_dict, model_file=None, batch_size=1):
+    ''' pred_fn predicts on batches of batch_size images. Smaller batches are padded. '''
 
     cfg = create_cfg(cfg_dict)
     name = Path(cfg.snapshot_prefix).stem
@@ -333,9 +334,11 @@ def get_pred_fn(cfg_dict, model_file=None):
 
     tf.reset_default_graph()
     cfg.init_weights = init_weights
+    cfg.batch_size = batch_size
     sess, inputs, outputs = predict.setup_pose_prediction(cfg)
 
     def pred_fn(all_f):
+        n_in = all_f.shape[0]
         if cfg.img_dim == 1:
             cur_im = np.tile(all_f,[1,1,1,3])
         else:
@@ -351,14 +354,20 @@ def get_pred_fn(cfg_dict, model_file=None):
                 nims.append(imresize(image, scale) if scale != 1 else image)
             cur_im = np.array(nims)
 
+        if n_in < batch_size:
+            pad = np.zeros((batch_size - n_in,) + cur_im.shape[1:], dtype=cur_im.dtype)
+            cur_im = np.concatenate([cur_im, pad], axis=0)
+
         cur_out = sess.run(outputs, feed_dict={inputs: cur_im})
-        scmap, locref = predict.extract_cnn_output(cur_out, cfg)
-        pose = predict.argmax_pose_predict(scmap, locref, cfg.stride)
-        pose = pose[np.newaxis,:,:2]/cfg.global_scale
+        scmap, locref = predict.extract_cnn_outputmulti(cur_out, cfg)
+        scmap = scmap[:n_in]
+        locref = locref[:n_in] if locref is not None else None
+        pose = predict.argmax_pose_predict_batch(scmap, locref, cfg.stride)
+        pose = pose[:,:,:2]/cfg.global_scale
         ret_dict = {}
         ret_dict['locs'] = pose
-        ret_dict['hmaps'] = scmap[np.newaxis,...]
-        ret_dict['conf'] = np.max(scmap[np.newaxis,...], axis=(1,2))
+        ret_dict['hmaps'] = scmap
+        ret_dict['conf'] = np.max(scmap, axis=(1,2))
         return ret_dict
 
     def close_fn():
@@ -0,0 +1,235 @@
+''' Streaming storage for heatmaps predicted while tracking a movie.
+
+HmapWriter writes the 4-D heatmap outputs (batch x height x width x parts) of pred_fn into a
+chunked, compressed HDF5 file, one group per output key. Writing happens on a background thread,
+so compression does not hold up prediction. Options:
+    quantize: store heatmaps as uint8, scaled per (frame, target, part) between the map's min and max.
+    peak_window: store only a (2*peak_window+1) square window around the peak of each part.
+    decimate: store heatmaps only for every decimate'th frame from start_frame.
+HmapReader reconstructs the heatmap for any stored (frame, target, part).
+'''
+
+import threading
+import logging
+import numpy as np
+import h5py
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class HmapWriter(object):
+
+    def __init__(self, out_file, start_frame, n_frames, n_trx, quantize=False, peak_window=0, decimate=1,
+                 compression_level=4, max_queue=8):
+        ''' n_frames is the number of frames from start_frame that can be tracked. frames and
+        trx ids are 0-indexed.'''
+        self.out_file = out_file
+        self.start_frame = start_frame
+        self.decimate = max(int(decimate), 1)
+        self.n_rows = int(np.ceil(float(n_frames) / self.decimate))
+        self.n_trx = n_trx
+        self.quantize = quantize
+        self.peak_window = int(peak_window)
+        self.compression_level = compression_level
+        self.fid = h5py.File(out_file, 'w')
+        self.fid.attrs['start_frame'] = start_frame
+        self.fid.attrs['decimate'] = self.decimate
+        self.fid.attrs['quantize'] = quantize
+        self.fid.attrs['peak_window'] = self.peak_window
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, key, hmaps, fnums, trx_ids):
+        ''' Queues hmaps (B x h x w x parts) for frames fnums and targets trx_ids (both of size B) to be written.
+        Frames that are not kept because of decimation are dropped.'''
+        if self.error is not None:
+            raise RuntimeError('Error writing heatmaps to {}: {}'.format(self.out_file, self.error))
+        fnums = np.asarray(fnums)
+        trx_ids = np.asarray(trx_ids)
+        sel = (fnums - self.start_frame) % self.decimate == 0
+        if not np.any(sel):
+            return
+        # copy because pred_fn may reuse its output buffers
+        self.queue.put((key, np.array(hmaps[sel], dtype='float32'), fnums[sel], trx_ids[sel]))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.fid.close()
+        if self.error is not None:
+            raise RuntimeError('Error writing heatmaps to {}: {}'.format(self.out_file, self.error))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                self._write(*item)
+            except Exception as e:
+                logging.exception('Error writing heatmaps')
+                self.error = e
+
+    def _create(self, key, hmap_shape):
+        h, w, n_parts = hmap_shape
+        grp = self.fid.create_group(key)
+        grp.attrs['hmap_shape'] = hmap_shape
+        dtype = 'uint8' if self.quantize else 'float32'
+        if self.peak_window > 0:
+            wy = min(2 * self.peak_window + 1, h)
+            wx = min(2 * self.peak_window + 1, w)
+            shape = (self.n_rows, self.n_trx, n_parts, wy, wx)
+            grp.create_dataset('origin', (self.n_rows, self.n_trx, n_parts, 2), dtype='int32')
+        else:
+            shape = (self.n_rows, self.n_trx, h, w, n_parts)
+        grp.create_dataset('maps', shape, dtype=dtype, chunks=(1, 1) + shape[2:],
+                           compression='gzip', compression_opts=self.compression_level, shuffle=True)
+        if self.quantize:
+            grp.create_dataset('lo', (self.n_rows, self.n_trx, n_parts), dtype='float32')
+            grp.create_dataset('hi', (self.n_rows, self.n_trx, n_parts), dtype='float32')
+        grp.create_dataset('valid', (self.n_rows, self.n_trx), dtype='bool')
+        return grp
+
+    def _write(self, key, hmaps, fnums, trx_ids):
+        if key not in self.fid:
+            grp = self._create(key, hmaps.shape[1:])
+        else:
+            grp = self.fid[key]
+        bsize, h, w, n_parts = hmaps.shape
+
+        if self.peak_window > 0:
+            wy, wx = grp['maps'].shape[3:]
+            flat = hmaps.transpose([0, 3, 1, 2]).reshape([bsize, n_parts, h * w])
+            peak = np.argmax(flat, axis=2)
+            oy = np.clip(peak // w - wy // 2, 0, h - wy)
+            ox = np.clip(peak % w - wx // 2, 0, w - wx)
+            rows = oy[:, :, None] + np.arange(wy)
+            cols = ox[:, :, None] + np.arange(wx)
+            b_ndx = np.arange(bsize)[:, None, None, None]
+            p_ndx = np.arange(n_parts)[None, :, None, None]
+            data = hmaps[b_ndx, rows[:, :, :, None], cols[:, :, None, :], p_ndx]  # B x parts x wy x wx
+            origin = np.stack([oy, ox], axis=-1)
+            red_axes = (2, 3)
+        else:
+            data = hmaps
+            red_axes = (1, 2)
+
+        if self.quantize:
+            lo = data.min(axis=red_axes)
+            hi = data.max(axis=red_axes)
+            scale = np.where(hi > lo, hi - lo, 1.)
+            if self.peak_window > 0:
+                q = (data - lo[:, :, None, None]) / scale[:, :, None, None]
+            else:
+                q = (data - lo[:, None, None, :]) / scale[:, None, None, :]
+            data = np.round(q * 255).astype('uint8')
+
+        rows_out = (np.asarray(fnums) - self.start_frame) // self.decimate
+        put = self._batch_writer(rows_out, np.asarray(trx_ids))
+        put(grp['maps'], data)
+        if self.peak_window > 0:
+            put(grp['origin'], origin)
+        if self.quantize:
+            put(grp['lo'], lo)
+            put(grp['hi'], hi)
+        put(grp['valid'], np.ones(bsize, dtype=bool))
+
+    @staticmethod
+    def _batch_writer(rows, trx_ids):
+        ''' Returns put(dset, values) that writes values[ndx] to dset[rows[ndx], trx_ids[ndx]] with as few h5py
+        writes as possible, as each write has a large overhead. If the batch covers most of its block of
+        rows x targets, the block is written with a single slice write (reading it first if the batch
+        doesn't cover all of it). Otherwise, there is one write per target with the rows sorted.'''
+        r0, t0 = rows.min(), trx_ids.min()
+        n_r, n_t = rows.max() + 1 - r0, trx_ids.max() + 1 - t0
+        covered = np.zeros([n_r, n_t], dtype=bool)
+        covered[rows - r0, trx_ids - t0] = True
+        n_covered = np.count_nonzero(covered)
+
+        if n_covered * 2 >= n_r * n_t:
+            blk = (slice(r0, r0 + n_r), slice(t0, t0 + n_t))
+            full = n_covered == n_r * n_t
+
+            def put(dset, values):
+                if full:
+                    block = np.zeros((n_r, n_t) + dset.shape[2:], dtype=dset.dtype)
+                else:
+                    block = dset[blk]
+                block[rows - r0, trx_ids - t0] = values
+                dset[blk] = block
+            return put
+
+        groups = []
+        for t in np.unique(trx_ids):
+            sel = np.where(trx_ids == t)[0]
+            sel = sel[np.argsort(rows[sel])]
+            groups.append((t, rows[sel], sel))
+
+        def put(dset, values):
+            for t, cur_rows, sel in groups:
+                dset[cur_rows, t] = values[sel]
+        return put
+
+
+class HmapReader(object):
+
+    def __init__(self, in_file):
+        self.fid = h5py.File(in_file, 'r')
+        self.start_frame = int(self.fid.attrs['start_frame'])
+        self.decimate = int(self.fid.attrs['decimate'])
+        self.quantize = bool(self.fid.attrs['quantize'])
+        self.peak_window = int(self.fid.attrs['peak_window'])
+
+    def keys(self):
+        return list(self.fid.keys())
+
+    def frames(self, key, trx_ndx):
+        ''' 0-indexed frames for which heatmaps of target trx_ndx are stored '''
+        rows = np.where(self.fid[key]['valid'][:, trx_ndx])[0]
+        return rows * self.decimate + self.start_frame
+
+    def get(self, key, fnum, trx_ndx, part=None):
+        ''' Heatmap for frame fnum and target trx_ndx (both 0-indexed) as an h x w x parts array,
+        or h x w if part is given. With peak_window, values outside the stored window are 0.'''
+        grp = self.fid[key]
+        rel = fnum - self.start_frame
+        r = rel // self.decimate
+        if rel < 0 or rel % self.decimate != 0 or r >= grp['valid'].shape[0] or not grp['valid'][r, trx_ndx]:
+            raise KeyError('No heatmap stored for frame {} target {}'.format(fnum, trx_ndx))
+        h, w, n_parts = grp.attrs['hmap_shape']
+        parts = np.arange(n_parts) if part is None else np.array([part])
+        data = grp['maps'][r, trx_ndx].astype('float32')
+
+        if self.peak_window > 0:
+            data = data[parts]  # parts x wy x wx
+        else:
+            data = data[..., parts].transpose([2, 0, 1])
+
+        if self.quantize:
+            lo = grp['lo'][r, trx_ndx][parts]
+            hi = grp['hi'][r, trx_ndx][parts]
+            scale = np.where(hi > lo, hi - lo, 1.)
+            data = data / 255. * scale[:, None, None] + lo[:, None, None]
+
+        if self.peak_window > 0:
+            origin = grp['origin'][r, trx_ndx][parts]
+            wy, wx = data.shape[1:]
+            out = np.zeros([len(parts), h, w], dtype='float32')
+            for ndx in range(len(parts)):
+                oy, ox = origin[ndx]
+                out[ndx, oy:oy + wy, ox:ox + wx] = data[ndx]
+            data = out
+
+        data = data.transpose([1, 2, 0])
+        return data[..., 0] if part is not None else data
+
+    def close(self):
+        self.fid.close()
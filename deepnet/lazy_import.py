@@ -0,0 +1,55 @@
+''' Deferred imports. Importing tensorflow, torch and the network backends takes a long time,
+and most invocations of APT_interface need only one network type (or none at all, eg model_files).
+LazyModule stands in for a module and imports it the first time one of its attributes is used.
+'''
+
+import importlib
+import logging
+import sys
+import time
+
+
+class LazyModule(object):
+    ''' Behaves like module_name once any attribute is accessed.
+    import_name is imported instead of module_name if given, which is needed when
+    module_name is a package and the submodule has to be imported too.
+    E.g. LazyModule('leap', 'leap.training') is a deferred "import leap.training".
+    post_fn, if given, is applied to the imported module and its output is used instead.
+    '''
+
+    def __init__(self, module_name, import_name=None, post_fn=None):
+        self._module_name = module_name
+        self._import_name = module_name if import_name is None else import_name
+        self._post_fn = post_fn
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            start = time.time()
+            importlib.import_module(self._import_name)
+            module = sys.modules[self._module_name]
+            if self._post_fn is not None:
+                module = self._post_fn(module)
+            self._module = module
+            logging.debug('Imported {} in {:.1f}s'.format(self._import_name, time.time() - start))
+        return self._module
+
+    def __getattr__(self, item):
+        return getattr(self._load(), item)
+
+    def __repr__(self):
+        status = 'loaded' if self._module is not None else 'not loaded'
+        return '<lazy module {} ({})>'.format(self._import_name, status)
+
+
+def tf_compat(tensorflow):
+    # tf 1.13 onwards uses the compat.v1 API
+    vv = [int(v) for v in tensorflow.__version__.split('.')[:2]]
+    if vv[0] == 1 and vv[1] > 12:
+        return tensorflow.compat.v1
+    else:
+        return tensorflow
+
+
+def lazy_tf():
+    return LazyModule('tensorflow', post_fn=tf_compat)
@@ -0,0 +1,138 @@
+''' Cache for values parsed from the .lbl file.
+
+Stripped lbl files can be hundreds of MB, and parsing the conf, movie lists etc from them
+is slow. Values computed by cached() are stored in memory and saved to disk as json, keyed on the
+lbl file's path, mtime and size plus any extra key given by the caller, so they are only
+recomputed when the lbl file changes. Every hit only costs a stat of the lbl file.
+
+The disk cache is in the user's own cache directory (readable only by the user), and json is used
+instead of pickle so that a cache file can never run code. numpy arrays, tuples and poseConfig
+configs are tagged so that they are restored with the same types. Values with other types are
+not saved to disk.
+'''
+
+import os
+import copy
+import json
+import hashlib
+import logging
+import numpy as np
+
+LBL_CACHE_VERSION = 2
+
+_mem_cache = {}
+
+
+def cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'apt', 'lbl_cache')
+
+
+def file_key(lbl_file):
+    st = os.stat(lbl_file)
+    return (LBL_CACHE_VERSION, os.path.abspath(lbl_file), st.st_mtime, st.st_size)
+
+
+def cache_file(kind, key):
+    key_str = hashlib.md5(repr(key).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir(), '{}_{}.json'.format(kind, key_str))
+
+
+def _encode(val):
+    if isinstance(val, np.ndarray):
+        if val.dtype == object:
+            return {'__ndarray_obj__': [_encode(v) for v in val.ravel()], 'shape': list(val.shape)}
+        return {'__ndarray__': val.tolist(), 'dtype': val.dtype.str, 'shape': list(val.shape)}
+    elif isinstance(val, np.generic):
+        return {'__npscalar__': val.item(), 'dtype': val.dtype.str}
+    elif isinstance(val, tuple):
+        return {'__tuple__': [_encode(v) for v in val]}
+    elif isinstance(val, list):
+        return [_encode(v) for v in val]
+    elif isinstance(val, dict):
+        if not all(isinstance(k, str) for k in val.keys()):
+            raise TypeError('Only dicts with string keys can be cached')
+        return {'__dict__': {k: _encode(v) for k, v in val.items()}}
+    elif val is None or isinstance(val, (bool, int, float, str)):
+        return val
+    elif type(val).__name__ == 'config' and type(val).__module__ == 'poseConfig':
+        return {'__conf__': _encode(val.__dict__)}
+    raise TypeError('Cannot cache values of type {}'.format(type(val)))
+
+
+def _decode(val):
+    if isinstance(val, list):
+        return [_decode(v) for v in val]
+    elif not isinstance(val, dict):
+        return val
+    elif '__ndarray__' in val:
+        return np.array(val['__ndarray__'], dtype=np.dtype(val['dtype'])).reshape(val['shape'])
+    elif '__ndarray_obj__' in val:
+        out = np.empty(len(val['__ndarray_obj__']), dtype=object)
+        for ndx, v in enumerate(val['__ndarray_obj__']):
+            out[ndx] = _decode(v)
+        return out.reshape(val['shape'])
+    elif '__npscalar__' in val:
+        return np.dtype(val['dtype']).type(val['__npscalar__'])
+    elif '__tuple__' in val:
+        return tuple(_decode(v) for v in val['__tuple__'])
+    elif '__dict__' in val:
+        return {k: _decode(v) for k, v in val['__dict__'].items()}
+    elif '__conf__' in val:
+        import poseConfig
+        conf = poseConfig.config()
+        conf.__dict__.update(_decode(val['__conf__']))
+        return conf
+    raise ValueError('Unknown entry in lbl cache')
+
+
+def _load(cur_file, key):
+    if not os.path.exists(cur_file):
+        return False, None
+    try:
+        with open(cur_file, 'r') as f:
+            saved = json.load(f)
+        if saved['key'] != repr(key):
+            return False, None
+        return True, _decode(saved['val'])
+    except Exception:
+        logging.warning('Could not read lbl cache {}'.format(cur_file))
+        return False, None
+
+
+def _save(cur_file, key, val):
+    try:
+        out = json.dumps({'key': repr(key), 'val': _encode(val)})
+        os.makedirs(os.path.dirname(cur_file), mode=0o700, exist_ok=True)
+        tmp_file = cur_file + '.{}.tmp'.format(os.getpid())
+        with open(tmp_file, 'w') as f:
+            f.write(out)
+        os.replace(tmp_file, cur_file)
+    except Exception as e:
+        logging.warning('Could not save lbl cache {}: {}'.format(cur_file, e))
+
+
+def cached(kind, lbl_file, extra_key, compute_fn, use_cache=True):
+    ''' Returns compute_fn() for lbl_file, using the cached value if the lbl file hasn't changed.
+    extra_key should identify everything else that compute_fn depends on and have a stable repr.
+    A copy is returned so that callers can modify it.
+    '''
+    if not use_cache:
+        return compute_fn()
+    key = (kind, file_key(lbl_file), extra_key)
+    if key in _mem_cache:
+        return copy.deepcopy(_mem_cache[key])
+
+    cur_file = cache_file(kind, key)
+    found, val = _load(cur_file, key)
+    if found:
+        logging.info('Using cached {} for {}'.format(kind, lbl_file))
+    else:
+        val = compute_fn()
+        _save(cur_file, key, val)
+    _mem_cache[key] = val
+    return copy.deepcopy(val)
+
+
+def clear_cache():
+    _mem_cache.clear()
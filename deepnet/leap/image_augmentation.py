@@ -1,8 +1,10 @@
 ''' Modified by Mayank Kabra
 From LEAP https://github.com/talmo/leap by Talmo Pereira
 '''
+import os
 import cv2
 import numpy as np
+import h5py
 import keras
 from keras.utils import Sequence
 import PoseTools
@@ -166,3 +168,144 @@ class MultiInputOutputPairedImageAugmenter(PairedImageAugmenter):
         X,Y = super(MultiInputOutputPairedImageAugmenter,self).__getitem__(batch_idx)
         return ({k: X for k in self.input_names}, {k: Y for k in self.output_names})
 
+
+
+def random_transform_matrices(n, img_size, theta=(-180, 180), scale=1.0, rng=np.random):
+    """ Random affine matrices (n x 2 x 3) drawn as in transform_imgs, one per image. """
+    theta = np.ptp(theta) * rng.rand(n) + np.min(theta) if not np.isscalar(theta) else np.full(n, theta)
+    scale = np.ptp(scale) * rng.rand(n) + np.min(scale) if not np.isscalar(scale) else np.full(n, scale)
+    ctr = (img_size[0] / 2, img_size[0] / 2)
+    return np.array([cv2.getRotationMatrix2D(ctr, t, s) for t, s in zip(theta, scale)])
+
+
+def warp_batch(X, T):
+    """ Warps a batch of images X (B x H x W x C) with affine matrices T (B x 2 x 3) the way cv2.warpAffine does
+    (bilinear, zero border), for all images and channels at once. """
+    B, H, W = X.shape[:3]
+    # inverse maps from output to input pixels
+    A = T[:, :, :2]
+    A_inv = np.linalg.inv(A)
+    b_inv = -np.matmul(A_inv, T[:, :, 2:])[..., 0]
+    yy, xx = np.meshgrid(np.arange(H, dtype='float32'), np.arange(W, dtype='float32'), indexing='ij')
+    src_x = A_inv[:, 0, 0, None, None] * xx + A_inv[:, 0, 1, None, None] * yy + b_inv[:, 0, None, None]
+    src_y = A_inv[:, 1, 0, None, None] * xx + A_inv[:, 1, 1, None, None] * yy + b_inv[:, 1, None, None]
+    x0 = np.floor(src_x).astype('int64')
+    y0 = np.floor(src_y).astype('int64')
+    wx = (src_x - x0)[..., None].astype('float32')
+    wy = (src_y - y0)[..., None].astype('float32')
+    b_ndx = np.arange(B)[:, None, None]
+    Xf = X.astype('float32')
+
+    def gather(yi, xi):
+        valid = (yi >= 0) & (yi < H) & (xi >= 0) & (xi < W)
+        vals = Xf[b_ndx, np.clip(yi, 0, H - 1), np.clip(xi, 0, W - 1)]
+        return vals * valid[..., None]
+
+    out = gather(y0, x0) * (1 - wx) * (1 - wy) + gather(y0, x0 + 1) * wx * (1 - wy) + \
+          gather(y0 + 1, x0) * (1 - wx) * wy + gather(y0 + 1, x0 + 1) * wx * wy
+    return out.astype(X.dtype) if X.dtype.kind == 'f' else np.round(out).astype(X.dtype)
+
+
+class LazyPairedImageAugmenter(Sequence):
+    """ Same batches as PairedImageAugmenter, but reads each batch from the h5 dataset when it is needed
+    instead of holding the whole dataset in memory, and augments the batch as a whole.
+    Can be used with keras multiprocessing workers: the h5 file is opened in each worker and
+    each worker gets its own random seed, so that workers don't produce the same augmentations.
+    idx selects the samples of the dataset to use.
+    """
+
+    def __init__(self, data_path, conf, X_dset='box', Y_dset='joints', idx=None, shuffle=False,
+                 permute=(0, 3, 2, 1), seed=None):
+        self.data_path = data_path
+        self.X_dset = X_dset
+        self.Y_dset = Y_dset
+        self.permute = permute
+        self.conf = conf
+        self.batch_size = conf.batch_size
+        self.theta = (-conf.rrange, conf.rrange)
+        self.scale = (1 / conf.scale_factor_range, conf.scale_factor_range)
+        self.seed = np.random.randint(2 ** 31) if seed is None else seed
+        self._fid = None
+        self._pid = None
+
+        with h5py.File(data_path, 'r') as f:
+            n_total = f[X_dset].shape[0]
+            self.img_shape = tuple(np.array(f[X_dset].shape)[list(permute[1:])])
+        all_idx = np.arange(n_total) if idx is None else np.asarray(idx)
+        self.num_samples = len(all_idx)
+        if self.num_samples < self.batch_size:
+            # as PairedImageAugmenter, which tiles the data to batch_size copies
+            all_idx = np.tile(all_idx, self.batch_size)
+        if shuffle:
+            np.random.shuffle(all_idx)
+        if self.num_samples < self.batch_size:
+            self.batches = np.array_split(all_idx, self.num_samples)
+        else:
+            self.batches = np.array_split(all_idx, np.ceil(self.num_samples / self.batch_size))
+
+    def __len__(self):
+        return len(self.batches)
+
+    def _init_worker(self):
+        # keras workers are forked processes, so reopen the file and reseed in each of them
+        pid = os.getpid()
+        if self._pid != pid:
+            self._pid = pid
+            self._fid = h5py.File(self.data_path, 'r')
+            seed = (self.seed + pid) % (2 ** 31)
+            self.rng = np.random.RandomState(seed)
+            np.random.seed(seed)  # PoseTools.preprocess_ims uses the global random state
+
+    def read(self, idx):
+        """ Reads samples idx from the h5 file. """
+        self._init_worker()
+        order = np.argsort(idx)
+        s_idx = np.asarray(idx)[order]
+        uniq, inv = np.unique(s_idx, return_inverse=True)  # h5py needs increasing unique indices
+        X = self._fid[self.X_dset][uniq.tolist()][inv]
+        Y = self._fid[self.Y_dset][uniq.tolist()][inv]
+        rev = np.argsort(order)
+        X = np.transpose(X[rev], self.permute)
+        return X, Y[rev]
+
+    def __getitem__(self, batch_idx):
+        X, Y = self.read(self.batches[batch_idx])
+
+        if self.conf.use_leap_preprocessing:
+            if Y.ndim == 4:
+                hmaps = np.transpose(Y, (0, 3, 2, 1))
+            else:
+                hmap_sigma = 5
+                hmaps = PoseTools.create_label_images(Y, X.shape[1:3], 1, hmap_sigma)
+                hmaps = (hmaps + 1) / 2
+            T = random_transform_matrices(len(X), X.shape[1:3], theta=self.theta, scale=self.scale, rng=self.rng)
+            X = warp_batch(X, T) / 255.
+            hmaps = warp_batch(hmaps, T)
+        else:
+            X, Y = PoseTools.preprocess_ims(X, Y, self.conf, True, self.conf.rescale)
+            X = X.astype('float') / 255.
+            hmap_sigma = min(5, self.conf.label_blur_rad)
+            hmaps = PoseTools.create_label_images(Y, X.shape[1:3], 1, hmap_sigma)
+            hmaps = (hmaps + 1) / 2
+        return X, hmaps
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_fid'] = None
+        state['_pid'] = None
+        return state
+
+
+class LazyMultiInputOutputPairedImageAugmenter(LazyPairedImageAugmenter):
+    def __init__(self, input_names, output_names, *args, **kwargs):
+        if type(input_names) != list:
+            input_names = [input_names,]
+        if type(output_names) != list:
+            output_names = [output_names,]
+        self.input_names = input_names
+        self.output_names = output_names
+        super(LazyMultiInputOutputPairedImageAugmenter, self).__init__(*args, **kwargs)
+
+    def __getitem__(self, batch_idx):
+        X, Y = super(LazyMultiInputOutputPairedImageAugmenter, self).__getitem__(batch_idx)
+        return ({k: X for k in self.input_names}, {k: Y for k in self.output_names})
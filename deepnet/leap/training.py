@@ -22,7 +22,8 @@ from keras.callbacks import Callback
 import keras.backend as K
 
 from leap import models
-from leap.image_augmentation import PairedImageAugmenter, MultiInputOutputPairedImageAugmenter
+from leap.image_augmentation import PairedImageAugmenter, MultiInputOutputPairedImageAugmenter, \
+    LazyPairedImageAugmenter, LazyMultiInputOutputPairedImageAugmenter
 #from leap.viz import show_pred, show_confmap_grid, plot_history
 from leap.utils import load_dataset
 
@@ -167,22 +168,43 @@ def train(data_path,
     # Load
     use_leap_lr = conf.get('leap_use_default_lr', False)
 
-    print("data_path:", data_path)
-    box, confmap = load_dataset(data_path, X_dset=box_dset, Y_dset=confmap_dset)
+    # Read batches from the data file as they are needed instead of loading everything.
+    lazy_data = conf.get('leap_lazy_data', True)
+    n_workers = conf.get('leap_data_workers', 0)
 
-    if use_leap_lr:
-        box, confmap, val_box, val_confmap, train_idx, val_idx = train_val_split(box, confmap, val_size=val_size, shuffle=preshuffle)
+    print("data_path:", data_path)
+    if lazy_data:
+        with h5py.File(data_path, 'r') as f:
+            n_samples = f[box_dset].shape[0]
+            box_shape = tuple(np.array(f[box_dset].shape)[[0, 3, 2, 1]])
+        if use_leap_lr:
+            _, _, _, _, train_idx, val_idx = train_val_split(np.arange(n_samples), np.arange(n_samples), val_size=val_size, shuffle=preshuffle)
+            train_sel, val_sel = train_idx, val_idx
+        else:
+            train_sel = val_sel = None
+            train_idx = np.array([0])
+            val_idx = np.array([0])
+        n_train = n_samples if train_sel is None else len(train_sel)
+        n_val = n_samples if val_sel is None else len(val_sel)
+        print("box.shape:", (n_train,) + box_shape[1:])
+        print("val_box.shape:", (n_val,) + box_shape[1:])
     else:
-        val_box   = box
-        val_confmap = confmap
-        train_idx = np.array([0])
-        val_idx = np.array([0])
+        box, confmap = load_dataset(data_path, X_dset=box_dset, Y_dset=confmap_dset)
 
-    print("box.shape:", box.shape)
-    print("val_box.shape:", val_box.shape)
+        if use_leap_lr:
+            box, confmap, val_box, val_confmap, train_idx, val_idx = train_val_split(box, confmap, val_size=val_size, shuffle=preshuffle)
+        else:
+            val_box   = box
+            val_confmap = confmap
+            train_idx = np.array([0])
+            val_idx = np.array([0])
+
+        print("box.shape:", box.shape)
+        print("val_box.shape:", val_box.shape)
+        box_shape = box.shape
 
     # Pull out metadata
-    img_size = np.array(box.shape[1:])
+    img_size = np.array(box_shape[1:])
     img_size[0] = img_size[0]//conf.rescale
     img_size[1] = img_size[1]//conf.rescale
 
@@ -227,7 +249,15 @@ def train(data_path,
     # Data generators/augmentation
     input_layers = model.input_names
     output_layers = model.output_names
-    if len(input_layers) > 1 or len(output_layers) > 1:
+    if lazy_data:
+        dset_args = {'X_dset': box_dset, 'Y_dset': confmap_dset, 'shuffle': True}
+        if len(input_layers) > 1 or len(output_layers) > 1:
+            train_datagen = LazyMultiInputOutputPairedImageAugmenter(input_layers, output_layers, data_path, conf, idx=train_sel, **dset_args)
+            val_datagen = LazyMultiInputOutputPairedImageAugmenter(input_layers, output_layers, data_path, conf, idx=val_sel, **dset_args)
+        else:
+            train_datagen = LazyPairedImageAugmenter(data_path, conf, idx=train_sel, **dset_args)
+            val_datagen = LazyPairedImageAugmenter(data_path, conf, idx=val_sel, **dset_args)
+    elif len(input_layers) > 1 or len(output_layers) > 1:
         train_datagen = MultiInputOutputPairedImageAugmenter(input_layers, output_layers, box, confmap, conf, shuffle=True)
         val_datagen = MultiInputOutputPairedImageAugmenter(input_layers, output_layers, val_box, val_confmap, conf, shuffle=True)
     else:
@@ -331,15 +361,16 @@ def train(data_path,
     # Train!
     epoch0 = 0
     t0_train = time()
-    use_multiprocessing = False if box.shape[0] < 300 else True
+    # workers need the lazy generators, which open the data file and get their own random seed in each worker
+    use_multiprocessing = lazy_data and n_workers > 0
     model.save(str(os.path.join(run_path, run_name + '-{}'.format(0))))
     training = model.fit_generator(
             train_datagen,
             initial_epoch=epoch0,
             epochs=epochs,
             verbose=0,
-    #         use_multiprocessing=True,
-    #         workers=8,
+            use_multiprocessing=use_multiprocessing,
+            workers=n_workers if use_multiprocessing else 1,
             steps_per_epoch=batches_per_epoch,
             max_queue_size=512,
             shuffle=False,
@@ -363,32 +394,16 @@ def train(data_path,
 
 
 def get_read_fn(conf, data_path):
-
-    batch_size = 1
-    rotate_angle = 0
-    net_name = conf.leap_net_name
+    # read_fn returns the images and the locations from the confmaps, which doesn't depend on the
+    # inputs and outputs of the network. So the network isn't created, and the multi input/output
+    # augmenter (which returns dicts keyed by layer name) isn't needed even for stacked_hourglass.
     box_dset="box"
     confmap_dset="joints"
-    filters=64
-
-    box, confmap = load_dataset(data_path, X_dset=box_dset, Y_dset=confmap_dset)
-
-    # Pull out metadata
-    img_size = box.shape[1:]
-    num_output_channels = confmap.shape[-1]
 
-    # Create network
-    model = create_model(net_name, img_size, num_output_channels, filters=filters, amsgrad=False, upsampling_layers=False, summary=False)
-    if model is None:
-        print("Could not find model:", net_name)
-        return
+    with h5py.File(data_path, 'r') as f:
+        n_db = f[box_dset].shape[0]
 
-    input_layers = model.input_names
-    output_layers = model.output_names
-    if len(input_layers) > 1 or len(output_layers) > 1:
-        datagen = MultiInputOutputPairedImageAugmenter(input_layers, output_layers, box, confmap, conf, shuffle=False)
-    else:
-        datagen = PairedImageAugmenter(box, confmap, conf, shuffle=False)
+    datagen = LazyPairedImageAugmenter(data_path, conf, X_dset=box_dset, Y_dset=confmap_dset, shuffle=False)
 
     cur_ex = [0]
     def read_fn():
@@ -398,8 +413,6 @@ def get_read_fn(conf, data_path):
         info = [0,0,0]
         return im, locs, info
 
-    n_db = box.shape[0]
-
     return read_fn, n_db
 
 
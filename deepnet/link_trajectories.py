@@ -7,12 +7,6 @@ import TrkFile
 
 from progressbar import progressbar
 
-# for debugging
-import matplotlib
-matplotlib.use('TkAgg')
-import matplotlib.pyplot as plt
-#plt.ion()
-
 def match_frame(pcurr,pnext,idscurr,params,lastid=np.nan):
     """
     match_frame(pcurr,pnext,idscurr,params,lastid=np.nan)
@@ -367,6 +361,178 @@ def apply_ids(trk,ids):
     return newtrk
 
 
+class OnlineLinker(object):
+    """
+    OnlineLinker(params,nframes_maxcost=100)
+    Links detections into trajectories frame by frame while a movie is being
+    tracked, instead of running assign_ids, stitch and delete_short on the
+    detections of the whole movie. Detections in frame t are matched to the
+    trajectories alive in frame t-1 with match_frame. Detections that are
+    not matched (births) are matched to trajectories that died within the
+    last params['maxframes_missed']+1 frames, most recent deaths first, which
+    stitches short gaps as in stitch. A trajectory that has been dead for
+    longer than that can't be stitched anymore and is finalized, and is
+    deleted if it is at most params['maxframes_delete'] frames long as in
+    delete_short.
+    If params['maxcost'] is None, it is estimated with estimate_maxcost from
+    the first nframes_maxcost frames, which are held back till then.
+    Each trajectory is a dict with fields t0, t1 (first and last frame), p
+    (d x nlandmarks x (t1-t0+1) detections, nan in stitched gaps) and isdummy.
+    While linking, the detections of a trajectory are kept as a list of
+    blocks that is concatenated only once the trajectory is finalized or
+    returned, so that extending a trajectory doesn't copy it.
+    """
+
+    def __init__(self,params,nframes_maxcost=100):
+        self.params = params.copy()
+        set_default_params(self.params)
+        self.nframes_maxcost = nframes_maxcost
+        self.lastid = -1
+        self.live = {} # id -> trajectory, detected in the last frame
+        self.dead = {} # id -> trajectory, can still be stitched
+        self.done = [] # finalized trajectories
+        self.held = [] # (t,p) frames held back to estimate maxcost
+        self.t = None
+        self.ndeleted = 0
+
+    def add_frame(self,t,p):
+        """
+        add_frame(t,p)
+        Adds the detections p (d x nlandmarks x maxnanimals, nan for dummy
+        detections as in assign_ids) for frame t. Frames should be added in order.
+        """
+        if self.params.get('maxcost',None) is None:
+            self.held.append((t,p))
+            if len(self.held) < self.nframes_maxcost or not self._estimate_maxcost():
+                return
+            held = self.held
+            self.held = []
+            for tt,pp in held:
+                self._link(tt,pp)
+        else:
+            self._link(t,p)
+
+    def _estimate_maxcost(self):
+        ph = np.stack([pp for _,pp in self.held],axis=3)
+        ndet = np.count_nonzero(np.any(np.isnan(ph),axis=(0,1))==False,axis=0)
+        if np.count_nonzero((ndet[:-1]>0) & (ndet[1:]>0)) == 0:
+            return False
+        self.params['maxcost'] = estimate_maxcost(ph,prctile=self.params.get('maxcost_prctile',95.))
+        if self.params['verbose']>0:
+            print('maxcost set to %f'%self.params['maxcost'])
+        return True
+
+    def _link(self,t,p):
+        assert self.t is None or t > self.t, 'Frames should be added in order'
+        if self.t is not None and t > self.t+1:
+            # frames were skipped, nothing is alive in the previous frame
+            for id in list(self.live.keys()):
+                self.dead[id] = self.live.pop(id)
+        self.t = t
+
+        pnext = p[:,:,real_idx(p)]
+        nnext = pnext.shape[2]
+        idslive = np.array(sorted(self.live.keys()),dtype=int)
+        if idslive.size > 0 and nnext > 0:
+            pcurr = np.stack([self.live[id]['plast'] for id in idslive],axis=2)
+            idsnext,_,_,_ = match_frame(pcurr,pnext,idslive,self.params,self.lastid)
+        else:
+            idsnext = np.arange(self.lastid+1,self.lastid+1+nnext,dtype=int)
+        isbirth = idsnext > self.lastid
+
+        # trajectories that were not continued
+        for id in idslive:
+            if not np.any(idsnext==id):
+                self.dead[id] = self.live.pop(id)
+
+        # stitch births to recently dead trajectories, shortest gaps first
+        for nframes_skip in range(2,self.params['maxframes_missed']+2):
+            births = np.nonzero(isbirth)[0]
+            if births.size == 0:
+                break
+            idsdeath = np.array([id for id in sorted(self.dead.keys()) if self.dead[id]['t1'] == t-nframes_skip],dtype=int)
+            if idsdeath.size == 0:
+                continue
+            pcurr = np.stack([self.dead[id]['plast'] for id in idsdeath],axis=2)
+            idsmatch,_,_,_ = match_frame(pcurr,pnext[:,:,births],idsdeath,self.params,self.lastid)
+            for j in range(births.size):
+                if idsmatch[j] > self.lastid:
+                    continue
+                id = idsmatch[j]
+                tr = self.dead.pop(id)
+                gap = np.zeros(tr['plast'].shape+(nframes_skip-1,))
+                gap[:] = np.nan
+                tr['pblocks'].append(gap)
+                tr['dummyblocks'].append(np.ones(nframes_skip-1,dtype=bool))
+                self.live[id] = tr
+                idsnext[births[j]] = id
+                isbirth[births[j]] = False
+                if self.params['verbose']>0:
+                    print('Stitching id %d frame %d to frame %d'%(id,tr['t1'],t))
+
+        for j in range(nnext):
+            if isbirth[j]:
+                self.lastid += 1
+                id = self.lastid
+                self.live[id] = {'t0':t,'t1':t,'plast':pnext[:,:,j],
+                                 'pblocks':[pnext[:,:,j:j+1]],'dummyblocks':[np.zeros(1,dtype=bool)]}
+            else:
+                tr = self.live[idsnext[j]]
+                tr['plast'] = pnext[:,:,j]
+                tr['pblocks'].append(pnext[:,:,j:j+1])
+                tr['dummyblocks'].append(np.zeros(1,dtype=bool))
+                tr['t1'] = t
+
+        # trajectories that can't be stitched anymore
+        for id in list(self.dead.keys()):
+            if self.dead[id]['t1'] <= t-self.params['maxframes_missed']-1:
+                self._finalize(self.dead.pop(id))
+
+    @staticmethod
+    def _stacked(tr):
+        return {'t0':tr['t0'],'t1':tr['t1'],
+                'p':np.concatenate(tr['pblocks'],axis=2),
+                'isdummy':np.concatenate(tr['dummyblocks'])}
+
+    def _finalize(self,tr):
+        if tr['t1']-tr['t0']+1 <= self.params['maxframes_delete']:
+            self.ndeleted += 1
+        else:
+            self.done.append(self._stacked(tr))
+
+    def trajectories(self):
+        """
+        trajectories()
+        Returns the trajectories so far, including the ones that may still be
+        extended or deleted, sorted by their first frame.
+        """
+        trs = self.done + [self._stacked(tr) for tr in list(self.dead.values()) + list(self.live.values())]
+        return sorted(trs,key=lambda tr: tr['t0'])
+
+    def finish(self):
+        """
+        finish()
+        Links any frames that are held back, finalizes all the trajectories
+        and returns them sorted by their first frame.
+        """
+        if len(self.held) > 0:
+            if not self._estimate_maxcost():
+                # there is nothing to match, any cost will do
+                self.params['maxcost'] = 1.
+            held = self.held
+            self.held = []
+            for tt,pp in held:
+                self._link(tt,pp)
+        for id in list(self.dead.keys()):
+            self._finalize(self.dead.pop(id))
+        for id in list(self.live.keys()):
+            self._finalize(self.live.pop(id))
+        if self.params['verbose'] > 0:
+            print('%d trajectories, deleted %d short trajectories'%(len(self.done),self.ndeleted))
+        self.done = sorted(self.done,key=lambda tr: tr['t0'])
+        return self.done
+
+
 def test_assign_ids():
     """
     test_assign_ids():
@@ -479,6 +645,11 @@ def test_assign_ids_data():
     loads data from a trkfile and runs assign_ids, stitch, delete_short, and delete_empty on them
     :return:
     """
+    # for debugging
+    import matplotlib
+    matplotlib.use('TkAgg')
+    import matplotlib.pyplot as plt
+    #plt.ion()
     
     #trkfile = '/groups/branson/home/kabram/temp/roian_multi/200918_m170234vocpb_m170234_odor_m170232_f0180322_full_min2.trk.part'
     #outtrkfile='/groups/branson/bransonlab/apt/tmp/200918_m170234vocpb_m170234_odor_m170232_f0180322_full_min2_kbstitched.trk'
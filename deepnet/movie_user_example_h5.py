@@ -55,6 +55,17 @@ class MovieReader:
         im = np.swapaxes(im, nd-2, nd-1)
         return im, framenumber
 
+    def get_frames(self, framenumbers):
+        """
+        Return (frames, framenumbers) for a list of frame numbers with a single read.
+
+        framenumbers: increasing frame indices, as required by h5py
+        """
+        framenumbers = np.asarray(framenumbers)
+        im = self.movdata[framenumbers.tolist(), ...]
+        im = np.swapaxes(im, 1, 2)
+        return im, framenumbers
+
     def get_n_frames(self):
         return self.movdata.shape[0]
 
@@ -77,13 +77,16 @@ class Movie:
                   parentframe=None,
                   open_now=True,
                   open_multiple=False,
-                  default_extension='.fmf' ):
+                  default_extension='.fmf',
+                  decode_workers=0 ):
         """Prepare to open a movie (awaiting call to self.open()).
 If initpath is a filename, just use it.
 If initpath is a directory and interactive is True, then ask user for a filename.
-If initpath is a directory and not in interactive mode, it's an error."""
+If initpath is a directory and not in interactive mode, it's an error.
+If decode_workers > 0, compressed movies read with OpenCV are decoded in parallel by that many worker processes."""
 
         self.interactive = interactive
+        self.decode_workers = decode_workers
         self.dirname = ""
         self.filename = ""
         self.fullpath = ""
@@ -217,7 +220,7 @@ If initpath is a directory and not in interactive mode, it's an error."""
                 self.type = 'avi'
             except:
                 try:
-                    self.h_mov = CompressedAvi( self.fullpath )
+                    self.h_mov = self.open_compressed_avi()
                     self.type = 'cavi'
                 except Exception as details:
                     if self.interactive:
@@ -249,7 +252,7 @@ If initpath is a directory and not in interactive mode, it's an error."""
         # unknown movie type
         else:
             try:
-                self.h_mov = CompressedAvi( self.fullpath )
+                self.h_mov = self.open_compressed_avi()
                 self.type = 'cavi'
             except:
                 if self.interactive:
@@ -269,12 +272,20 @@ If initpath is a directory and not in interactive mode, it's an error."""
         self.bufferedframe_num = None
 
 
+    def open_compressed_avi( self ):
+        if self.decode_workers > 0 and not is_indexed_mjpg( self.fullpath ):
+            return ParallelCompressedAvi( self.fullpath, self.decode_workers )
+        return CompressedAvi( self.fullpath )
+
+
     def is_open( self ):
         return hasattr( self, 'h_mov' )
 
 
     def close( self ):
         """Close the movie file."""
+        if hasattr( self.h_mov, 'stop_decoders' ):
+            self.h_mov.stop_decoders()
         del self.file_lock
         del self.h_mov
         del self.type
@@ -316,6 +327,66 @@ If initpath is a directory and not in interactive mode, it's an error."""
         frame, stamp = self.h_mov.get_frame( framenumber )
         return frame, stamp
 
+    def get_frames( self, start, stop=None, step=1 ):
+        """Return (frames, stamps) for get_frames(start, stop, step) or get_frames(framenumbers).
+        frames is a N x H x W x C array in the requested order. Frames are read in increasing order,
+        each frame once, using the reader's get_frames for block reads if it has one."""
+        if stop is None and not num.isscalar( start ):
+            framenumbers = num.asarray( start, dtype=int ).ravel()
+        elif stop is None:
+            framenumbers = num.array( [start], dtype=int )
+        else:
+            framenumbers = num.arange( start, stop, step, dtype=int )
+        nfr = len( framenumbers )
+        if nfr == 0:
+            return num.zeros( [0, self.get_height(), self.get_width(), 1], dtype=num.uint8 ), num.zeros( [0] )
+
+        ufr, inv = num.unique( framenumbers, return_inverse=True )
+        with self.file_lock:
+            try:
+                if hasattr( self.h_mov, 'get_frames' ):
+                    ims, ustamps = self.h_mov.get_frames( ufr )
+                    ims = num.asarray( ims )
+                    if ims.ndim == 3:
+                        ims = ims[..., num.newaxis]
+                    # avoid the copy only when framenumbers are already sorted and unique
+                    in_order = len( ufr ) == nfr and num.array_equal( ufr, framenumbers )
+                    frames = ims if in_order else ims[inv]
+                    stamps = num.asarray( ustamps )[inv]
+                else:
+                    frames = None
+                    stamps = num.zeros( nfr )
+                    for ndx, fr in enumerate( ufr ):
+                        im, stamp = self.h_mov.get_frame( fr )
+                        if im.ndim == 2:
+                            im = im[:, :, num.newaxis]
+                        if frames is None:
+                            frames = num.zeros( (nfr,) + im.shape, dtype=im.dtype )
+                        sel = inv == ndx
+                        frames[sel] = im
+                        stamps[sel] = stamp
+            except (IndexError, NoMoreFramesException):
+                if self.interactive:
+                    wx.MessageBox( "Frame numbers %d to %d out of range"%(ufr[0], ufr[-1]), "Error", wx.ICON_ERROR|wx.OK )
+                else:
+                    print("frames", ufr[0], "to", ufr[-1], "out of range")
+                raise
+            except (ValueError, AssertionError):
+                if self.interactive:
+                    wx.MessageBox( "Error reading frames %d to %d"%(ufr[0], ufr[-1]), "Error", wx.ICON_ERROR|wx.OK )
+                else:
+                    print("error reading frames", ufr[0], "to", ufr[-1])
+                raise
+
+            # store the last frame in the buffer, as get_frame would have
+            last = num.flatnonzero( inv == len( ufr ) - 1 )[0]
+            im = frames[last]
+            self.bufferedframe_im = im[:, :, 0].copy() if im.shape[2] == 1 else im.copy()
+            self.bufferedframe_stamp = stamps[last]
+            self.bufferedframe_num = ufr[-1]
+
+        return frames, stamps
+
     def get_n_frames( self ):
         with self.file_lock:
             return self.h_mov.get_n_frames()
@@ -1087,6 +1158,33 @@ class Avi:
     # end class Avi
 
 
+def is_indexed_mjpg(filename):
+    """True for mjpg movies with an index file, which are read as jpgs."""
+    index_file = os.path.splitext(filename)[0] + '.txt'
+    return os.path.splitext(filename)[1] == '.mjpg' and os.path.exists(index_file)
+
+
+def convert_cv_frame(im,height,width,color_depth):
+    """Frame read by OpenCV as an RGB or grayscale array."""
+    frame = num.frombuffer(im.data,num.uint8)
+
+    if color_depth == 1:
+        frame.resize((height,width))
+    else: # color_depth == 3
+        frame.resize( (height, width, 3) )
+        # Mayank 20190906 - opencv by default read the image into BGR format. Surprisingly this wasn't an issue before.
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        # tmp = frame.astype(float)
+        # tmp = tmp[:,2:self.width*3:3]*.3 + \
+        #     tmp[:,1:self.width*3:3]*.59 + \
+        #     tmp[:,0:self.width*3:3]*.11
+        # frame = tmp.astype(num.uint8)
+
+    # frame = num.flipud(frame)
+
+    return frame
+
+
 class CompressedAvi:
     """Use OpenCV to read compressed avi files."""
 
@@ -1097,7 +1195,7 @@ class CompressedAvi:
         self.filename = filename
 
         index_file = os.path.splitext(filename)[0] + '.txt'
-        if os.path.splitext(filename)[1] == '.mjpg' and os.path.exists(index_file):
+        if is_indexed_mjpg(filename):
             with open(index_file) as f:
                 import csv
                 rr = csv.reader(f, delimiter=' ')
@@ -1247,24 +1345,13 @@ class CompressedAvi:
         if not retval:
             raise IOError( "OpenCV failed reading frame %d" % self.currframe )
 
-        frame = num.frombuffer(im.data,num.uint8)
-
-        if self.color_depth == 1:
-            frame.resize((self.height,self.width))
-        else: # color_depth == 3
-            frame.resize( (self.height, self.width, 3) )
-            # Mayank 20190906 - opencv by default read the image into BGR format. Surprisingly this wasn't an issue before.
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            # tmp = frame.astype(float)
-            # tmp = tmp[:,2:self.width*3:3]*.3 + \
-            #     tmp[:,1:self.width*3:3]*.59 + \
-            #     tmp[:,0:self.width*3:3]*.11
-            # frame = tmp.astype(num.uint8)
-
-        # frame = num.flipud(frame)
+        frame = self._convert_frame(im)
 
         return (frame,ts)
 
+    def _convert_frame(self,im):
+        return convert_cv_frame(im,self.height,self.width,self.color_depth)
+
     def get_next_frame(self):
 
         (frame,ts) = self._get_next_frame_helper()
@@ -1407,6 +1494,159 @@ class CompressedAvi:
             self.source.set( cv2.CAP_PROP_POS_FRAMES, self.currframe )
         return self.currframe
 
+
+class ParallelCompressedAvi(CompressedAvi):
+    """CompressedAvi that decodes the movie with worker processes.
+
+    The movie is split into segments of segment_len frames. OpenCV doesn't expose where the
+    keyframes are, so the segments start at multiples of segment_len and seeking to the start of a
+    segment decodes from the preceding keyframe. Each worker decodes whole segments with its own
+    capture handle into shared memory slots. The segments are given to the reader in order, and
+    upto n_slots segments are buffered for reordering. Frames before the current segment are read
+    sequentially as in CompressedAvi.
+    The workers are started with forkserver (or spawn) rather than fork, as they may be started
+    after the tracking network has created its threads and GPU context. They only get the
+    filename, the frame shape and the shared buffers and queues."""
+
+    def __init__(self,filename,n_workers,segment_len=None,n_slots=None):
+        CompressedAvi.__init__(self,filename)
+        self.n_workers = n_workers
+        self.segment_len = int(self.buffersize if segment_len is None else segment_len)
+        self.n_slots = 2*n_workers if n_slots is None else max(n_slots,n_workers)
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        self.ctx = multiprocessing.get_context(start_method)
+        self.slot_ims = None
+        self.workers = []
+        self.cur_seg = None # segment that is being read
+        self.cur_slot = None
+        self.ready = {} # decoded segments that haven't been read yet. seg -> (slot, n_frames)
+
+    def _alloc_slots(self):
+        shape = (self.segment_len,self.height,self.width,self.color_depth)
+        self.slot_bufs = [(self.ctx.RawArray('B',int(num.prod(shape))),self.ctx.RawArray('d',self.segment_len)) for _ in range(self.n_slots)]
+        self.slot_ims = [num.frombuffer(b,dtype=num.uint8).reshape(shape) for b,_ in self.slot_bufs]
+        self.slot_ts = [num.frombuffer(t,dtype=num.float64) for _,t in self.slot_bufs]
+
+    def start_decoders(self,seg):
+        """Start decoding from segment seg."""
+        self.stop_decoders()
+        if self.slot_ims is None:
+            self._alloc_slots()
+        self.free_q = self.ctx.Queue()
+        self.full_q = self.ctx.Queue()
+        self.next_seg = self.ctx.Value('l',seg)
+        for slot in range(self.n_slots):
+            self.free_q.put(slot)
+        for ndx in range(self.n_workers):
+            p = self.ctx.Process(target=_decode_segments,name='decoder_{}'.format(ndx),
+                                 args=(self.filename,self.slot_ims[0].shape,self.n_frames,
+                                       self.slot_bufs,self.free_q,self.full_q,self.next_seg))
+            p.daemon = True
+            p.start()
+            self.workers.append(p)
+        self.cur_seg = seg
+        if DEBUG_MOVIES: print("started %d decoders at frame %d"%(self.n_workers,seg*self.segment_len))
+
+    def stop_decoders(self):
+        if len(self.workers) > 0:
+            for _ in self.workers:
+                self.free_q.put(None)
+            for p in self.workers:
+                p.join(5)
+                if p.is_alive():
+                    p.terminate()
+        self.workers = []
+        self.cur_seg = None
+        self.cur_slot = None
+        self.ready = {}
+
+    def get_frame(self,framenumber):
+        """Read frame from the decoded segments and return as NumPy array."""
+
+        if framenumber < 0: raise IndexError
+        if framenumber >= self.n_frames:
+            return CompressedAvi.get_frame(self,framenumber)
+
+        seg = framenumber//self.segment_len
+        if self.cur_seg is not None and seg < self.cur_seg:
+            return CompressedAvi.get_frame(self,framenumber)
+        if self.cur_seg is None or seg >= self.cur_seg + self.n_slots:
+            self.start_decoders(seg)
+
+        if seg != self.cur_seg or self.cur_slot is None:
+            # done with the segments before seg
+            if self.cur_slot is not None:
+                self.free_q.put(self.cur_slot)
+                self.cur_slot = None
+            for s in sorted(self.ready.keys()):
+                if s < seg:
+                    self.free_q.put(self.ready.pop(s)[0])
+            while seg not in self.ready:
+                slot, s, n_read = self.full_q.get()
+                if slot is None:
+                    raise IOError("Decoding %s failed: %s"%(self.filename,n_read))
+                if s < seg:
+                    self.free_q.put(slot)
+                else:
+                    self.ready[s] = (slot,n_read)
+            self.cur_slot, self.cur_n = self.ready.pop(seg)
+            self.cur_seg = seg
+
+        off = framenumber - seg*self.segment_len
+        if off >= self.cur_n:
+            raise IOError( "OpenCV failed reading frame %d" % framenumber )
+        frame = self.slot_ims[self.cur_slot][off]
+        if self.color_depth == 1:
+            frame = frame[:,:,0]
+        return (frame.copy(),self.slot_ts[self.cur_slot][off])
+
+
+def _decode_segments(filename,shape,n_frames,slot_bufs,free_q,full_q,next_seg):
+    """Decode worker of ParallelCompressedAvi. Decodes the segment in next_seg into each slot
+    taken from free_q, and puts (slot, segment, number of frames read) in full_q.
+    shape is the shape of a slot, segment_len x height x width x color_depth."""
+    if hasattr(cv2, 'cv'): # OpenCV 2.x
+        pos_frames, pos_msec = cv2.cv.CV_CAP_PROP_POS_FRAMES, cv2.cv.CV_CAP_PROP_POS_MSEC
+    else: # OpenCV 3.x
+        pos_frames, pos_msec = cv2.CAP_PROP_POS_FRAMES, cv2.CAP_PROP_POS_MSEC
+    cv2.setNumThreads(0) # the workers decode in parallel already
+    source = cv2.VideoCapture(filename)
+    pos = 0
+    segment_len,height,width,color_depth = shape
+    try:
+        slot_ims = [num.frombuffer(b,dtype=num.uint8).reshape(shape) for b,_ in slot_bufs]
+        slot_ts = [num.frombuffer(t,dtype=num.float64) for _,t in slot_bufs]
+        while True:
+            slot = free_q.get()
+            if slot is None:
+                break
+            with next_seg.get_lock():
+                seg = next_seg.value
+                next_seg.value += 1
+            f0 = seg*segment_len
+            n = max(0,min(segment_len,n_frames-f0))
+            if n > 0 and pos != f0:
+                source.set(pos_frames,f0)
+            n_read = 0
+            while n_read < n:
+                ts = source.get(pos_msec)/1000.
+                retval, im = source.read()
+                if not retval:
+                    break
+                slot_ims[slot][n_read] = convert_cv_frame(im,height,width,color_depth).reshape(shape[1:])
+                slot_ts[slot][n_read] = ts
+                n_read += 1
+            pos = f0 + n_read
+            full_q.put((slot,seg,n_read))
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    except Exception as e:
+        logging.exception('Error decoding %s'%filename)
+        full_q.put((None,None,'%s'%e))
+    finally:
+        source.release()
+
+
 def write_results_to_avi(movie,tracks,filename,f0=None,f1=None):
 
     nframes = len(tracks)
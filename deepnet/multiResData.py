@@ -17,12 +17,8 @@ import pickle
 import h5py
 import errno
 import PoseTools
-import tensorflow
-vv = [int(v) for v in tensorflow.__version__.split('.')]
-if vv[0]==1 and vv[1]>12:
-    tf = tensorflow.compat.v1
-else:
-    tf = tensorflow
+from lazy_import import lazy_tf
+tf = lazy_tf()
 
 import movies
 import json
@@ -453,19 +449,20 @@ def create_envs(conf, split, db_type=None):
         return env, val_env
 
 
-def get_patch(cap, fnum, conf, locs, offset=0, stationary=True, cur_trx=None, flipud=False, crop_loc=None):
+def get_patch(cap, fnum, conf, locs, offset=0, stationary=True, cur_trx=None, flipud=False, crop_loc=None, frame=None):
     '''
     fnum is the frame number
     cur_trx == None indicates that the project doesnt have trx file.
     offset is used for multiframe
     stationary is also used for multiframe.
     crop_loc is the cropping location. It should be 0-indexed.
+    frame is the already read (not flipped) frame fnum, e.g. from cap.get_frames. If None, the frame is read from cap.
 
     '''
     if cur_trx is not None: # when there are trx
-        return get_patch_trx(cap, cur_trx, fnum, conf, locs, offset, stationary,flipud)
+        return get_patch_trx(cap, cur_trx, fnum, conf, locs, offset, stationary,flipud, frame=frame)
     else:
-        frame_in, _, _, _ = read_frame(cap,fnum,cur_trx,flipud=flipud, offset=offset)
+        frame_in, _, _, _ = read_frame(cap,fnum,cur_trx,flipud=flipud, offset=offset, frame=frame)
         frame_in = frame_in[:,:,0:conf.img_dim]
         if crop_loc is not None:
             xlo, xhi, ylo, yhi = crop_loc
@@ -557,8 +554,9 @@ def read_trx(cur_trx, fnum):
     return x, y, theta
 
 
-def read_frame(cap, fnum, cur_trx, offset=0, stationary=True,flipud=False):
+def read_frame(cap, fnum, cur_trx, offset=0, stationary=True,flipud=False, frame=None):
     # stationary means that fly will always be in the center of the frame
+    # frame, if given, is the frame fnum and is used instead of reading it again.
     if not check_fnum(fnum, cap, 0, 0):
         return None, None, None, None
     o_fnum = fnum + offset
@@ -572,7 +570,10 @@ def read_frame(cap, fnum, cur_trx, offset=0, stationary=True,flipud=False):
         o_fnum = 0 if o_fnum < 0 else o_fnum
         o_fnum = cap.get_n_frames()-1 if o_fnum > (cap.get_n_frames()-1) else o_fnum
 
-    framein = cap.get_frame(o_fnum)[0]
+    if frame is not None and o_fnum == fnum:
+        framein = frame
+    else:
+        framein = cap.get_frame(o_fnum)[0]
     if flipud:
         framein = np.flipud(framein)
     if framein.ndim == 2:
@@ -585,9 +586,9 @@ def read_frame(cap, fnum, cur_trx, offset=0, stationary=True,flipud=False):
     return framein, x, y, theta
 
 
-def get_patch_trx(cap, cur_trx, fnum, conf, locs, offset=0, stationary=True,flipud=False):
+def get_patch_trx(cap, cur_trx, fnum, conf, locs, offset=0, stationary=True,flipud=False, frame=None):
     # assert conf.imsz[0] == conf.imsz[1]
-    im, x, y, theta = read_frame(cap, fnum, cur_trx, offset, stationary,flipud)
+    im, x, y, theta = read_frame(cap, fnum, cur_trx, offset, stationary,flipud, frame=frame)
     return crop_patch_trx(conf, im,x,y,theta, locs)
 
 
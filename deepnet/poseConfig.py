@@ -71,6 +71,12 @@ class config(object):
         self.valratio = 0.3
         self.holdoutratio = 0.8
         self.flipud = False
+        self.movie_decode_workers = 0 # worker processes that decode compressed movies in parallel while tracking. 0 => sequential decoding
+        self.tf_augment = False # augment with tensorflow ops instead of py_func in the tf dataset pipeline
+        self.dataset_shuffle_buffer = 100
+        self.dataset_prefetch_buffer = 100
+        self.batch_workers = 0 # worker processes that create batches for PoseCommon based nets. 0 => threads
+        self.batch_shm_slots = None # shared memory batch buffers for the workers. None => 2*batch_workers
 
         # ----- UNet params
         self.unet_rescale = 1
@@ -137,6 +143,8 @@ class config(object):
 
         # ------ Leap params
         self.leap_net_name = "leap_cnn"
+        self.leap_lazy_data = True  # read training batches from the h5 file as needed
+        self.leap_data_workers = 0  # keras worker processes for the training data. Needs leap_lazy_data
 
         # ----- Deep Lab Cut
         self.dlc_train_img_dir = 'train'
@@ -187,6 +195,21 @@ class config(object):
         self.max_n_animals = 1
         self.bb_ex = 0 # extra margin to keep around annotations while generating masks
         self.n_grid = 1 # Number of cells to split the image into for multianimal
+        self.link_maxcost = None # cost above which detections in consecutive frames are not linked. None => estimated from the first link_maxcost_nframes frames
+        self.link_maxcost_nframes = 100
+        self.link_maxframes_missed = 4 # longest gap in a trajectory that is stitched
+        self.link_maxframes_delete = 10 # trajectories of at most these many frames are deleted
+
+        # ============== TWO STAGE ==========
+        # For projects without trx. If detect_crop_sz ([height, width]) is set, the pose network is trained and
+        # tracked on crops of that size around the animal. While tracking, the animal is found by a detector
+        # network, which is the same type of network trained on whole frames, usually at a lower resolution,
+        # e.g. with -train_name detect -conf_params rescale 4.
+        self.detect_crop_sz = None
+        self.detect_train_name = 'detect'
+        self.detect_net_type = None # None => same as the pose network
+        self.detect_model_file = None # None => latest model of detect_train_name
+        self.detect_rescale = None # rescale the detector was trained with. None => rescale
 
 
         # ============== EXTRA ================
@@ -203,12 +226,31 @@ class config(object):
         self.att_hist = 128
         self.att_layers = [1] # use layer this far from the middle (top?) layers.
 
+        # ----- Tracking parameters
+        self.track_batch_size = None # batch size for tracking. None => same as batch_size used for training
+        self.track_autotune = False # probe batch sizes for tracking and use the fastest one that fits in memory
+        self.track_autotune_max_bsize = 64
+        self.track_autotune_mem_frac = 0.9 # fraction of device memory that autotune can use
+        self.track_autotune_reps = 5 # number of timed predictions per probed batch size
+        self.track_intra_op_threads = 0 # threads used within an op by exported models. 0 => let the framework decide
+        self.track_inter_op_threads = 0
+        self.track_list_readers = 0 # processes that read movies while tracking lists (eg GT). 0 => read in the tracking process
+        self.track_reuse_thresh = None # reuse the last prediction for a target if its input patch changed by less than this (mean absolute pixel difference). None => predict every frame
+        self.track_reuse_max_gap = 10 # predict at least every these many frames when reusing predictions
+        self.hmap_quantize = False # store heatmaps saved while tracking as uint8
+        self.hmap_peak_window = 0 # if > 0, store only a window of this radius around the peak of each heatmap
+        self.hmap_decimate = 1 # store heatmaps for every n-th frame
+        self.hmap_compression_level = 4
+        self.trk_filter = None # temporal filter for the tracking output: median, savgol or kalman. See trk_filter
+        self.trk_filter_params = {} # keyword arguments for the filter, eg {"window": 5}
+
         # ----- Save parameters
 
         self.save_time = None
         self.save_step = 2000
         self.save_td_step = 100
         self.maxckpt = 30
+        self.async_save = True # write checkpoints and training info on a background thread
         self.cachedir = ''
         self.project_file = ''
 
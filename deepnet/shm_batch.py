@@ -0,0 +1,119 @@
+''' Multi-process batch producer with shared memory buffers.
+
+Worker processes create batches (read + augment) and write them into a ring of shared memory
+slots. The consumer gets filled slots in the order they are ready, uses them directly as numpy
+arrays (no pickling or copying between processes) and releases them back to the workers.
+
+The batch function is inherited by the workers through fork, so it can be any closure. Tensorflow
+and CUDA state is not fork safe, so start() has to be called before any tensorflow session (and so
+CUDA context) is created. Workers are given different random seeds so that they produce different
+augmentations.
+'''
+
+import os
+import sys
+import logging
+import multiprocessing as mp
+import numpy as np
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class ShmBatchProducer(object):
+
+    def __init__(self, batch_fn, spec, n_workers=4, n_slots=None, seed=None, name='producer'):
+        ''' batch_fn(worker_id) is called once in each worker and should return a function that creates
+        the next batch as a dict of arrays. spec is a list of [name, shape] of the arrays to share. '''
+        self.spec = [(k, tuple(int(s) for s in v)) for k, v in spec]
+        self.n_workers = n_workers
+        self.n_slots = 2 * n_workers if n_slots is None else max(int(n_slots), 1)
+        self.batch_fn = batch_fn
+        self.seed = np.random.randint(2 ** 31) if seed is None else seed
+        self.name = name
+        self.ctx = mp.get_context('fork')
+
+        self.buffers = []
+        self.slots = []
+        for _ in range(self.n_slots):
+            cur_buf = {}
+            cur_slot = {}
+            for k, shape in self.spec:
+                b = self.ctx.RawArray('f', int(np.prod(shape)))
+                cur_buf[k] = b
+                cur_slot[k] = np.frombuffer(b, dtype=np.float32).reshape(shape)
+            self.buffers.append(cur_buf)
+            self.slots.append(cur_slot)
+
+        self.free_q = self.ctx.Queue()
+        self.full_q = self.ctx.Queue()
+        for ndx in range(self.n_slots):
+            self.free_q.put(ndx)
+        self.workers = []
+        self.stopped = False
+
+    def start(self):
+        for w_ndx in range(self.n_workers):
+            p = self.ctx.Process(target=self._worker, args=(w_ndx,), name='{}_{}'.format(self.name, w_ndx))
+            p.daemon = True
+            p.start()
+            self.workers.append(p)
+        logging.info('Started {} batch workers with {} shared memory slots for {}'.format(self.n_workers, self.n_slots, self.name))
+
+    def _worker(self, w_ndx):
+        seed = (self.seed + 7919 * (w_ndx + 1)) % (2 ** 31)
+        np.random.seed(seed)
+        try:
+            import cv2
+            cv2.setNumThreads(0)  # cv2's thread pool doesn't survive fork
+        except ImportError:
+            pass
+        try:
+            next_batch = self.batch_fn(w_ndx)
+            while True:
+                slot = self.free_q.get()
+                if slot is None:
+                    break
+                batch = next_batch()
+                for k, _ in self.spec:
+                    self.slots[slot][k][...] = batch[k]
+                self.full_q.put(slot)
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        except Exception as e:
+            logging.exception('Error in batch worker {} of {}'.format(w_ndx, self.name))
+            self.full_q.put(('error', '{}'.format(e)))
+        finally:
+            sys.stdout.flush()
+
+    def get(self, timeout=None):
+        ''' Returns (slot, batch). batch is a dict of arrays that are valid until release(slot) is called.
+        Raises queue.Empty if no batch is ready in timeout seconds, and RuntimeError if a worker has died
+        (eg killed by a segfault or the OOM killer) without reporting an error. '''
+        try:
+            slot = self.full_q.get(timeout=timeout)
+        except queue.Empty:
+            dead = [p for p in self.workers if not p.is_alive()]
+            if not self.stopped and len(dead) > 0:
+                raise RuntimeError('Batch worker {} of {} died with exit code {}'.format(dead[0].name, self.name, dead[0].exitcode))
+            raise
+        if isinstance(slot, tuple):
+            raise RuntimeError('Batch worker of {} failed: {}'.format(self.name, slot[1]))
+        return slot, self.slots[slot]
+
+    def release(self, slot):
+        self.free_q.put(slot)
+
+    def stop(self):
+        if self.stopped:
+            return
+        self.stopped = True
+        for _ in self.workers:
+            self.free_q.put(None)
+        for p in self.workers:
+            p.join(5)
+            if p.is_alive():
+                p.terminate()
+        self.workers = []
@@ -0,0 +1,164 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import json
+import pickle
+import threading
+import collections
+import pytest
+import ckpt_writer
+
+
+def test_atomic_write(tmp_path):
+    out_file = str(tmp_path / 'out.json')
+    ckpt_writer.atomic_write(out_file, lambda f: f.write('old'), mode='w')
+
+    def failing_write(f):
+        f.write('partial')
+        raise IOError('disk full')
+
+    with pytest.raises(IOError):
+        ckpt_writer.atomic_write(out_file, failing_write, mode='w')
+    # the target is untouched if writing fails
+    with open(out_file) as f:
+        assert f.read() == 'old'
+
+    ckpt_writer.atomic_write(out_file, lambda f: f.write('new'), mode='w')
+    with open(out_file) as f:
+        assert f.read() == 'new'
+    assert not os.path.exists(out_file + '.tmp')
+
+
+def blocked_writer():
+    ''' Writer whose thread is busy till the returned event is set, so that jobs stay queued.'''
+    writer = ckpt_writer.CheckpointWriter()
+    release = threading.Event()
+    started = threading.Event()
+
+    def block():
+        started.set()
+        release.wait()
+
+    writer.submit(block)
+    started.wait()
+    return writer, release
+
+
+def test_jobs_run_in_order():
+    writer, release = blocked_writer()
+    done = []
+    for ndx in range(5):
+        writer.submit(lambda ndx=ndx: done.append(ndx))
+    release.set()
+    writer.wait()
+    assert done == list(range(5))
+
+
+def test_keyed_job_replaces_queued():
+    writer, release = blocked_writer()
+    done = []
+    writer.submit(lambda: done.append('td1'), key='td')
+    writer.submit(lambda: done.append('ckpt'))
+    writer.submit(lambda: done.append('td2'), key='td')
+    writer.submit(lambda: done.append('other'), key='other')
+    release.set()
+    writer.wait()
+    # td2 takes the place of td1 in the queue
+    assert done == ['td2', 'ckpt', 'other']
+
+    # a job that has already run is not replaced
+    writer.submit(lambda: done.append('td3'), key='td')
+    writer.wait()
+    assert done[-1] == 'td3'
+
+
+def test_error_propagates():
+    writer = ckpt_writer.CheckpointWriter()
+
+    def fail():
+        raise ValueError('bad checkpoint')
+
+    writer.submit(fail)
+    with pytest.raises(RuntimeError, match='bad checkpoint'):
+        writer.wait()
+    # the error is reported once, and the writer keeps working
+    done = []
+    writer.submit(lambda: done.append(1))
+    writer.wait()
+    assert done == [1]
+
+
+def test_error_raised_on_next_submit():
+    writer, release = blocked_writer()
+
+    def fail():
+        raise ValueError('bad checkpoint')
+
+    writer.submit(fail)
+    release.set()
+    with writer.cond:
+        while len(writer.jobs) > 0 or writer.busy:
+            writer.cond.wait()
+    with pytest.raises(RuntimeError, match='bad checkpoint'):
+        writer.submit(lambda: None)
+
+
+def test_sync_writer():
+    writer = ckpt_writer.CheckpointWriter(async_write=False)
+    done = []
+    writer.submit(lambda: done.append(1))
+    assert done == [1]
+    with pytest.raises(ValueError):
+        writer.submit(lambda: int('x'))
+
+
+def test_save_td(tmp_path):
+    td_file = str(tmp_path / 'deepnet_traindata')
+    writer = ckpt_writer.CheckpointWriter()
+    conf = {'batch_size': 8}
+    train_info = collections.OrderedDict([('step', [0, 50]), ('train_dist', [10., 5.])])
+    n_logged = ckpt_writer.save_td(writer, td_file, train_info, conf)
+    assert n_logged == 2
+    train_info['step'].append(100)
+    train_info['train_dist'].append(2.5)
+    n_logged = ckpt_writer.save_td(writer, td_file, train_info, conf, n_logged)
+    assert n_logged == 3
+    writer.wait()
+
+    with open(td_file, 'rb') as f:
+        saved_info, saved_conf = pickle.load(f)
+    assert saved_info['step'] == [0, 50, 100]
+    assert saved_conf == conf
+    with open(td_file + '.json') as f:
+        assert json.load(f)['train_dist'] == [10., 5., 2.5]
+    with open(td_file + '.jsonl') as f:
+        entries = [json.loads(l) for l in f]
+    assert [e['step'] for e in entries] == [0, 50, 100]
+
+
+class Trainer(ckpt_writer.BackgroundSaveMixin):
+    def __init__(self, td_file):
+        self.conf = {'async_save': True}
+        self.td_file = td_file
+        self.train_info = collections.OrderedDict([('step', [0]), ('train_dist', [10.])])
+
+    def get_td_file(self):
+        return self.td_file
+
+
+def test_background_save_mixin(tmp_path):
+    trainer = Trainer(str(tmp_path / 'traindata'))
+    trainer.wait_for_saves()  # nothing to wait for
+    trainer.save_td()
+    trainer.train_info['step'].append(50)
+    trainer.train_info['train_dist'].append(5.)
+    trainer.save_td()
+    other_file = str(tmp_path / 'other_traindata')
+    trainer.save_td(other_file)
+    assert trainer.get_writer() is trainer.get_writer()
+    trainer.wait_for_saves()
+
+    with open(trainer.td_file + '.jsonl') as f:
+        assert [json.loads(l)['step'] for l in f] == [0, 50]
+    with open(other_file, 'rb') as f:
+        assert pickle.load(f)[0]['step'] == [0, 50]
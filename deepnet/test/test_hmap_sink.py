@@ -0,0 +1,97 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+import pytest
+import hmap_sink
+
+H, W, N_PARTS = 20, 24, 3
+N_FRAMES = 10
+N_TRX = 8
+START = 5
+
+
+def make_hmaps(n, seed=0):
+    rng = np.random.RandomState(seed)
+    hmaps = rng.rand(n, H, W, N_PARTS).astype('float32') * 3 - 1
+    # put the peaks near the corners and the middle so that the windows get clipped
+    peaks = [(0, 0), (H - 1, W - 1), (H // 2, 1)]
+    for p, (y, x) in enumerate(peaks):
+        hmaps[:, y, x, p] = 5.
+    return hmaps
+
+
+def write_all(out_file, trx_ids, bsize=4, **kwargs):
+    ''' Writes heatmaps for all frames of targets trx_ids in frame major order, in batches of bsize as
+    classify_movie does. Returns dict (frame, target) -> heatmap.'''
+    to_do = [(START + f, t) for f in range(N_FRAMES) for t in trx_ids]
+    hmaps = make_hmaps(len(to_do))
+    writer = hmap_sink.HmapWriter(out_file, START, N_FRAMES, N_TRX, **kwargs)
+    for b0 in range(0, len(to_do), bsize):
+        cur = np.array(to_do[b0:b0 + bsize])
+        writer.write('hmaps', hmaps[b0:b0 + bsize], cur[:, 0], cur[:, 1])
+    writer.close()
+    return {k: hmaps[ndx] for ndx, k in enumerate(to_do)}
+
+
+# [0, 7] covers little of the batch's block of rows x targets, so it is written per target
+@pytest.mark.parametrize('trx_ids', [[0], [0, 1, 2], [0, 2], [0, 7]])
+def test_float_round_trip(tmp_path, trx_ids):
+    out_file = str(tmp_path / 'hmap.h5')
+    expected = write_all(out_file, trx_ids)
+    reader = hmap_sink.HmapReader(out_file)
+    for (fnum, t), hmap in expected.items():
+        np.testing.assert_array_equal(reader.get('hmaps', fnum, t), hmap)
+        np.testing.assert_array_equal(reader.get('hmaps', fnum, t, part=1), hmap[..., 1])
+    for t in trx_ids:
+        np.testing.assert_array_equal(reader.frames('hmaps', t), START + np.arange(N_FRAMES))
+    reader.close()
+
+
+def test_quantized_round_trip(tmp_path):
+    out_file = str(tmp_path / 'hmap.h5')
+    expected = write_all(out_file, [0, 1], quantize=True)
+    reader = hmap_sink.HmapReader(out_file)
+    for (fnum, t), hmap in expected.items():
+        out = reader.get('hmaps', fnum, t)
+        tol = (hmap.max(axis=(0, 1)) - hmap.min(axis=(0, 1))) / 255.
+        assert np.all(np.abs(out - hmap) <= tol[None, None, :] + 1e-6)
+    reader.close()
+
+
+@pytest.mark.parametrize('quantize', [False, True])
+def test_peak_window(tmp_path, quantize):
+    out_file = str(tmp_path / 'hmap.h5')
+    pw = 3
+    expected = write_all(out_file, [0, 1, 2], peak_window=pw, quantize=quantize)
+    reader = hmap_sink.HmapReader(out_file)
+    for (fnum, t), hmap in expected.items():
+        out = reader.get('hmaps', fnum, t)
+        for p in range(N_PARTS):
+            py, px = np.unravel_index(np.argmax(hmap[..., p]), (H, W))
+            oy = min(max(py - pw, 0), H - 2 * pw - 1)
+            ox = min(max(px - pw, 0), W - 2 * pw - 1)
+            in_win = np.zeros([H, W], dtype=bool)
+            in_win[oy:oy + 2 * pw + 1, ox:ox + 2 * pw + 1] = True
+            assert np.all(out[~in_win, p] == 0)
+            win = hmap[in_win, p]
+            tol = (win.max() - win.min()) / 255. + 1e-6 if quantize else 0
+            assert np.all(np.abs(out[in_win, p] - win) <= tol)
+    reader.close()
+
+
+def test_missing_frames_raise(tmp_path):
+    out_file = str(tmp_path / 'hmap.h5')
+    write_all(out_file, [0, 2], decimate=3)
+    reader = hmap_sink.HmapReader(out_file)
+    np.testing.assert_array_equal(reader.frames('hmaps', 0), START + np.arange(0, N_FRAMES, 3))
+    reader.get('hmaps', START + 3, 0)
+    with pytest.raises(KeyError):
+        reader.get('hmaps', START + 1, 0)  # decimated
+    with pytest.raises(KeyError):
+        reader.get('hmaps', START + 3, 1)  # target not tracked
+    with pytest.raises(KeyError):
+        reader.get('hmaps', START - 1, 0)  # before start
+    with pytest.raises(KeyError):
+        reader.get('hmaps', START + 3 * N_FRAMES, 0)  # after the end
+    reader.close()
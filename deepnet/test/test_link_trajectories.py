@@ -0,0 +1,98 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+import link_trajectories as lnk
+
+D = 2
+N_PTS = 5
+T = 60
+
+
+def make_params():
+    return {'maxcost': 1., 'maxframes_missed': 3, 'maxframes_delete': 2, 'verbose': 0}
+
+
+def make_detections(seed=0, n_animals=8, n_spurious=6):
+    ''' Synthetic detections, d x nlandmarks x maxnanimals x T with nan padding. Animals are far apart and
+    move slowly, come and go, and have gaps that are short enough to stitch or too long to. Spurious
+    detections last 1 or 2 frames and should be deleted.'''
+    rng = np.random.RandomState(seed)
+    present = np.zeros((n_animals + n_spurious, T), bool)
+    present[0, :] = True
+    for a in range(1, n_animals):
+        t0 = rng.randint(0, T // 2)
+        t1 = rng.randint(t0 + 10, T + 1)
+        present[a, t0:t1] = True
+        gap_len = rng.choice([1, 2, 3, 5])
+        gap_t0 = rng.randint(t0 + 3, t1 - 2)
+        present[a, gap_t0:gap_t0 + gap_len] = False
+    for a in range(n_animals, n_animals + n_spurious):
+        t0 = rng.randint(0, T - 2)
+        present[a, t0:t0 + rng.randint(1, 3)] = True
+
+    base = rng.rand(len(present), D, N_PTS) + 10. * np.arange(len(present))[:, None, None]
+    vel = (rng.rand(len(present), D, N_PTS) - 0.5) * 0.02
+    maxn = present.sum(axis=0).max()
+    p = np.full((D, N_PTS, maxn, T), np.nan)
+    for t in range(T):
+        animals = rng.permutation(np.nonzero(present[:, t])[0])
+        for slot, a in enumerate(animals):
+            p[:, :, slot, t] = base[a] + vel[a] * t
+    return p
+
+
+def batch_trajectories(p, params):
+    ''' Trajectories from assign_ids, stitch and delete_short in the format of OnlineLinker.'''
+    ids, _ = lnk.assign_ids(p, params)
+    ids, isdummy = lnk.stitch(p, ids, params)
+    ids, _ = lnk.delete_short(ids, params)
+    trs = []
+    for id in np.unique(ids[ids >= 0]):
+        slots, ts = np.nonzero(ids == id)
+        t0, t1 = ts.min(), ts.max()
+        tr_p = np.full(p.shape[:2] + (t1 - t0 + 1,), np.nan)
+        tr_p[:, :, ts - t0] = p[:, :, slots, ts].transpose([1, 2, 0])
+        trs.append({'t0': t0, 't1': t1, 'p': tr_p, 'isdummy': isdummy[id, t0:t1 + 1]})
+    return trs
+
+
+def sort_key(tr):
+    return (tr['t0'], tr['p'][0, 0, 0])
+
+
+def test_online_same_as_batch():
+    p = make_detections()
+    expected = sorted(batch_trajectories(p.copy(), make_params()), key=sort_key)
+
+    linker = lnk.OnlineLinker(make_params())
+    for t in range(T):
+        linker.add_frame(t, p[:, :, :, t])
+        if t == T // 2:
+            for tr in linker.trajectories():
+                assert tr['p'].shape[2] == tr['t1'] - tr['t0'] + 1
+                assert tr['isdummy'].shape == (tr['t1'] - tr['t0'] + 1,)
+    online = sorted(linker.finish(), key=sort_key)
+
+    assert linker.ndeleted > 0
+    assert any(tr['isdummy'].any() for tr in online)
+    assert len(online) == len(expected)
+    for tr, etr in zip(online, expected):
+        assert (tr['t0'], tr['t1']) == (etr['t0'], etr['t1'])
+        np.testing.assert_array_equal(tr['p'], etr['p'])
+        np.testing.assert_array_equal(tr['isdummy'], etr['isdummy'])
+        assert np.all(np.isnan(tr['p'][:, :, tr['isdummy']]))
+
+
+def test_skipped_frames_are_gaps():
+    p = make_detections(seed=1)
+    linker = lnk.OnlineLinker(make_params())
+    for t in range(T):
+        if t in (20, 21):
+            continue
+        linker.add_frame(t, p[:, :, :, t])
+    # animal 0 is always present, so it is stitched across the skipped frames
+    tr = [tr for tr in linker.finish() if tr['p'][0, 0, 0] < 5][0]
+    assert (tr['t0'], tr['t1']) == (0, T - 1)
+    assert tr['isdummy'][20] and tr['isdummy'][21]
+    assert np.count_nonzero(tr['isdummy']) == 2
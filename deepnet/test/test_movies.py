@@ -0,0 +1,127 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+import pytest
+import cv2
+import FlyMovieFormat
+import movies
+
+N_FRAMES = 20
+H, W = 12, 16
+
+
+class GetFrameOnly(object):
+    ''' Reader without get_frames, so that Movie.get_frames reads frame by frame.'''
+
+    def __init__(self, h_mov):
+        self.h_mov = h_mov
+
+    def get_frame(self, fnum):
+        return self.h_mov.get_frame(fnum)
+
+    def close(self):
+        self.h_mov.close()
+
+
+@pytest.fixture
+def fmf_file(tmp_path):
+    mov_file = str(tmp_path / 'test.fmf')
+    saver = FlyMovieFormat.FlyMovieSaver(mov_file, version=1)
+    for ndx in range(N_FRAMES):
+        # every pixel of frame ndx is 10*ndx so that frames can be identified
+        saver.add_frame(np.full([H, W], 10 * ndx, dtype=np.uint8), float(ndx) + 0.5)
+    saver.close()
+    return mov_file
+
+
+@pytest.fixture(params=['native', 'get_frame'])
+def mov(request, fmf_file):
+    cur_mov = movies.Movie(fmf_file)
+    if request.param == 'get_frame':
+        cur_mov.h_mov = GetFrameOnly(cur_mov.h_mov)
+    yield cur_mov
+    cur_mov.close()
+
+
+@pytest.mark.parametrize('fnums', [
+    [3, 4, 5, 6],
+    [7, 2, 11, 0],
+    [5, 5, 1, 5, 9, 1],
+    [19, 0],
+    [8],
+])
+def test_get_frames_order(mov, fnums):
+    ims, stamps = mov.get_frames(fnums)
+    assert ims.shape == (len(fnums), H, W, 1)
+    assert [int(im[0, 0, 0]) // 10 for im in ims] == fnums
+    np.testing.assert_allclose(stamps, np.array(fnums) + 0.5)
+
+
+def test_get_frames_matches_get_frame(mov):
+    fnums = [9, 3, 3, 17]
+    ims, stamps = mov.get_frames(fnums)
+    for ndx, fnum in enumerate(fnums):
+        im, stamp = mov.get_frame(fnum)
+        np.testing.assert_array_equal(ims[ndx].reshape(im.shape), im)
+        assert stamp == stamps[ndx]
+
+
+def test_get_frames_range(mov):
+    ims, stamps = mov.get_frames(2, 10, 3)
+    assert [int(im[0, 0, 0]) // 10 for im in ims] == [2, 5, 8]
+
+
+def test_get_frames_empty(mov):
+    ims, stamps = mov.get_frames([])
+    assert ims.shape[0] == 0
+    assert stamps.shape[0] == 0
+
+
+
+AVI_N_FRAMES = 60
+AVI_H, AVI_W = 32, 48
+
+
+@pytest.fixture
+def avi_file(tmp_path):
+    mov_file = str(tmp_path / 'test.avi')
+    writer = cv2.VideoWriter(mov_file, cv2.VideoWriter_fourcc(*'MJPG'), 30., (AVI_W, AVI_H))
+    if not writer.isOpened():
+        pytest.skip('OpenCV cannot write MJPG avi files')
+    rng = np.random.RandomState(0)
+    for ndx in range(AVI_N_FRAMES):
+        im = rng.randint(0, 255, [AVI_H, AVI_W, 3]).astype(np.uint8)
+        im[:8, :8] = 4 * ndx
+        writer.write(im)
+    writer.release()
+    return mov_file
+
+
+@pytest.mark.parametrize('fnums', [
+    list(range(AVI_N_FRAMES)),  # sequential
+    list(range(5)) + list(range(50, 55)),  # jump forward past the buffered segments
+    list(range(30, 40)) + list(range(3, 8)),  # read backwards
+])
+def test_parallel_avi_same_as_sequential(avi_file, fnums):
+    ref = movies.CompressedAvi(avi_file)
+    par = movies.ParallelCompressedAvi(avi_file, 2, segment_len=8, n_slots=2)
+    try:
+        for fnum in fnums:
+            ref_im, ref_ts = ref.get_frame(fnum)
+            im, ts = par.get_frame(fnum)
+            np.testing.assert_array_equal(im, ref_im)
+            assert ts == pytest.approx(ref_ts)
+    finally:
+        par.stop_decoders()
+
+
+def test_movie_decode_workers(avi_file):
+    cap = movies.Movie(avi_file, decode_workers=2)
+    assert isinstance(cap.h_mov, movies.ParallelCompressedAvi)
+    ims, _ = cap.get_frames(list(range(10)))
+    cap.close()
+    ref = movies.Movie(avi_file)
+    ref_ims, _ = ref.get_frames(list(range(10)))
+    ref.close()
+    np.testing.assert_array_equal(ims, ref_ims)
@@ -0,0 +1,73 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import math
+import numpy as np
+import pytest
+import easydict
+
+# imports tensorflow and the networks
+RNN_postprocess = pytest.importorskip('RNN_postprocess')
+
+HIST = 8
+N_CLASSES = 5
+FIRST_FRAME = 10  # 0-indexed
+N_TRX_FRAMES = 40
+
+
+def make_trx(seed=0):
+    rng = np.random.RandomState(seed)
+    return {'firstframe': np.array([[FIRST_FRAME + 1]]),  # 1-indexed as in the trx files
+            'endframe': np.array([[FIRST_FRAME + N_TRX_FRAMES]]),
+            'x': rng.rand(1, N_TRX_FRAMES) * 500,
+            'y': rng.rand(1, N_TRX_FRAMES) * 500,
+            'theta': (rng.rand(1, N_TRX_FRAMES) - 0.5) * 4 * math.pi}
+
+
+def loop_window_preds(pred_locs, conf, fnum, cur_trx, first_frame, end_frame):
+    ''' Per example alignment as done in RNN_pp.create_db when the predictions are not cached.'''
+    cur_pred = np.ones(pred_locs.shape) * np.nan
+    hsz = [float(conf.imsz[1]) / 2, float(conf.imsz[0]) / 2]
+    for e_ndx in range(2 * HIST):
+        trx_fnum = fnum - first_frame
+        trx_fnum_ex = fnum - first_frame + e_ndx - HIST
+        trx_fnum_ex = trx_fnum_ex if trx_fnum_ex > 0 else 0
+        end_ndx = end_frame - first_frame
+        trx_fnum_ex = trx_fnum_ex if trx_fnum_ex < end_ndx else end_ndx
+        temp_pred = pred_locs[e_ndx, :, :]
+        dx = cur_trx['x'][0, trx_fnum] - cur_trx['x'][0, trx_fnum_ex]
+        dy = cur_trx['y'][0, trx_fnum] - cur_trx['y'][0, trx_fnum_ex]
+        tt = cur_trx['theta'][0, trx_fnum] - cur_trx['theta'][0, trx_fnum_ex]
+        R = [[np.cos(tt), -np.sin(tt)], [np.sin(tt), np.cos(tt)]]
+        rr = (cur_trx['theta'][0, trx_fnum]) + math.pi / 2
+        Q = [[np.cos(rr), -np.sin(rr)], [np.sin(rr), np.cos(rr)]]
+        cur_pred[e_ndx, ...] = np.dot(temp_pred - hsz, R) + hsz - np.dot([dx, dy], Q)
+    return cur_pred
+
+
+# labeled frames at the start, in the middle and at the end of the trajectory, so that windows get clipped
+@pytest.mark.parametrize('fnum', [FIRST_FRAME, FIRST_FRAME + 3, FIRST_FRAME + 20, FIRST_FRAME + N_TRX_FRAMES - 2])
+def test_align_window_preds_same_as_loop(fnum):
+    conf = easydict.EasyDict()
+    conf.imsz = (90, 100)
+    cur_trx = make_trx()
+    pred_locs = np.random.RandomState(fnum).rand(2 * HIST, N_CLASSES, 2) * 90
+    out = RNN_postprocess.align_window_preds(pred_locs, conf, fnum, cur_trx, HIST)
+    expected = loop_window_preds(pred_locs, conf, fnum, cur_trx, FIRST_FRAME, FIRST_FRAME + N_TRX_FRAMES - 1)
+    np.testing.assert_allclose(out, expected, rtol=1e-10, atol=1e-8)
+
+
+def test_align_window_preds_without_trx():
+    conf = easydict.EasyDict()
+    conf.imsz = (90, 100)
+    pred_locs = np.random.RandomState(0).rand(2 * HIST, N_CLASSES, 2)
+    np.testing.assert_array_equal(RNN_postprocess.align_window_preds(pred_locs, conf, 5, None, HIST), pred_locs)
+
+
+def test_window_frames_clipped_to_trx():
+    cur_trx = make_trx()
+    frames = RNN_postprocess.PredCache.window_frames(FIRST_FRAME + 2, HIST, cur_trx, 1000)
+    assert frames[0] == FIRST_FRAME
+    assert frames[-1] == FIRST_FRAME + 2 + HIST - 1
+    frames = RNN_postprocess.PredCache.window_frames(3, HIST, None, 6)
+    assert frames.min() == 0 and frames.max() == 5
@@ -0,0 +1,81 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+import trk_filter
+
+
+def make_trk(n_frames=50, n_parts=3, n_targets=2, noise=0., seed=0):
+    ''' nparts x 2 x nframes x ntargets array of straight line tracks. '''
+    rng = np.random.RandomState(seed)
+    t = np.arange(n_frames, dtype='float64')
+    p = np.zeros([n_parts, 2, n_frames, n_targets])
+    for part in range(n_parts):
+        for tgt in range(n_targets):
+            p[part, 0, :, tgt] = 10 * part + 2 * tgt + 0.5 * t
+            p[part, 1, :, tgt] = 5 * part - tgt + 0.25 * t
+    return p + noise * rng.randn(*p.shape)
+
+
+def test_median_matches_reference():
+    p = make_trk(noise=1.)
+    window = 5
+    out = trk_filter.median_filter(p, window=window)
+    half = window // 2
+    ref = np.zeros_like(p)
+    for f in range(p.shape[2]):
+        ref[:, :, f] = np.median(p[:, :, max(f - half, 0):f + half + 1], axis=2)
+    np.testing.assert_allclose(out, ref)
+
+
+def test_median_removes_outlier():
+    p = make_trk()
+    noisy = p.copy()
+    noisy[0, 0, 20, 0] += 100.
+    out = trk_filter.median_filter(noisy, window=5)
+    np.testing.assert_allclose(out[:, :, 2:-2], p[:, :, 2:-2], atol=1e-9)
+
+
+def test_median_chunked_same_as_whole():
+    p = make_trk(n_frames=95, noise=1.)
+    whole = trk_filter.median_filter(p, window=7, chunk_size=None)
+    chunked = trk_filter.median_filter(p, window=7, chunk_size=20)
+    np.testing.assert_allclose(chunked, whole)
+
+
+def test_nans_passthrough():
+    p = make_trk(noise=1.)
+    p[1, :, 10:15, 0] = np.nan
+    p[:, :, :, 1] = np.nan
+    for filter_type in trk_filter.FILTER_TYPES:
+        out = trk_filter.filter_trk_array(p, filter_type)
+        assert out.shape == p.shape
+        assert np.array_equal(np.isnan(out), np.isnan(p)), filter_type
+
+
+def test_fill_gaps():
+    p = make_trk(noise=0.1)
+    p[1, :, 10:13, 0] = np.nan
+    for filter_type in ['median', 'kalman']:
+        out = trk_filter.filter_trk_array(p, filter_type, fill_gaps=True)
+        assert not np.any(np.isnan(out)), filter_type
+
+
+def test_kalman_smooths_noise():
+    clean = make_trk(n_frames=200)
+    noisy = clean + 2. * np.random.RandomState(1).randn(*clean.shape)
+    out = trk_filter.kalman_smoother(noisy, q=0.01, r=4.)
+    err_in = np.mean((noisy - clean) ** 2)
+    err_out = np.mean((out - clean) ** 2)
+    assert err_out < 0.5 * err_in
+
+
+def test_kalman_low_confidence_is_ignored():
+    clean = make_trk(n_frames=100)
+    noisy = clean.copy()
+    noisy[0, 0, 50, 0] += 50.
+    conf = np.ones(clean.shape[:1] + clean.shape[2:])
+    conf[0, 50, 0] = 1e-3
+    out_conf = trk_filter.kalman_smoother(noisy, conf=conf, q=0.01)
+    out = trk_filter.kalman_smoother(noisy, q=0.01)
+    assert abs(out_conf[0, 0, 50, 0] - clean[0, 0, 50, 0]) < abs(out[0, 0, 50, 0] - clean[0, 0, 50, 0])
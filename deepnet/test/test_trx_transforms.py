@@ -0,0 +1,79 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import math
+import numpy as np
+import pytest
+import easydict
+import trx_transforms
+
+N = 200
+N_PTS = 7
+PSZ = (90, 100)
+
+
+def make_conf(align):
+    conf = easydict.EasyDict()
+    conf.imsz = PSZ
+    conf.img_dim = 1
+    conf.trx_align_theta = align
+    return conf
+
+
+def make_trx(seed=0):
+    rng = np.random.RandomState(seed)
+    x = rng.rand(N) * 500
+    y = rng.rand(N) * 500
+    theta = (rng.rand(N) - 0.5) * 4 * math.pi
+    x[0] = np.nan
+    locs = rng.rand(N, N_PTS, 2) * 500
+    locs[1, 2, :] = np.nan
+    return x, y, theta, locs
+
+
+@pytest.mark.parametrize('align', [True, False])
+def test_batched_same_as_per_row(align):
+    import multiResData
+    import APT_interface as apt
+    conf = make_conf(align)
+    x, y, theta, locs = make_trx()
+    A = trx_transforms.crop_matrices(conf, x, y, theta)
+    fwd = trx_transforms.apply_matrices(A, locs)
+    inv = trx_transforms.to_orig_batch(conf, locs, x, y, theta)
+    im = (np.random.RandomState(1).rand(600, 600) * 255).astype('uint8')
+    for ndx in range(N):
+        patch, lr = multiResData.crop_patch_trx(conf, im, x[ndx], y[ndx], theta[ndx], locs[ndx])
+        assert np.array_equal(lr, fwd[ndx], equal_nan=True), ndx
+        if ndx > 0:
+            assert np.array_equal(patch, trx_transforms.crop_patch(conf, im, A[ndx])), ndx
+        orig = apt.to_orig(conf, locs[ndx], x[ndx], y[ndx], theta[ndx])
+        assert np.array_equal(orig, inv[ndx], equal_nan=True), ndx
+
+
+@pytest.mark.parametrize('align', [True, False])
+def test_crop_and_uncrop_are_inverses(align):
+    conf = make_conf(align)
+    x, y, theta, locs = make_trx()
+    A = trx_transforms.crop_matrices(conf, x[1:], y[1:], theta[1:])
+    fwd = trx_transforms.apply_matrices(A, locs[1:])
+    back = trx_transforms.to_orig_batch(conf, fwd, x[1:], y[1:], theta[1:])
+    np.testing.assert_allclose(back, locs[1:], atol=1e-6)
+
+
+def test_detect_centers():
+    locs = np.array([[[0., 0.], [2., 4.]],
+                     [[np.nan, np.nan], [1., 1.]],
+                     [[np.nan, np.nan], [np.nan, np.nan]]])
+    centers = trx_transforms.detect_centers(locs)
+    np.testing.assert_allclose(centers[:2], [[1., 2.], [1., 1.]])
+    assert np.all(np.isnan(centers[2]))
+
+
+def test_convert_to_orig_batch_crop():
+    conf = make_conf(True)
+    conf.has_trx_file = False
+    locs = np.random.RandomState(2).rand(4, N_PTS, 2) * 50
+    out = trx_transforms.convert_to_orig_batch(locs, conf, np.arange(4), np.zeros(4, 'int'), None, [10, 80, 20, 90])
+    np.testing.assert_allclose(out, locs + [10, 20])
+    out = trx_transforms.convert_to_orig_batch(locs, conf, np.arange(4), np.zeros(4, 'int'), None, None)
+    np.testing.assert_allclose(out, locs)
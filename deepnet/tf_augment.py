@@ -0,0 +1,218 @@
+''' Image augmentation with tensorflow ops.
+
+Graph version of PoseTools.preprocess_ims and PoseTools.create_label_images for batches of
+single animal examples, so that the training dataset pipeline doesn't have to go through tf.py_func
+(and the GIL) for augmentation. The random transformations are drawn as in PoseTools:
+    flips: each example is flipped with probability 0.5, landmarks are swapped using flipLandmarkMatches.
+    affine: rotation, scaling and translation as in randomly_affine. If check_bounds_distort is set,
+        upto 5 random transforms are tried and the first one that keeps all the landmarks inside the
+        image is used. If none of them do, the example is not transformed.
+    brightness/contrast: as in randomly_adjust.
+Differences from PoseTools: images are warped with bilinear instead of bicubic interpolation,
+downsampling uses area interpolation, and CLAHE contrast adjustment (conf.adjust_contrast) is not
+supported (use supported() to check).
+'''
+
+import numpy as np
+import tensorflow
+from lazy_import import tf_compat
+tf = tf_compat(tensorflow)
+from tensorflow.contrib.image import transform as image_transform
+
+N_AFFINE_TRIES = 5
+
+
+def supported(conf):
+    return not conf.adjust_contrast
+
+
+def _rand(shape):
+    return tf.random_uniform(shape, dtype=tf.float32)
+
+
+def flip_perm(conf):
+    ''' Landmark order after flipping '''
+    pairs = conf.flipLandmarkMatches
+    return [int(pairs.get('{}'.format(ll), ll)) for ll in range(conf.n_classes)]
+
+
+def scale_images(ims, locs, scale):
+    sz = ims.get_shape().as_list()
+    szy_ds = int(sz[1]//scale)
+    szx_ds = int(sz[2]//scale)
+    scaley_actual = sz[1]/szy_ds
+    scalex_actual = sz[2]/szx_ds
+    valid = tf.logical_not(tf.is_nan(locs)) & (locs > -10000)
+    if scale != 1:
+        ims = tf.image.resize_images(ims, [szy_ds, szx_ds], method=tf.image.ResizeMethod.AREA)
+    new_x = (locs[..., 0] - (scalex_actual - 1) / 2) / scalex_actual
+    new_y = (locs[..., 1] - (scaley_actual - 1) / 2) / scaley_actual
+    new_locs = tf.stack([new_x, new_y], axis=-1)
+    new_locs = tf.where(valid, new_locs, -100000 * tf.ones_like(new_locs))
+    return ims, new_locs
+
+
+def randomly_flip(ims, locs, conf, axis):
+    ''' Flips left-right for axis=2 and up-down for axis=1 '''
+    bsize = tf.shape(ims)[0]
+    sz = ims.get_shape().as_list()[axis]
+    do_flip = _rand([bsize]) < 0.5
+    flipped_ims = tf.reverse(ims, axis=[axis])
+    ims = tf.where(do_flip, flipped_ims, ims)
+
+    matched = tf.gather(locs, flip_perm(conf), axis=1)
+    coord = 0 if axis == 2 else 1
+    flipped_c = tf.where(matched[..., coord] < -1000, -100000 * tf.ones_like(matched[..., coord]),
+                         sz - 1 - matched[..., coord])
+    if coord == 0:
+        flipped_locs = tf.stack([flipped_c, matched[..., 1]], axis=-1)
+    else:
+        flipped_locs = tf.stack([matched[..., 0], flipped_c], axis=-1)
+    locs = tf.where(do_flip, flipped_locs, locs)
+    return ims, locs
+
+
+def affine_params(conf, shape):
+    ''' Random rotation (degrees), scale and translation as in PoseTools.randomly_affine '''
+    rangle = (_rand(shape) * 2 - 1) * conf.rrange
+    if conf.use_scale_factor_range:
+        srange = conf.scale_factor_range
+        sfactor = 1. + _rand(shape) * np.abs(srange - 1.)
+        sfactor = tf.where(_rand(shape) < 0.5, 1.0 / sfactor, sfactor)
+    else:
+        sfactor = (_rand(shape) - 0.5) * conf.scale_range + 1
+    sfactor = tf.maximum(sfactor, 0.05)
+    dx = (_rand(shape) * 2 - 1) * float(conf.trange) / conf.rescale
+    dy = (_rand(shape) * 2 - 1) * float(conf.trange) / conf.rescale
+    return rangle, sfactor, dx, dy
+
+
+def randomly_affine(ims, locs, conf):
+    if conf.use_scale_factor_range:
+        srange = conf.scale_factor_range
+        no_rescale = (srange > 1.0 / 1.01) and (srange < 1.01)
+    else:
+        no_rescale = conf.scale_range < .01
+    if conf.rrange < 1 and conf.trange < 1 and no_rescale:
+        return ims, locs
+
+    rows, cols = ims.get_shape().as_list()[1:3]
+    bsize = tf.shape(ims)[0]
+    n_tries = N_AFFINE_TRIES if conf.check_bounds_distort else 1
+    rangle, sfactor, dx, dy = affine_params(conf, [bsize, n_tries])
+
+    # same as cv2.getRotationMatrix2D((cols/2,rows/2), rangle, sfactor) with dx, dy added
+    theta = rangle * np.pi / 180
+    alpha = sfactor * tf.cos(theta)
+    beta = sfactor * tf.sin(theta)
+    cx = cols / 2.
+    cy = rows / 2.
+    tx = (1 - alpha) * cx - beta * cy + dx
+    ty = beta * cx + (1 - alpha) * cy + dy
+
+    # landmarks for each try: B x tries x N
+    lx = locs[:, None, :, 0]
+    ly = locs[:, None, :, 1]
+    new_x = alpha[..., None] * lx + beta[..., None] * ly + tx[..., None]
+    new_y = -beta[..., None] * lx + alpha[..., None] * ly + ty[..., None]
+
+    if conf.check_bounds_distort:
+        valid = tf.logical_not(tf.is_nan(lx)) & (lx > -1000)
+        in_bounds = (new_x > 0) & (new_y > 0) & (new_x <= cols) & (new_y <= rows)
+        sane = tf.reduce_all(in_bounds | tf.logical_not(valid), axis=2)  # B x tries
+        any_sane = tf.reduce_any(sane, axis=1)
+        sel = tf.argmax(tf.cast(sane, tf.int32), axis=1, output_type=tf.int32)
+    else:
+        any_sane = tf.ones([bsize], dtype=tf.bool)
+        sel = tf.zeros([bsize], dtype=tf.int32)
+    gather_ndx = tf.stack([tf.range(bsize), sel], axis=1)
+
+    def pick(x, default):
+        return tf.where(any_sane, tf.gather_nd(x, gather_ndx), default * tf.ones([bsize]))
+
+    alpha, beta, tx, ty = pick(alpha, 1.), pick(beta, 0.), pick(tx, 0.), pick(ty, 0.)
+    new_x = tf.where(any_sane, tf.gather_nd(new_x, gather_ndx), locs[..., 0])
+    new_y = tf.where(any_sane, tf.gather_nd(new_y, gather_ndx), locs[..., 1])
+
+    # image.transform maps output to input pixel locations, so use the inverse of the affine matrix.
+    det = alpha ** 2 + beta ** 2
+    ia, ib = alpha / det, beta / det
+    inv = tf.stack([ia, -ib, -(ia * tx - ib * ty), ib, ia, -(ib * tx + ia * ty),
+                    tf.zeros([bsize]), tf.zeros([bsize])], axis=1)
+    ims = image_transform(ims, inv, interpolation='BILINEAR')
+
+    high_valid = locs[..., 0] > -1000
+    new_x = tf.where(high_valid, new_x, -100000 * tf.ones_like(new_x))
+    new_y = tf.where(high_valid, new_y, -100000 * tf.ones_like(new_y))
+    new_locs = tf.stack([new_x, new_y], axis=-1)
+    return ims, new_locs
+
+
+def randomly_adjust(ims, conf):
+    brange = conf.brange
+    bdiff = brange[1] - brange[0]
+    crange = conf.crange
+    cdiff = crange[1] - crange[0]
+    imax = conf.imax
+    if (bdiff < 0.01) and (cdiff < 0.01):
+        return ims
+    bsize = tf.shape(ims)[0]
+    bfactor = (_rand([bsize]) * bdiff + brange[0])[:, None, None, None]
+    cfactor = (_rand([bsize]) * cdiff + crange[0])[:, None, None, None]
+    mm = tf.reduce_mean(ims, axis=[1, 2, 3], keepdims=True)
+    jj = ims + bfactor * imax
+    jj = tf.minimum(float(imax), (jj - mm) * cfactor + mm)
+    return tf.clip_by_value(jj, 0., float(imax))
+
+
+def normalize_mean(ims, conf):
+    if not conf.normalize_img_mean:
+        return ims
+    ims = ims - tf.reduce_mean(ims, axis=[1, 2], keepdims=True)
+    if conf.img_dim == 3 and conf.perturb_color:
+        bsize = tf.shape(ims)[0]
+        to_add = (_rand([bsize, 1, 1, 3]) - 0.5) * conf.imax / 8
+        ims = ims + to_add
+    return ims
+
+
+def preprocess_ims(ims, locs, conf, distort, scale):
+    ''' Same as PoseTools.preprocess_ims for tensors. ims is B x H x W x C with known H, W and C, locs is B x N x 2. '''
+    ims = tf.cast(ims, tf.float32)
+    locs = tf.cast(locs, tf.float32)
+    ims, locs = scale_images(ims, locs, scale)
+    if distort:
+        if conf.horz_flip:
+            ims, locs = randomly_flip(ims, locs, conf, axis=2)
+        if conf.vert_flip:
+            ims, locs = randomly_flip(ims, locs, conf, axis=1)
+        ims, locs = randomly_affine(ims, locs, conf)
+        ims = randomly_adjust(ims, conf)
+    ims = normalize_mean(ims, conf)
+    return ims, locs
+
+
+def create_label_images(locs, im_sz, scale, blur_rad):
+    ''' Same as PoseTools.create_label_images for tensors. locs is B x N x 2. '''
+    sz0 = int(im_sz[0] // scale)
+    sz1 = int(im_sz[1] // scale)
+    scaley_actual = im_sz[0] / sz0
+    scalex_actual = im_sz[1] / sz1
+    k_size = max(int(round(3 * blur_rad)), 1)
+
+    x = locs[..., 0]
+    y = locs[..., 1]
+    valid = tf.logical_not(tf.is_nan(x) | tf.is_nan(y) | tf.is_inf(x) | tf.is_inf(y)) & (x >= -1000)
+    mx = tf.round((x - (scalex_actual - 1) / 2) / scalex_actual)
+    my = tf.round((y - (scaley_actual - 1) / 2) / scaley_actual)
+    mx = tf.where(valid, mx, tf.zeros_like(mx))
+    my = tf.where(valid, my, tf.zeros_like(my))
+
+    # the blurred label is a gaussian truncated at k_size pixels, with peak 1
+    gx = tf.range(sz1, dtype=tf.float32)[None, None, :] - mx[..., None]  # B x N x sz1
+    gy = tf.range(sz0, dtype=tf.float32)[None, None, :] - my[..., None]  # B x N x sz0
+    wx = tf.exp(-gx ** 2 / (2. * blur_rad ** 2)) * tf.cast(tf.abs(gx) <= k_size, tf.float32)
+    wy = tf.exp(-gy ** 2 / (2. * blur_rad ** 2)) * tf.cast(tf.abs(gy) <= k_size, tf.float32)
+    wy = wy * tf.cast(valid, tf.float32)[..., None]
+    label_ims = tf.einsum('bny,bnx->byxn', wy, wx)
+    return (label_ims - 0.5) * 2.
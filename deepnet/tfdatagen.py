@@ -47,13 +47,15 @@ def distsquaredpts2limb(zz, startxy, sehat):
 def distsquaredpts2limb2(zz, xs, ys, xe, ye, dse2):
     '''
     Prob better (numerically) version of distsquaredpts2limb
+    zz: 2 x ... (x/y) points
     xs, ys, xe, ye: x/ystart, x/yend
     dse2: (xe-xs)**2 + (ye-ys)**2
+    xs, ys, xe, ye and dse2 can be arrays that broadcast against zz[0], eg a limb per row of points.
     '''
 
     assert zz.shape[0] == 2
 
-    num = (ye - ys)*zz[0, :] - (xe - xs)*zz[1, :] + xe*ys - ye*xs
+    num = (ye - ys)*zz[0] - (xe - xs)*zz[1] + xe*ys - ye*xs
     zzdist2 = np.square(num) / dse2
     return zzdist2
 
@@ -106,74 +108,67 @@ def create_affinity_labels(locs, imsz, graph,
     nbatch = locs.shape[0]
     out = np.zeros([nbatch, imsz[0], imsz[1], nlimb * 2])
     n_steps = 2 * max(imsz)
-
-    for cur in range(nbatch):
-        for mndx in range(locs.shape[1]):
-            for ndx, e in enumerate(graph):
-                startxy = locs[cur, mndx, e[0], :]
-                start_x, start_y = locs[cur, mndx, e[0], :]
-                end_x, end_y = locs[cur, mndx, e[1], :]
-                assert not (np.isnan(start_x) or np.isnan(start_y) or np.isnan(end_x) or np.isnan(end_y))
-                assert not (np.isinf(start_x) or np.isinf(start_y) or np.isinf(end_x) or np.isinf(end_y))
-                if (start_x < -1000) or (start_y < -1000):
-                    # multi labeled animal that are not labeled
-                    continue
-
-                ll2 = (start_x - end_x) ** 2 + (start_y - end_y) ** 2
-                ll = np.sqrt(ll2)
-
-                if ll == 0:
-                    # Can occur if start/end labels identical
-                    # Don't update out/PAF
-                    continue
-
-                costh = (end_x - start_x) / ll
-                sinth = (end_y - start_y) / ll
-                zz = None
-                TUBESTEP = 0.25 # seems like overkill (smaller than nec)
-                ntubestep = int(np.ceil(tubewidth / TUBESTEP + 1))
-                for delta in np.linspace(-tuberad, tuberad, ntubestep):
-                    # delta indicates perpendicular displacement from line/limb segment (in px)
-
-                    xx = np.round(np.linspace(start_x + delta * sinth, end_x + delta * sinth, n_steps))
-                    yy = np.round(np.linspace(start_y - delta * costh, end_y - delta * costh, n_steps))
-                    if zz is None:
-                        zz = np.stack([xx, yy])
-                    else:
-                        zz = np.concatenate([zz, np.stack([xx, yy])], axis=1)
-                # zz now has all the pixels that are along the line.
-                # or "tube" of width tubewidth around limb
-                zz = np.unique(zz, axis=1)
-                # zz now has all the unique pixels that are along the line with thickness==tubewidth.
-                # zz shape is (2, n)
-                # zz is rounded, representing px centers; startxy is not rounded
-                if tubeblur:
-                    # since zz is rounded, some points in zz may violate tubeblurclip.
-                    zzdist2 = distsquaredpts2limb2(zz, start_x, start_y, end_x, end_y, ll2)
-                    w = np.exp(-zzdist2/2.0/tubeblursig**2)
-                    # tfwsmall = w < tubeblurclip
-                    # if np.any(tfwsmall):
-                    #     print "Small w vals: {}/{}".format(np.count_nonzero(tfwsmall), tfwsmall.size)
-                    #     print w[tfwsmall]
-                    assert zz.shape[1] == w.size
-
-                    for i in range(w.size):
-                        x, y = zz[:, i]
-                        xint = int(round(x))  # should already be rounded
-                        yint = int(round(y))  # etc
-                        if xint < 0 or xint >= out.shape[2] or yint < 0 or yint >= out.shape[1]:
-                            continue
-                        out[cur, yint, xint, ndx * 2] = w[i] * costh
-                        out[cur, yint, xint, ndx * 2 + 1] = w[i] * sinth
-
-                else:
-                    for x, y in zz.T:
-                        xint = int(round(x)) # already rounded?
-                        yint = int(round(y)) # etc
-                        if xint < 0 or xint >= out.shape[2] or yint < 0 or yint >= out.shape[1]:
-                            continue
-                        out[cur, yint, xint, ndx * 2] = costh
-                        out[cur, yint, xint, ndx * 2 + 1] = sinth
+    if nlimb == 0:
+        return out
+
+    graph = np.array(graph, dtype='int64').reshape([nlimb, 2])
+    limb_locs = locs[:, :, graph, :]  # nbatch x nanimal x nlimb x 2(start/end) x 2(x/y)
+    assert np.all(np.isfinite(limb_locs))
+
+    TUBESTEP = 0.25 # seems like overkill (smaller than nec)
+    ntubestep = int(np.ceil(tubewidth / TUBESTEP + 1))
+    # delta indicates perpendicular displacement from line/limb segment (in px)
+    deltas = np.linspace(-tuberad, tuberad, ntubestep)
+    steps = np.arange(n_steps)
+    b_ndx = np.broadcast_to(np.arange(nbatch)[:, None, None, None], (nbatch, nlimb, ntubestep, n_steps))
+    c_ndx = np.broadcast_to(2 * np.arange(nlimb)[None, :, None, None], (nbatch, nlimb, ntubestep, n_steps))
+
+    # Pixels along all the limbs of an animal are generated together. Animals are done in order so that,
+    # as before, later animals overwrite earlier ones where their limbs overlap.
+    for mndx in range(locs.shape[1]):
+        start_x, start_y = limb_locs[:, mndx, :, 0, 0], limb_locs[:, mndx, :, 0, 1]  # nbatch x nlimb
+        end_x, end_y = limb_locs[:, mndx, :, 1, 0], limb_locs[:, mndx, :, 1, 1]
+
+        ll2 = (start_x - end_x) ** 2 + (start_y - end_y) ** 2
+        ll = np.sqrt(ll2)
+        # multi labeled animals that are not labeled, and limbs whose start/end labels are identical.
+        valid = (start_x >= -1000) & (start_y >= -1000) & (ll > 0)
+        if not np.any(valid):
+            continue
+        ll = np.where(valid, ll, 1.)
+        ll2 = np.where(valid, ll2, 1.)
+        costh = (end_x - start_x) / ll
+        sinth = (end_y - start_y) / ll
+
+        # points along the lines displaced by deltas, computed exactly as np.linspace does.
+        # nbatch x nlimb x ntubestep x n_steps
+        def tube_coords(s, e, off):
+            s = s[:, :, None] + deltas * off[:, :, None]
+            e = e[:, :, None] + deltas * off[:, :, None]
+            zz = steps * ((e - s) / (n_steps - 1))[..., None] + s[..., None]
+            zz[..., -1] = e
+            return np.round(zz)
+
+        xx = tube_coords(start_x, end_x, sinth)
+        yy = tube_coords(start_y, end_y, -costh)
+        # zz now has all the pixels that are along the line.
+        # or "tube" of width tubewidth around limb
+        sel = valid[:, :, None, None] & (xx >= 0) & (xx < out.shape[2]) & (yy >= 0) & (yy < out.shape[1])
+
+        if tubeblur:
+            # since zz is rounded, some points in zz may violate tubeblurclip.
+            xs, ys, xe, ye, dse2 = [v[:, :, None, None] for v in (start_x, start_y, end_x, end_y, ll2)]
+            zzdist2 = distsquaredpts2limb2(np.stack([xx, yy]), xs, ys, xe, ye, dse2)
+            w = np.exp(-zzdist2 / 2.0 / tubeblursig ** 2)
+        else:
+            w = np.ones(xx.shape)
+
+        cb, cc = b_ndx[sel], c_ndx[sel]
+        cy, cx = yy[sel].astype('int64'), xx[sel].astype('int64')
+        cw = w[sel]
+        # Duplicate pixels within a limb get the same value, so the order of assignment doesn't matter.
+        out[cb, cy, cx, cc] = cw * np.broadcast_to(costh[:, :, None, None], xx.shape)[sel]
+        out[cb, cy, cx, cc + 1] = cw * np.broadcast_to(sinth[:, :, None, None], xx.shape)[sel]
 
     return out
 
@@ -0,0 +1,184 @@
+''' Temporal filtering of tracking outputs.
+
+Filters work on trk arrays of size nparts x 2 x nframes x ntargets (as in trk['pTrk']) and filter
+all the parts and targets together along the frame axis. Long movies are filtered in chunks of
+chunk_size frames that overlap by the filter's support, so memory use doesn't grow with movie length.
+NaNs (untracked frames) are handled, and are kept as NaN in the output unless fill_gaps is True.
+
+Filters:
+    median: running median over window frames.
+    savgol: Savitzky-Golay filter with the given window and polynomial order.
+    kalman: constant velocity Kalman (RTS) smoother. If confidences (nparts x nframes x ntargets, eg
+        trk['pTrkconf']) are given, observations with low confidence are trusted less.
+'''
+
+import logging
+import warnings
+import numpy as np
+from scipy import signal
+
+FILTER_TYPES = ('median', 'savgol', 'kalman')
+
+
+def median_filter(p, window=5, fill_gaps=False, chunk_size=10000):
+    return _chunked(_median, p, None, window // 2 + 1, chunk_size, fill_gaps, window=window)
+
+
+def savgol_filter(p, window=9, order=2, fill_gaps=False, chunk_size=10000):
+    return _chunked(_savgol, p, None, window // 2 + 1, chunk_size, fill_gaps, window=window, order=order)
+
+
+def kalman_smoother(p, conf=None, q=1., r=4., fill_gaps=False, chunk_size=10000, overlap=200):
+    ''' q is the variance of the acceleration noise (px^2/frame^4) and r the variance of the observation noise (px^2)
+    for observations with confidence 1. '''
+    if conf is not None:
+        conf = conf[:, np.newaxis, ...]
+    return _chunked(_kalman, p, conf, overlap, chunk_size, fill_gaps, q=q, r=r)
+
+
+def filter_trk_array(p, filter_type, conf=None, **kwargs):
+    ''' Applies filter_type to p (nparts x 2 x nframes x ntargets). kwargs are passed to the filter. '''
+    if filter_type == 'median':
+        return median_filter(p, **kwargs)
+    elif filter_type == 'savgol':
+        return savgol_filter(p, **kwargs)
+    elif filter_type == 'kalman':
+        return kalman_smoother(p, conf=conf, **kwargs)
+    else:
+        raise ValueError('Unknown filter type {}. Should be one of {}'.format(filter_type, FILTER_TYPES))
+
+
+def filter_trk_file(in_file, out_file, filter_type, **kwargs):
+    ''' Filters pTrk in trk file in_file and saves it to out_file. The unfiltered pTrk is saved as pTrkraw. '''
+    import TrkFile
+    trk = TrkFile.load_trk(in_file)
+    p = np.array(trk['pTrk'], dtype='float64')
+    squeeze = p.ndim == 3
+    if squeeze:
+        # projects without trx
+        p = p[..., np.newaxis]
+    conf = trk.get('pTrkconf', None)
+    if conf is not None:
+        conf = np.array(conf, dtype='float64').reshape(p.shape[:1] + p.shape[2:])
+    out = filter_trk_array(p, filter_type, conf=conf, **kwargs)
+    trk['pTrkraw'] = trk['pTrk']
+    trk['pTrk'] = out[..., 0] if squeeze else out
+    trk.pop('issparse', None)
+    TrkFile.save_trk(out_file, trk)
+    logging.info('Saved {} filtered trk to {}'.format(filter_type, out_file))
+
+
+def _chunked(fn, p, conf, overlap, chunk_size, fill_gaps, **kwargs):
+    p = np.asarray(p, dtype='float64')
+    n_frames = p.shape[2]
+    if chunk_size is None or n_frames <= chunk_size:
+        out = fn(p, conf, **kwargs)
+    else:
+        out = np.empty_like(p)
+        for start in range(0, n_frames, chunk_size):
+            end = min(start + chunk_size, n_frames)
+            c_start = max(start - overlap, 0)
+            c_end = min(end + overlap, n_frames)
+            cur_conf = None if conf is None else conf[:, :, c_start:c_end]
+            cur_out = fn(p[:, :, c_start:c_end], cur_conf, **kwargs)
+            out[:, :, start:end] = cur_out[:, :, (start - c_start):(end - c_start)]
+    if not fill_gaps:
+        out[np.isnan(p)] = np.nan
+    return out
+
+
+def _median(p, conf, window):
+    half = window // 2
+    pad = np.full(p.shape[:2] + (half,) + p.shape[3:], np.nan)
+    padded = np.concatenate([pad, p, pad], axis=2)
+    # view with the window as the last axis. as_strided rather than sliding_window_view,
+    # which needs numpy>=1.20
+    windows = np.lib.stride_tricks.as_strided(padded, shape=p.shape + (window,),
+                                              strides=padded.strides + (padded.strides[2],),
+                                              writeable=False)
+    with warnings.catch_warnings():
+        # windows with no tracked frames
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        return np.nanmedian(windows, axis=-1)
+
+
+def _interp_gaps(p):
+    ''' Linearly interpolates NaNs along the frame axis. Series without any valid values stay NaN. '''
+    x = np.moveaxis(p, 2, -1).reshape([-1, p.shape[2]])
+    out = x.copy()
+    frames = np.arange(x.shape[1])
+    for ndx in np.where(np.any(np.isnan(x), axis=1))[0]:
+        valid = ~np.isnan(x[ndx])
+        if np.any(valid):
+            out[ndx] = np.interp(frames, frames[valid], x[ndx, valid])
+    return np.moveaxis(out.reshape(np.moveaxis(p, 2, -1).shape), -1, 2)
+
+
+def _savgol(p, conf, window, order):
+    n_frames = p.shape[2]
+    if n_frames < window:
+        window = n_frames if n_frames % 2 == 1 else n_frames - 1
+    if window <= order:
+        return p.copy()
+    filled = _interp_gaps(p)
+    out = signal.savgol_filter(np.nan_to_num(filled), window, order, axis=2, mode='interp')
+    out[np.isnan(filled)] = np.nan
+    return out
+
+
+def _kalman(p, conf, q, r):
+    ''' Constant velocity Kalman filter with RTS smoothing, run on all the series (part, coordinate, target) together. '''
+    n_frames = p.shape[2]
+    obs = np.moveaxis(p, 2, 0).reshape([n_frames, -1])  # frames x series
+    n_series = obs.shape[1]
+    if conf is None:
+        r_t = np.full(obs.shape, float(r))
+    else:
+        w = np.clip(np.moveaxis(np.broadcast_to(conf, p.shape), 2, 0).reshape([n_frames, -1]), 1e-3, 1.)
+        r_t = r / np.where(np.isnan(w), 1e-3, w)
+
+    F = np.array([[1., 1.], [0., 1.]])
+    Q = q * np.array([[0.25, 0.5], [0.5, 1.]])
+
+    # initialize at the first observation of each series
+    valid = ~np.isnan(obs)
+    has_obs = np.any(valid, axis=0)
+    first = np.argmax(valid, axis=0)
+    x = np.zeros([n_series, 2])
+    x[has_obs, 0] = obs[first[has_obs], np.where(has_obs)[0]]
+    P = np.tile(np.diag([1e4, 1e4]), [n_series, 1, 1])
+
+    x_pred = np.zeros([n_frames, n_series, 2])
+    P_pred = np.zeros([n_frames, n_series, 2, 2])
+    x_filt = np.zeros([n_frames, n_series, 2])
+    P_filt = np.zeros([n_frames, n_series, 2, 2])
+    for t in range(n_frames):
+        if t > 0:
+            x = x @ F.T
+            P = F @ P @ F.T + Q
+        x_pred[t] = x
+        P_pred[t] = P
+        # update with observation of position
+        z = obs[t]
+        sel = ~np.isnan(z)
+        s = P[sel, 0, 0] + r_t[t, sel]
+        K = P[sel, :, 0] / s[:, np.newaxis]
+        x[sel] = x[sel] + K * (z[sel] - x[sel, 0])[:, np.newaxis]
+        HP = P[sel, 0, :]
+        P[sel] = P[sel] - K[:, :, np.newaxis] * HP[:, np.newaxis, :]
+        x_filt[t] = x
+        P_filt[t] = P
+
+    x_smooth = x_filt[-1].copy()
+    out = np.zeros([n_frames, n_series])
+    out[-1] = x_smooth[:, 0]
+    for t in range(n_frames - 2, -1, -1):
+        Pp = P_pred[t + 1]
+        det = Pp[:, 0, 0] * Pp[:, 1, 1] - Pp[:, 0, 1] * Pp[:, 1, 0]
+        Pp_inv = np.stack([np.stack([Pp[:, 1, 1], -Pp[:, 0, 1]], -1),
+                           np.stack([-Pp[:, 1, 0], Pp[:, 0, 0]], -1)], 1) / det[:, np.newaxis, np.newaxis]
+        C = P_filt[t] @ F.T @ Pp_inv
+        x_smooth = x_filt[t] + (C @ (x_smooth - x_pred[t + 1])[:, :, np.newaxis])[:, :, 0]
+        out[t] = x_smooth[:, 0]
+    out[:, ~has_obs] = np.nan
+    return np.moveaxis(out.reshape((n_frames,) + p.shape[:2] + p.shape[3:]), 0, 2)
@@ -0,0 +1,225 @@
+''' Fast loading of trx files.
+
+Parsing a trx file with scipy loads every field of the trx struct, which for large Ctrax/FlyTracker
+outputs takes seconds and a lot of memory. load_trx reads only the fields APT uses, for both
+v5 and v7.3 MAT files, and stores them as a compact table. The table is cached next to the trx
+file (or in a temp directory if that is not writable) as a .npz file keyed on the trx file's mtime and
+size, and also in memory, so that loading the same trx file again is quick.
+
+TrxTable[ndx] returns the same kind of struct as sio.loadmat(trx_file)['trx'][0][ndx] restricted to
+the loaded fields, so it can be used wherever the per target trx struct was used.
+'''
+
+import os
+import hashlib
+import logging
+import tempfile
+import numpy as np
+import h5py
+from scipy import io as sio
+
+TRX_FIELDS = ('x', 'y', 'theta', 'a', 'b')
+TRX_CACHE_VERSION = 1
+TRX_CACHE_EXT = '.apt_trx.npz'
+
+_mem_cache = {}
+
+
+class TrxTable(object):
+    ''' Trajectories of all the targets in a trx file.
+    Per frame fields (TRX_FIELDS) of all the targets are concatenated into one array each.
+    firstframe and endframe are as in the trx file, ie 1-indexed and inclusive.
+    '''
+
+    def __init__(self, fields, firstframe, endframe, trx_file=None):
+        self.fields = fields
+        self.firstframe = firstframe
+        self.endframe = endframe
+        self.trx_file = trx_file
+        lengths = np.array([int(e - f + 1) for f, e in zip(firstframe, endframe)], dtype='int64')
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype('int64')
+        self.lengths = lengths
+
+    @property
+    def n_trx(self):
+        return len(self.firstframe)
+
+    def __len__(self):
+        return self.n_trx
+
+    def __getitem__(self, ndx):
+        if ndx < 0:
+            ndx += self.n_trx
+        if ndx < 0 or ndx >= self.n_trx:
+            raise IndexError('Trx index {} out of range for {} targets'.format(ndx, self.n_trx))
+        sl = slice(self.offsets[ndx], self.offsets[ndx] + self.lengths[ndx])
+        cur_trx = {k: v[np.newaxis, sl] for k, v in self.fields.items()}
+        cur_trx['firstframe'] = self.firstframe[ndx:ndx + 1, np.newaxis]
+        cur_trx['endframe'] = self.endframe[ndx:ndx + 1, np.newaxis]
+        cur_trx['nframes'] = self.lengths[ndx:ndx + 1, np.newaxis]
+        return cur_trx
+
+    def __iter__(self):
+        for ndx in range(self.n_trx):
+            yield self[ndx]
+
+    def first_frames(self):
+        ''' 0-indexed first frame of each target '''
+        return self.firstframe - 1
+
+    def end_frames(self):
+        ''' 0-indexed end frame (exclusive) of each target '''
+        return self.endframe.copy()
+
+    def index(self, trx_ndx, fnums):
+        ''' Index into the concatenated field arrays for targets trx_ndx at 0-indexed frames fnums.
+        Returns -1 where the target is not tracked.'''
+        trx_ndx = np.asarray(trx_ndx, dtype='int64')
+        fnums = np.asarray(fnums, dtype='int64')
+        rel = fnums - (self.firstframe[trx_ndx].astype('int64') - 1)
+        valid = (rel >= 0) & (rel < self.lengths[trx_ndx])
+        return np.where(valid, self.offsets[trx_ndx] + rel, -1)
+
+    def get(self, field, trx_ndx, fnums):
+        ''' Values of field for targets trx_ndx at 0-indexed frames fnums, NaN where the target is not tracked.
+        Locations are returned as stored, ie 1-indexed.'''
+        idx = self.index(trx_ndx, fnums)
+        out = self.fields[field][np.maximum(idx, 0)].astype('float64')
+        out[idx < 0] = np.nan
+        return out
+
+    def get_frame(self, fnum):
+        ''' All the targets tracked at 0-indexed frame fnum. Returns the target ids and a dict with their fields.'''
+        ids = np.where((self.firstframe - 1 <= fnum) & (self.endframe > fnum))[0]
+        fnums = np.full(ids.shape, fnum)
+        idx = self.index(ids, fnums)
+        return ids, {k: v[idx] for k, v in self.fields.items()}
+
+    def unpack(self):
+        ''' Same output as trx_transforms.unpack_trx '''
+        return {'x': self.fields['x'].astype('float64') - 1, 'y': self.fields['y'].astype('float64') - 1,
+                'theta': self.fields['theta'].astype('float64'),
+                'first_frames': np.array([int(f) for f in self.firstframe]) - 1,
+                'end_frames': np.array([int(e) for e in self.endframe]),
+                'offsets': self.offsets}
+
+
+def _read_v5(trx_file):
+    trx = sio.loadmat(trx_file, variable_names=['trx'])['trx'][0]
+    names = trx.dtype.names
+    firstframe = np.array([t['firstframe'][0, 0] for t in trx])
+    endframe = np.array([t['endframe'][0, 0] for t in trx])
+    fields = {}
+    for k in TRX_FIELDS:
+        if k in names:
+            fields[k] = np.concatenate([np.asarray(t[k]).ravel() for t in trx]) if len(trx) > 0 else np.zeros(0)
+    return fields, firstframe, endframe
+
+
+def _read_v73(trx_file):
+    with h5py.File(trx_file, 'r') as f:
+        trx = f['trx']
+        n_trx = trx['x'].shape[0]
+
+        def read_field(k, ndx):
+            return np.array(trx[trx[k][ndx, 0]]).ravel()
+
+        firstframe = np.array([read_field('firstframe', ndx)[0] for ndx in range(n_trx)])
+        endframe = np.array([read_field('endframe', ndx)[0] for ndx in range(n_trx)])
+        fields = {}
+        for k in TRX_FIELDS:
+            if k in trx.keys():
+                fields[k] = np.concatenate([read_field(k, ndx) for ndx in range(n_trx)]) if n_trx > 0 else np.zeros(0)
+    return fields, firstframe, endframe
+
+
+def read_trx_file(trx_file):
+    ''' Reads the trx file without caching. '''
+    try:
+        fields, firstframe, endframe = _read_v5(trx_file)
+    except NotImplementedError:
+        # trx file in v7.3 format
+        fields, firstframe, endframe = _read_v73(trx_file)
+
+    n = sum(int(e - f + 1) for f, e in zip(firstframe, endframe))
+    for k in TRX_FIELDS:
+        if k not in fields:
+            fields[k] = np.full(n, np.nan)
+        assert fields[k].size == n, 'Trx field {} in {} has {} entries, expected {}'.format(k, trx_file, fields[k].size, n)
+    return TrxTable(fields, firstframe, endframe, trx_file)
+
+
+def cache_files(trx_file):
+    ''' Candidate locations for the cache of trx_file, in order of preference. '''
+    trx_file = os.path.abspath(trx_file)
+    key = hashlib.md5(trx_file.encode('utf-8')).hexdigest()
+    return [trx_file + TRX_CACHE_EXT,
+            os.path.join(tempfile.gettempdir(), 'apt_trx_cache', key + TRX_CACHE_EXT)]
+
+
+def _file_key(trx_file):
+    st = os.stat(trx_file)
+    return np.array([TRX_CACHE_VERSION, st.st_mtime, st.st_size], dtype='float64')
+
+
+def _load_cache(cache_file, key, trx_file):
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        with np.load(cache_file) as d:
+            if not np.array_equal(d['key'], key):
+                return None
+            fields = {k: d['field_' + k] for k in TRX_FIELDS}
+            return TrxTable(fields, d['firstframe'], d['endframe'], trx_file)
+    except Exception:
+        logging.warning('Could not read trx cache {}'.format(cache_file))
+        return None
+
+
+def _save_cache(cache_file, key, table):
+    arrays = {'field_' + k: v for k, v in table.fields.items()}
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = cache_file + '.{}.tmp'.format(os.getpid())
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, key=key, firstframe=table.firstframe, endframe=table.endframe, **arrays)
+        os.replace(tmp_file, cache_file)
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def load_trx(trx_file, use_cache=True):
+    ''' Loads trx_file as a TrxTable. With use_cache, the table is cached in memory and on disk and
+    reused as long as the trx file's mtime and size don't change.'''
+    if not use_cache:
+        return read_trx_file(trx_file)
+
+    key = _file_key(trx_file)
+    mem_key = os.path.abspath(trx_file)
+    if mem_key in _mem_cache and np.array_equal(_mem_cache[mem_key][0], key):
+        return _mem_cache[mem_key][1]
+
+    table = None
+    cfiles = cache_files(trx_file)
+    for cache_file in cfiles:
+        table = _load_cache(cache_file, key, trx_file)
+        if table is not None:
+            break
+
+    if table is None:
+        table = read_trx_file(trx_file)
+        saved = False
+        for cache_file in cfiles:
+            saved = _save_cache(cache_file, key, table)
+            if saved:
+                break
+        if not saved:
+            logging.warning('Could not save trx cache for {}'.format(trx_file))
+
+    _mem_cache[mem_key] = (key, table)
+    return table
+
+
+def clear_cache():
+    _mem_cache.clear()
@@ -0,0 +1,185 @@
+''' Batched versions of the trx crop/uncrop transforms in multiResData.crop_patch_trx and
+APT_interface.to_orig/convert_to_orig.
+
+Trx are unpacked once per movie into contiguous arrays (unpack_trx), and the affine matrices
+for a whole batch of (frame, target) pairs are computed in one call. The matrices follow
+the row-vector convention of the per-row code, i.e. [x, y, 1] * A_full, and are computed with
+the same sequence of floating point operations as the per-row code, so that the results are
+identical. In particular cv2.getRotationMatrix2D is reproduced here, and cos/sin are computed with
+math (libm) rather than numpy, whose vectorized versions can differ in the last bit.
+Use test_trx_transforms to check against the per-row code.
+'''
+
+import math
+import numpy as np
+import cv2
+
+
+def unpack_trx(trx):
+    ''' Unpacks a list of trx structs (as loaded from the trx file) into contiguous arrays.
+    Returns a dict with
+        x, y: 0-indexed locations for all targets concatenated.
+        theta: orientation, concatenated the same way
+        first_frames, end_frames: 0-indexed first frame and (exclusive) end frame for each target
+        offsets: index of the first frame of each target in x, y and theta.
+    trx can also be a trx_table.TrxTable, which is already stored this way.
+    '''
+    if hasattr(trx, 'unpack'):
+        return trx.unpack()
+    first_frames = np.array([int(t['firstframe'][0, 0]) - 1 for t in trx])
+    end_frames = np.array([int(t['endframe'][0, 0]) for t in trx])
+    x = [np.asarray(t['x'][0, :], dtype='float64') - 1 for t in trx]
+    y = [np.asarray(t['y'][0, :], dtype='float64') - 1 for t in trx]
+    theta = [np.asarray(t['theta'][0, :], dtype='float64') for t in trx]
+    lengths = np.array([len(cur) for cur in x])
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype('int64')
+    return {'x': np.concatenate(x), 'y': np.concatenate(y), 'theta': np.concatenate(theta),
+            'first_frames': first_frames, 'end_frames': end_frames, 'offsets': offsets}
+
+
+def clip_fnums(trx_arr, trx_ndx, fnums):
+    ''' Clips the frames to the frames where the targets are tracked, the way multiResData.read_frame does.'''
+    trx_ndx = np.asarray(trx_ndx)
+    fnums = np.asarray(fnums)
+    return np.clip(fnums, trx_arr['first_frames'][trx_ndx], trx_arr['end_frames'][trx_ndx] - 1)
+
+
+def get_xytheta(trx_arr, trx_ndx, fnums):
+    ''' 0-indexed x, y and theta for targets trx_ndx at frames fnums (both arrays of size B). '''
+    trx_ndx = np.asarray(trx_ndx)
+    fnums = np.asarray(fnums)
+    idx = trx_arr['offsets'][trx_ndx] + fnums - trx_arr['first_frames'][trx_ndx]
+    return trx_arr['x'][idx], trx_arr['y'][idx], trx_arr['theta'][idx]
+
+
+def rotation_matrices(cx, cy, theta):
+    ''' Same as cv2.getRotationMatrix2D((cx, cy), theta * 180 / math.pi, 1) for each theta,
+    transposed into the 3x3 row-vector form used by crop_patch_trx and to_orig. Returns B x 3 x 3.'''
+    angle = theta * 180 / math.pi
+    angle = angle * (math.pi / 180)  # angle *= CV_PI/180 in opencv
+    alpha = np.array([math.cos(a) for a in angle]) * 1.
+    beta = np.array([math.sin(a) for a in angle]) * 1.
+    R = np.zeros([len(theta), 3, 3])
+    R[:, 0, 0] = alpha
+    R[:, 1, 0] = beta
+    R[:, 2, 0] = (1 - alpha) * cx - beta * cy
+    R[:, 0, 1] = -beta
+    R[:, 1, 1] = alpha
+    R[:, 2, 1] = beta * cx + (1 - alpha) * cy
+    R[:, 2, 2] = 1
+    return R
+
+
+def translation_matrices(tx, ty):
+    T = np.zeros([len(tx), 3, 3])
+    T[:, 0, 0] = 1
+    T[:, 1, 1] = 1
+    T[:, 2, 0] = tx
+    T[:, 2, 1] = ty
+    T[:, 2, 2] = 1
+    return T
+
+
+def crop_matrices(conf, x, y, theta, align_theta=None):
+    ''' Affine matrices (B x 3 x 3) from frame to patch coordinates as in multiResData.crop_patch_trx.
+    x, y should be 0-indexed. align_theta overrides conf.trx_align_theta if given.'''
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    theta = np.asarray(theta, dtype='float64')
+    psz_x = conf.imsz[1]
+    psz_y = conf.imsz[0]
+    if align_theta is None:
+        align_theta = conf.trx_align_theta
+    if align_theta:
+        T = translation_matrices(-x + float(psz_x) / 2 - 0.5, -y + float(psz_y) / 2 - 0.5)
+        R = rotation_matrices(float(psz_x) / 2 - 0.5, float(psz_y) / 2 - 0.5, theta + math.pi / 2)
+        A_full = np.matmul(T, R)
+    else:
+        x = np.round(x)
+        y = np.round(y)
+        A_full = translation_matrices(-x + float(psz_x) / 2 - 0.5, -y + float(psz_y) / 2 - 0.5)
+    return A_full
+
+
+def uncrop_matrices(conf, x, y, theta, align_theta=None):
+    ''' Affine matrices (B x 3 x 3) from patch to frame coordinates as in APT_interface.to_orig.
+    x, y should be 0-indexed. align_theta overrides conf.trx_align_theta if given.'''
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    theta = np.asarray(theta, dtype='float64')
+    psz_x = conf.imsz[1]
+    psz_y = conf.imsz[0]
+    if align_theta is None:
+        align_theta = conf.trx_align_theta
+    if align_theta:
+        T = translation_matrices(x - float(psz_x) / 2 + 0.5, y - float(psz_y) / 2 + 0.5)
+        R = rotation_matrices(float(psz_x) / 2 - 0.5, float(psz_y) / 2 - 0.5, -theta - math.pi / 2)
+        A_full = np.matmul(R, T)
+    else:
+        x = np.round(x)
+        y = np.round(y)
+        A_full = translation_matrices(x - float(psz_x) / 2 + 0.5, y - float(psz_y) / 2 + 0.5)
+    return A_full
+
+
+def apply_matrices(A_full, locs):
+    ''' Transforms locs (B x N x 2) with A_full (B x 3 x 3). Returns B x N x 2.'''
+    # Same memory layout as the per-row code, so that numpy uses the same matmul kernel
+    locs = np.ascontiguousarray(locs, dtype='float64')
+    A_full = np.ascontiguousarray(A_full)
+    lr = np.matmul(A_full[:, :2, :2].transpose([0, 2, 1]), locs.transpose([0, 2, 1])) + A_full[:, 2, :2, np.newaxis]
+    return lr.transpose([0, 2, 1])
+
+
+def crop_patch(conf, im_in, A_full):
+    ''' Patch for one frame given its crop matrix from crop_matrices. Same as the image returned by
+    multiResData.crop_patch_trx.'''
+    im = im_in.copy()
+    if im_in.ndim == 2:
+        im = im[:, :, np.newaxis]
+    A = A_full[:, :2].T
+    rpatch = cv2.warpAffine(im, A, (conf.imsz[1], conf.imsz[0]), flags=cv2.INTER_LINEAR)
+    if rpatch.ndim == 2:
+        rpatch = rpatch[:, :, np.newaxis]
+    return rpatch[:, :, :conf.img_dim]
+
+
+def to_orig_batch(conf, locs, x, y, theta):
+    ''' Batched APT_interface.to_orig. locs is B x N x 2 and x, y, theta are of size B. Everything 0-indexed.'''
+    return apply_matrices(uncrop_matrices(conf, x, y, theta), locs)
+
+
+def detect_centers(locs):
+    ''' Centers (B x 2) of the animals for two-stage (detect_crop_sz) crops: the mean of the landmarks
+    in locs (B x N x 2) that are not nan.'''
+    locs = np.asarray(locs, dtype='float64')
+    valid = ~np.any(np.isnan(locs), axis=-1)
+    n_valid = np.count_nonzero(valid, axis=1)
+    centers = np.where(valid[..., np.newaxis], locs, 0).sum(axis=1) / np.maximum(n_valid, 1)[:, np.newaxis]
+    centers[n_valid == 0, :] = np.nan
+    return centers
+
+
+def crop_around_locs(conf, im, locs):
+    ''' Axis aligned crop of size conf.imsz around the center of the landmarks locs (N x 2), which is
+    how the examples are created for two-stage tracking. Returns the patch and locs in the patch.'''
+    cx, cy = detect_centers(locs[np.newaxis, ...])[0]
+    A_full = crop_matrices(conf, [cx], [cy], [0.], align_theta=False)
+    return crop_patch(conf, im, A_full[0]), apply_matrices(A_full, locs[np.newaxis, ...])[0]
+
+
+def convert_to_orig_batch(base_locs, conf, fnums, trx_ndx, trx_arr, crop_loc):
+    ''' Batched APT_interface.convert_to_orig. base_locs is B x N x 2, fnums and trx_ndx are of size B.
+    trx_arr is the output of unpack_trx and is ignored for projects without trx. Everything 0-indexed.'''
+    if conf.has_trx_file:
+        x, y, theta = get_xytheta(trx_arr, trx_ndx, fnums)
+        return to_orig_batch(conf, base_locs, x, y, theta)
+    elif crop_loc is not None:
+        xlo, xhi, ylo, yhi = crop_loc
+        base_locs_orig = base_locs.copy()
+        base_locs_orig[..., 0] += xlo
+        base_locs_orig[..., 1] += ylo
+        return base_locs_orig
+    else:
+        return base_locs.copy()
+
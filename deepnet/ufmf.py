@@ -1390,7 +1390,7 @@ class UfmfSaverV1(UfmfSaverBase):
             this_str_head = struct.pack(FMT[1].SUBHEADER, xmin, ymin)
 
             str_buf.append( this_str_head + this_str_buf )
-        fullstr = ''.join(str_buf)
+        fullstr = b''.join(str_buf)
         if len(fullstr):
             self.file.write(fullstr)
         self.last_timestamp = timestamp